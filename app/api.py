@@ -1,9 +1,15 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
+from email.utils import format_datetime, parsedate_to_datetime
+import datetime
 import os
-from .database import get_user_history
+from .database import HISTORY_RESOLUTIONS, get_history_cache_stats, get_pool_stats, get_profile_cache_stats
+from .repository import get_user_history
+from . import log_sink
+from .coach import get_persona_cache_stats, get_prompt_stats
+from . import change_feed, chat_sessions, media, outbox, plan_jobs, plan_library, replies, sharding, vision_cache
 
 app = FastAPI()
 
@@ -16,13 +22,70 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def _not_modified(request, etag, last_modified):
+    """GET condicional: If-None-Match tem precedência sobre If-Modified-Since."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
 # Endpoint de API
+# ?from=AAAA-MM-DD&to=AAAA-MM-DD&resolution=day|week|month&points=N (todos opcionais)
 @app.get("/api/history/{user_id}")
-async def history(user_id: int):
-    data = get_user_history(user_id)
+async def history(
+    user_id: int,
+    request: Request,
+    date_from: datetime.date | None = Query(None, alias="from"),
+    date_to: datetime.date | None = Query(None, alias="to"),
+    resolution: str = Query("day"),
+    points: int | None = Query(None, ge=3),
+):
+    if resolution not in HISTORY_RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"resolution deve ser {', '.join(HISTORY_RESOLUTIONS)}")
+    if date_from and date_to and date_from > date_to:
+        raise HTTPException(status_code=400, detail="'from' depois de 'to'")
+    data = await get_user_history(user_id, date_from, date_to, resolution, points)
     if not data:
         return {"error": "Sem dados"}
-    return data
+    etag = f'"{data.pop("_version")}"'
+    last_modified = data.pop("_last_modified")
+    if last_modified is not None:
+        last_modified = last_modified.astimezone(datetime.timezone.utc)
+    # no-cache: o navegador guarda a resposta mas revalida sempre (304 sem corpo)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(data, headers=headers)
+
+# Métricas internas (pool de conexões, caches)
+@app.get("/api/stats")
+async def stats():
+    return {
+        "db_pool": get_pool_stats(),
+        "profile_cache": get_profile_cache_stats(),
+        "history_cache": get_history_cache_stats(),
+        "log_sink": log_sink.stats(),
+        "outbox": outbox.stats(),
+        "scheduler": sharding.stats(),
+        "change_feed": change_feed.stats(),
+        "persona_cache": get_persona_cache_stats(),
+        "prompt": get_prompt_stats(),
+        "coach_replies": replies.stats(),
+        "chat_sessions": chat_sessions.stats(),
+        "vision_cache": vision_cache.stats(),
+        "photo_preprocessing": media.stats(),
+        "plan_jobs": plan_jobs.stats(),
+        "plan_library": plan_library.stats(),
+    }
 
 # Rota Especial para o Index
 @app.get("/")
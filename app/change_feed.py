@@ -0,0 +1,88 @@
+import os
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from . import database
+
+# Propagação de escritas entre processos (vários workers do bot/API).
+# Cada escrita em users/consolidado faz pg_notify(CHANGE_CHANNEL) na própria
+# transação; aqui uma thread escuta o canal numa conexão dedicada (fora do pool)
+# e aplica os avisos dos outros processos: invalida perfil/histórico e atualiza
+# o índice de lembretes desses usuários.
+# Se a conexão cair, avisos podem ter se perdido: ao reconectar, descarta os
+# caches por usuário e força a reconstrução do índice.
+
+RECONNECT_DELAY = float(os.getenv("CHANGE_FEED_RECONNECT_DELAY", 5))  # s
+
+_thread = None
+_stop = threading.Event()
+_stats = {"notifications": 0, "own_skipped": 0, "users_refreshed": 0, "reconnects": 0, "connected": False}
+
+def _drain(conn):
+    user_ids = set()
+    while conn.notifies:
+        note = conn.notifies.pop(0)
+        _stats["notifications"] += 1
+        origin, _, ids = note.payload.partition(":")
+        if origin == database.CHANGE_ORIGIN:
+            _stats["own_skipped"] += 1
+            continue
+        user_ids.update(int(i) for i in ids.split(",") if i)
+    return user_ids
+
+def _listen(reconnecting):
+    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+    try:
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {database.CHANGE_CHANNEL}")
+        _stats["connected"] = True
+        if reconnecting:
+            # Só depois do LISTEN: nada escrito a partir daqui se perde
+            database.invalidate_all()
+        while not _stop.is_set():
+            if not select.select([conn], [], [], 1.0)[0]:
+                continue
+            conn.poll()
+            user_ids = _drain(conn)
+            if user_ids:
+                database.apply_remote_changes(user_ids)
+                _stats["users_refreshed"] += len(user_ids)
+    finally:
+        _stats["connected"] = False
+        conn.close()
+
+def _run():
+    reconnecting = False
+    while not _stop.is_set():
+        try:
+            _listen(reconnecting)
+        except Exception as e:
+            print(f"ChangeFeed: conexão perdida ({e}); reconectando em {RECONNECT_DELAY}s")
+        if _stop.is_set():
+            break
+        reconnecting = True
+        _stats["reconnects"] += 1
+        _stop.wait(RECONNECT_DELAY)
+
+def start():
+    """Inicia a thread de escuta (uma por processo)."""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="change-feed", daemon=True)
+    _thread.start()
+
+def stop():
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+    _thread = None
+
+def stats():
+    return dict(_stats)
@@ -0,0 +1,154 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Sessões de conversa por usuário (memória de curto prazo do coach).
+# Cada sessão guarda os últimos CHAT_MAX_TURNS turnos (usuário + coach) e um
+# resumo compacto dos turnos mais antigos, enviados como histórico junto da
+# mensagem atual. O pool é limitado por quantidade de sessões (LRU), por tempo
+# ocioso e por memória total (caracteres guardados); mídia vira só um marcador.
+
+MAX_TURNS = int(os.getenv("CHAT_MAX_TURNS", 6))                   # pares usuário/coach mantidos na íntegra
+MAX_SESSIONS = int(os.getenv("CHAT_POOL_SIZE", 5000))
+IDLE_SECONDS = float(os.getenv("CHAT_IDLE_SECONDS", 1800))
+MAX_CHARS = int(os.getenv("CHAT_POOL_MAX_CHARS", 20_000_000))     # teto de memória do pool
+TURN_MAX_CHARS = int(os.getenv("CHAT_TURN_MAX_CHARS", 2000))      # texto guardado por turno
+SUMMARY_MAX_CHARS = int(os.getenv("CHAT_SUMMARY_MAX_CHARS", 600))
+SUMMARY_ITEM_CHARS = 120
+
+_TOKEN_RE = re.compile(r'\[\[.*?\]\]', re.DOTALL)
+_SENTENCE_RE = re.compile(r'(.+?[.!?…])(\s|$)', re.DOTALL)
+
+_MEDIA_MARKERS = {"image": "[foto]", "audio": "[áudio]"}
+
+
+class ChatSession:
+    __slots__ = ("user_id", "turns", "summary", "last_used", "chars")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.turns = deque()  # (texto do usuário, texto do coach)
+        self.summary = ""
+        self.last_used = time.monotonic()
+        self.chars = 0
+
+    def contents(self):
+        """Histórico no formato multi-turno do LLM (role/parts)."""
+        history = []
+        if self.summary:
+            history.append({"role": "user", "parts": [f"(Resumo da conversa anterior: {self.summary})"]})
+            history.append({"role": "model", "parts": ["Entendido."]})
+        for user_text, reply in self.turns:
+            history.append({"role": "user", "parts": [user_text]})
+            history.append({"role": "model", "parts": [reply]})
+        return history
+
+
+_lock = threading.Lock()
+_sessions = OrderedDict()  # user_id -> ChatSession, em ordem LRU
+_total_chars = 0
+_stats = {"hits": 0, "misses": 0, "compactions": 0, "evicted_lru": 0, "evicted_idle": 0, "evicted_memory": 0}
+
+def _clean(text, limit=TURN_MAX_CHARS):
+    # Tokens de comando já foram aplicados; não precisam voltar ao modelo
+    text = " ".join(_TOKEN_RE.sub("", text or "").split())
+    return text[:limit] + "..." if len(text) > limit else text
+
+def _user_text(user_input, media_type):
+    marker = ""
+    if media_type:
+        marker = _MEDIA_MARKERS.get(media_type.split("/")[0], "[mídia]")
+    return " ".join(part for part in (marker, _clean(user_input)) if part)
+
+def _gist(text):
+    match = _SENTENCE_RE.match(text)
+    gist = match.group(1) if match else text
+    return gist[:SUMMARY_ITEM_CHARS] + "..." if len(gist) > SUMMARY_ITEM_CHARS else gist
+
+def _compact(session):
+    """Dobra os turnos além de MAX_TURNS no resumo (primeira frase de cada lado), sem chamar o LLM."""
+    while len(session.turns) > MAX_TURNS:
+        user_text, reply = session.turns.popleft()
+        session.summary = f"{session.summary} | Aluno: {_gist(user_text)} Coach: {_gist(reply)}".strip(" |")
+        _stats["compactions"] += 1
+    if len(session.summary) > SUMMARY_MAX_CHARS:
+        # Mantém o fim (mais recente)
+        session.summary = "..." + session.summary[-SUMMARY_MAX_CHARS:]
+
+def _size(session):
+    return len(session.summary) + sum(len(u) + len(r) for u, r in session.turns)
+
+def _drop(user_id, reason):
+    global _total_chars
+    session = _sessions.pop(user_id, None)
+    if session is not None:
+        _total_chars -= session.chars
+        _stats[reason] += 1
+
+def _evict(now):
+    # Ociosas primeiro (as mais antigas ficam no início do OrderedDict)
+    while _sessions:
+        user_id, session = next(iter(_sessions.items()))
+        if now - session.last_used <= IDLE_SECONDS:
+            break
+        _drop(user_id, "evicted_idle")
+    while len(_sessions) > MAX_SESSIONS:
+        _drop(next(iter(_sessions)), "evicted_lru")
+    while _total_chars > MAX_CHARS and len(_sessions) > 1:
+        _drop(next(iter(_sessions)), "evicted_memory")
+
+def history(user_id):
+    """Histórico (role/parts) a enviar antes da mensagem atual; [] sem sessão ativa."""
+    if user_id is None:
+        return []
+    now = time.monotonic()
+    with _lock:
+        session = _sessions.get(user_id)
+        if session is None or now - session.last_used > IDLE_SECONDS:
+            if session is not None:
+                _drop(user_id, "evicted_idle")
+            _stats["misses"] += 1
+            return []
+        _stats["hits"] += 1
+        return session.contents()
+
+def record(user_id, user_input, reply, media_type=None):
+    """Guarda o turno concluído (mensagem + resposta do coach) na sessão do usuário."""
+    global _total_chars
+    if user_id is None or not reply:
+        return
+    now = time.monotonic()
+    with _lock:
+        session = _sessions.get(user_id)
+        if session is None:
+            session = _sessions[user_id] = ChatSession(user_id)
+        _sessions.move_to_end(user_id)
+        session.turns.append((_user_text(user_input, media_type), _clean(reply)))
+        session.last_used = now
+        _compact(session)
+        size = _size(session)
+        _total_chars += size - session.chars
+        session.chars = size
+        _evict(now)
+
+def reset(user_id):
+    """Descarta a sessão (ex: /reset, perfil apagado)."""
+    global _total_chars
+    with _lock:
+        session = _sessions.pop(user_id, None)
+        if session is not None:
+            _total_chars -= session.chars
+
+def stats():
+    with _lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "sessions": len(_sessions),
+            "max_sessions": MAX_SESSIONS,
+            "chars": _total_chars,
+            "max_chars": MAX_CHARS,
+            "hit_rate": round(_stats["hits"] / lookups, 3) if lookups else None,
+        }
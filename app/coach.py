@@ -1,60 +1,38 @@
 import os
-import warnings
-# Suppress deprecation warning for now
-warnings.filterwarnings("ignore", category=FutureWarning, module="google.generativeai")
-import google.generativeai as genai
+import asyncio
+import logging
+import json
+import time
 from dotenv import load_dotenv
 from PIL import Image
 
+from . import chat_sessions, llm
+from .cache import TTLCache
+from .prompt_builder import build_sections, detect_topics, estimate_tokens, TOKEN_BUDGET
+
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
-def get_persona_instruction(profile):
-    """Gera a System Instruction baseada no nicho do usuário."""
+logger = logging.getLogger(__name__)
+
+# (backend, telegram_id, versão do perfil, nicho, tópicos) -> (system instruction, modelo, tokens)
+# A versão muda a cada alteração do perfil, então entradas antigas só saem por LRU/TTL.
+_persona_cache = TTLCache(
+    maxsize=int(os.getenv("PERSONA_CACHE_SIZE", 2000)),
+    ttl=float(os.getenv("PERSONA_CACHE_TTL", 3600))
+)
+_plan_model = None
+
+def build_persona(profile, user_message=None):
+    """
+    System Instruction com as seções do perfil escolhidas pelo orçamento de tokens.
+    Retorna (instrução, tokens estimados).
+    """
     niche = profile.get('niche', 'Geral')
-    preferences = profile.get('preferences', {})
-    
-    # Injeção de Contexto (LTM)
-    context_str = ""
-    if preferences:
-        context_str = "\nCONTEXTO & MEMÓRIA:\n"
-        for k, v in preferences.items():
-            context_str += f"- {k}: {v}\n"
-
-    # Injeção de Agenda Atual
-    reminders = profile.get('reminders', [])
-    schedule_str = ""
-    if reminders:
-        if isinstance(reminders, str):
-            try: reminders = json.loads(reminders)
-            except: reminders = []
-        if isinstance(reminders, list):
-            schedule_str = "\nAGENDA ATUAL:\n"
-            for r in reminders:
-                schedule_str += f"- {r.get('label')}: {r.get('time')}\n"
-
-    # Injeção de Dieta Atual
-    generated_plan = profile.get('generated_plan', {})
-    if isinstance(generated_plan, str):
-        try: generated_plan = json.loads(generated_plan)
-        except: generated_plan = {}
-    
-    diet_list = generated_plan.get('diet', [])
-    diet_str = ""
-    if diet_list:
-        diet_str = "\nDIETA ATUAL:\n"
-        for meal in diet_list:
-            foods = ", ".join(meal.get('foods', []))
-            diet_str += f"- {meal.get('meal')}: {foods}\n"
-
-    # Injeção de Treino Atual
-    workout = generated_plan.get('workout', {})
-    workout_str = ""
-    if workout:
-        workout_str = f"\nTREINO ATUAL ({workout.get('split', 'Geral')}):\n"
-        for day in workout.get('days', []):
-            exercises = ", ".join(day.get('exercises', []))
-            workout_str += f"- {day.get('day')}: {exercises}\n"
+    sections, _, _ = build_sections(profile, user_message)
+    context_str = sections["context"]
+    schedule_str = sections["schedule"]
+    diet_str = sections["diet"]
+    workout_str = sections["workout"]
 
     base_instruction = f"""
     Você é o ShapeBot, um Coach de Alta Performance e Nutricionista.
@@ -102,7 +80,7 @@ def get_persona_instruction(profile):
     """
     
     if niche == 'Programador':
-        return base_instruction + """
+        instruction = base_instruction + """
         PERSONALIDADE (MODO DEV):
         - Aja como um Tech Lead Sênior da Saúde.
         - Use analogias de código: 'bug no shape', 'deploy de massa magra', 'refatorar a dieta', 'garbage collection' (detox).
@@ -110,7 +88,7 @@ def get_persona_instruction(profile):
         - Seja prático, lógico e direto.
         """
     elif niche == 'Executivo':
-        return base_instruction + """
+        instruction = base_instruction + """
         PERSONALIDADE (MODO EXECUTIVO):
         - Aja como um Consultor de Alta Performance.
         - Foco em ROI (Retorno sobre Investimento) de energia e tempo.
@@ -118,7 +96,7 @@ def get_persona_instruction(profile):
         - Seja extremamente polido, eficiente e focado em resultados rápidos.
         """
     else: # Geral
-        return base_instruction + """
+        instruction = base_instruction + """
         PERSONALIDADE (MODO COACH):
         - Seja motivador, energético e acolhedor.
         - Use emojis e linguagem acessível.
@@ -126,57 +104,246 @@ def get_persona_instruction(profile):
         - Aja como aquele personal trainer gente boa.
         """
 
+    return instruction, estimate_tokens(instruction)
+
+def get_coach_model(profile, user_message=None):
+    """
+    Retorna o modelo (do backend ativo) com a persona do usuário, reaproveitando enquanto
+    o perfil (e as seções escolhidas para a mensagem) não mudarem.
+    """
+    backend = llm.get_backend()
+    # As seções escolhidas dependem só do perfil (versão) e dos tópicos da mensagem
+    topics = frozenset(detect_topics(user_message))
+    key = None
+    if profile.get('telegram_id') is not None and profile.get('_version'):
+        key = (backend.name, profile['telegram_id'], profile['_version'], profile.get('niche'), topics)
+        cached = _persona_cache.get(key)
+        if cached is not None:
+            _record_prompt_tokens(cached[2])
+            return cached[1]
+
+    system_instruction, tokens = build_persona(profile, user_message)
+    model = backend.create_model(system_instruction)
+    _record_prompt_tokens(tokens)
+    if key is not None:
+        _persona_cache.set(key, (system_instruction, model, tokens))
+    return model
+
+_prompt_stats = {"calls": 0, "tokens_total": 0, "tokens_last": 0, "tokens_max": 0}
+
+def _record_prompt_tokens(tokens):
+    _prompt_stats["calls"] += 1
+    _prompt_stats["tokens_total"] += tokens
+    _prompt_stats["tokens_last"] = tokens
+    _prompt_stats["tokens_max"] = max(_prompt_stats["tokens_max"], tokens)
+    logger.debug(f"System instruction: ~{tokens} tokens")
+
+def get_prompt_stats():
+    calls = _prompt_stats["calls"]
+    return {
+        **_prompt_stats,
+        "tokens_avg": round(_prompt_stats["tokens_total"] / calls, 1) if calls else None,
+        "budget": TOKEN_BUDGET,
+    }
+
+def get_persona_cache_stats():
+    return _persona_cache.stats()
+
+def use_backend(backend):
+    """Troca o backend de LLM (ex: llm_fake.FakeBackend em benchmarks) e descarta os modelos em cache."""
+    global _plan_model
+    llm.set_backend(backend)
+    _persona_cache.clear()
+    _plan_model = None
+    return backend
+
+class CoachError(Exception):
+    """Falha na chamada ao LLM (erro da API, resposta bloqueada/vazia)."""
+
+class CoachTimeout(CoachError):
+    """O LLM não respondeu dentro do prazo."""
+
+class CoachCancelled(CoachError):
+    """A chamada foi cancelada (o usuário saiu do fluxo)."""
+
+COACH_TIMEOUT = float(os.getenv("COACH_TIMEOUT", 60))
+PLAN_TIMEOUT = float(os.getenv("PLAN_TIMEOUT", 120))
+
+# Chamadas em andamento por usuário, para cancelar quando ele sai (/cancel, /reset)
+_inflight = {}
+
+def cancel_user_requests(user_id):
+    """Cancela as chamadas ao LLM em andamento do usuário. Retorna quantas foram canceladas."""
+    tasks = _inflight.pop(user_id, set())
+    for task in tasks:
+        task.cancel()
+    return len(tasks)
+
+async def run_for_user(user_id, coro, timeout):
+    """Executa a chamada com prazo, registrada para cancelamento por usuário."""
+    task = asyncio.ensure_future(asyncio.wait_for(coro, timeout))
+    if user_id is not None:
+        _inflight.setdefault(user_id, set()).add(task)
+    try:
+        return await task
+    except asyncio.TimeoutError:
+        raise CoachTimeout(f"Sem resposta do LLM em {timeout}s")
+    except asyncio.CancelledError:
+        # Só converte se quem foi cancelado é a chamada, não o handler que a aguarda
+        if task.cancelled() and not asyncio.current_task().cancelling():
+            raise CoachCancelled("Chamada cancelada")
+        raise
+    finally:
+        if user_id is not None:
+            tasks = _inflight.get(user_id)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    _inflight.pop(user_id, None)
+
+def _build_content_parts(user_input, media_data=None, media_type=None):
+    content_parts = []
+    if user_input:
+        content_parts.append(user_input)
+        
+    if media_data:
+        if isinstance(media_data, Image.Image) or hasattr(media_data, "uri"):
+            # PIL Image ou arquivo já enviado via upload_media
+            content_parts.append(media_data)
+        else:
+            # Bytes crus (ex: áudio) vão como blob inline com o mime type informado
+            content_parts.append({
+                "mime_type": media_type or "audio/mp3",
+                "data": media_data
+            })
+    return content_parts
+
+def _chat_contents(user_id, content_parts):
+    """Histórico recente da sessão do usuário + a mensagem atual (formato multi-turno)."""
+    return chat_sessions.history(user_id) + [{"role": "user", "parts": content_parts}]
+
+def _topic_message(user_input, media_type=None):
+    """Texto usado para escolher as seções do prompt; em áudio o conteúdo é desconhecido (tudo relevante)."""
+    if media_type and media_type.startswith("audio"):
+        return None
+    return user_input
+
+def _response_text(response):
+    try:
+        text = response.text
+    except Exception as e:
+        # Resposta bloqueada pelos filtros ou sem candidatos
+        raise CoachError(f"Resposta sem texto: {e}")
+    if not text:
+        raise CoachError("Resposta vazia")
+    return text
+
 def think_as_coach(user_input, user_profile, media_data=None, media_type=None):
     """
-    Processa entrada texto ou multimodal.
+    Processa entrada texto ou multimodal (versão síncrona, para scripts).
     media_data: Bytes (imagem ou audio) ou PIL Image
     media_type: Mime type str (ex: 'image/jpeg', 'audio/mp3')
+    Levanta CoachError em caso de falha.
     """
+    if not user_profile:
+        user_profile = {"name": "Visitante", "niche": "Geral"}
+    model = get_coach_model(user_profile, _topic_message(user_input, media_type))
+    user_id = user_profile.get('telegram_id')
     try:
-        if not user_profile:
-            user_profile = {"name": "Visitante", "niche": "Geral"}
-            
-        system_instruction = get_persona_instruction(user_profile)
-        
-        model = genai.GenerativeModel(
-            model_name="models/gemini-2.5-flash-preview-09-2025",
-            system_instruction=system_instruction
+        response = model.generate_content(
+            _chat_contents(user_id, _build_content_parts(user_input, media_data, media_type)),
+            request_options={"timeout": COACH_TIMEOUT}
         )
-        
-        content_parts = []
-        if user_input:
-            content_parts.append(user_input)
-            
-        if media_data:
-            if isinstance(media_data, Image.Image):
-                content_parts.append(media_data)
-            else:
-                # Assuming raw bytes for manual blob construction if needed, 
-                # but Gemini Python SDK usually takes a dict or special object for Blob.
-                # Simplificando: Assumimos que media_data virá como PIL Image para fotos
-                # Para Audio, talvez precisemos de ajuste. 
-                # Vamos focar na conversão prévia no main.py ou usar a API de File se for grande.
-                # Para MVP rápido de Voz: Mandar o blob.
-                content_parts.append({
-                    "mime_type": media_type or "audio/mp3",
-                    "data": media_data
-                })
-
-        response = model.generate_content(content_parts)
-        return response.text
     except Exception as e:
-        return f"Erro de processamento no neural core: {e}"
+        raise CoachError(f"Erro de processamento no neural core: {e}") from e
+    text = _response_text(response)
+    chat_sessions.record(user_id, user_input, text, media_type)
+    return text
 
-import json
+async def think_as_coach_async(user_input, user_profile, media_data=None, media_type=None, timeout=None):
+    """
+    Versão assíncrona de think_as_coach: não bloqueia o event loop,
+    respeita o prazo (COACH_TIMEOUT) e pode ser cancelada por cancel_user_requests.
+    Levanta CoachError / CoachTimeout / CoachCancelled.
+    """
+    if not user_profile:
+        user_profile = {"name": "Visitante", "niche": "Geral"}
+    model = get_coach_model(user_profile, _topic_message(user_input, media_type))
+    user_id = user_profile.get('telegram_id')
+    contents = _chat_contents(user_id, _build_content_parts(user_input, media_data, media_type))
+    try:
+        response = await run_for_user(
+            user_id,
+            model.generate_content_async(contents),
+            timeout or COACH_TIMEOUT
+        )
+    except CoachError:
+        raise
+    except Exception as e:
+        raise CoachError(f"Erro de processamento no neural core: {e}") from e
+    text = _response_text(response)
+    chat_sessions.record(user_id, user_input, text, media_type)
+    return text
 
-def get_gemini_response(user_input):
-    return think_as_coach(user_input, None)
+async def stream_coach_reply(user_input, user_profile, media_data=None, media_type=None):
+    """
+    Versão em streaming: gera os pedaços de texto conforme o modelo responde.
+    Use dentro de run_for_user para ter prazo e cancelamento. Levanta CoachError.
+    """
+    if not user_profile:
+        user_profile = {"name": "Visitante", "niche": "Geral"}
+    model = get_coach_model(user_profile, _topic_message(user_input, media_type))
+    user_id = user_profile.get('telegram_id')
+    contents = _chat_contents(user_id, _build_content_parts(user_input, media_data, media_type))
+    received = []
+    try:
+        response = await model.generate_content_async(contents, stream=True)
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except Exception:
+                continue # Chunk sem texto (ex: só metadados de término)
+            if text:
+                received.append(text)
+                yield text
+    except CoachError:
+        raise
+    except Exception as e:
+        raise CoachError(f"Erro de processamento no neural core: {e}") from e
+    if not received:
+        raise CoachError("Resposta vazia")
+    chat_sessions.record(user_id, user_input, "".join(received), media_type)
 
-def generate_full_plan(profile):
+UPLOAD_READY_TIMEOUT = 30  # s esperando o arquivo enviado ficar ACTIVE
+
+def upload_media(stream, mime_type):
     """
-    Gera um plano completo (Dieta, Treino, Agenda) em JSON.
+    Envia mídia grande pela File API (upload e depois referência no prompt),
+    em vez de inline. stream: arquivo/BytesIO. Bloqueante: rode fora do event loop.
     """
-    prompt = f"""
+    backend = llm.get_backend()
+    uploaded = backend.upload_file(stream, mime_type)
+    deadline = time.monotonic() + UPLOAD_READY_TIMEOUT
+    while uploaded.state.name == "PROCESSING":
+        if time.monotonic() > deadline:
+            raise CoachError("Arquivo enviado não ficou pronto a tempo")
+        time.sleep(0.5)
+        uploaded = backend.get_file(uploaded.name)
+    if uploaded.state.name != "ACTIVE":
+        raise CoachError(f"Falha no upload da mídia: {uploaded.state.name}")
+    return uploaded
+
+def delete_media(uploaded):
+    try:
+        llm.get_backend().delete_file(uploaded.name)
+    except Exception as e:
+        print(f"Erro ao remover mídia enviada: {e}")
+
+def get_gemini_response(user_input):
+    return think_as_coach(user_input, None)
+
+def _build_plan_prompt(profile):
+    return f"""
     Crie um plano de transformação completo para este perfil, no formato JSON estrito.
     
     PERFIL:
@@ -209,11 +376,92 @@ def generate_full_plan(profile):
     Responda APENAS o JSON, sem markdown (```json).
     """
 
+# Geração por seção: cada parte do plano é uma chamada independente
+# (paralelizáveis, com retry próprio), no mesmo formato do plano completo.
+PLAN_SECTIONS = {
+    "diet": ("lista", """
+        "diet": [
+            {"meal": "Café da Manhã", "time": "08:00", "foods": ["...", "..."], "calories": 500},
+            ...
+        ]"""),
+    "workout": ("objeto", """
+        "workout": {
+            "split": "ABC ou Fullbody...",
+            "days": [
+                {"day": "Segunda", "focus": "Peito e Tríceps", "exercises": ["...", "..."]}
+            ]
+        }"""),
+    "schedule": ("lista", """
+        "schedule": [
+            {"label": "Café da Manhã", "time": "08:00", "message": "Hora de comer! Foco na proteína."},
+            {"label": "Água 1", "time": "10:00", "message": "Hidratação! 500ml pra dentro."},
+            {"label": "Treino", "time": "18:00", "message": "Bora esmagar! Dia de..."}
+        ]"""),
+}
+_SECTION_TYPES = {"lista": list, "objeto": dict}
+
+def _build_section_prompt(profile, section):
+    kind, schema = PLAN_SECTIONS[section]
+    return f"""
+    Crie a parte "{section}" de um plano de transformação para este perfil, no formato JSON estrito.
+    
+    PERFIL:
+    - Nome: {profile.get('name')}
+    - Altura: {profile.get('height')}
+    - Peso: {profile.get('weight_current')} (Meta: {profile.get('weight_target')})
+    - Nível: {profile.get('activity_level')}
+    - Nicho: {profile.get('niche')}
+    - Preferências: {profile.get('preferences')}
+
+    O JSON deve ter exatamente esta chave ({kind}):
+    {{{schema}
+    }}
+    
+    Responda APENAS o JSON, sem markdown (```json).
+    """
+
+def _get_plan_model():
+    global _plan_model
+    backend = llm.get_backend()
+    if _plan_model is None or _plan_model[0] is not backend:
+        _plan_model = (backend, backend.create_model())
+    return _plan_model[1]
+
+def _parse_plan(text):
+    text = text.replace("```json", "").replace("```", "").strip()
+    return json.loads(text)
+
+def generate_full_plan(profile):
+    """
+    Gera um plano completo (Dieta, Treino, Agenda) em JSON.
+    """
     try:
-        model = genai.GenerativeModel("models/gemini-2.5-flash-preview-09-2025")
-        response = model.generate_content(prompt)
-        text = response.text.replace("```json", "").replace("```", "").strip()
-        return json.loads(text)
+        response = _get_plan_model().generate_content(
+            _build_plan_prompt(profile),
+            request_options={"timeout": PLAN_TIMEOUT}
+        )
+        return _parse_plan(response.text)
     except Exception as e:
         print(f"Erro ao gerar plano: {e}")
         return None
+
+async def generate_plan_section_async(profile, section, user_id=None, timeout=None):
+    """
+    Gera uma seção do plano ('diet', 'workout' ou 'schedule').
+    Levanta CoachError (ou CoachTimeout/CoachCancelled) em falha.
+    """
+    try:
+        response = await run_for_user(
+            user_id,
+            _get_plan_model().generate_content_async(_build_section_prompt(profile, section)),
+            timeout or PLAN_TIMEOUT
+        )
+        value = _parse_plan(_response_text(response)).get(section)
+    except CoachError:
+        raise
+    except Exception as e:
+        raise CoachError(f"Seção '{section}' inválida: {e}") from e
+    expected = _SECTION_TYPES[PLAN_SECTIONS[section][0]]
+    if not isinstance(value, expected) or not value:
+        raise CoachError(f"Seção '{section}' vazia ou em formato inesperado")
+    return value
@@ -0,0 +1,198 @@
+import json
+import re
+
+# Motor dos tokens de comando que o LLM emite na resposta (ex: [[LOG_WATER: 300]]).
+# - Uma única passada de tokenização sobre a resposta.
+# - Vários comandos de cada tipo por resposta.
+# - Plano e agenda editados uma vez e gravados numa única transação no fim,
+#   junto com água e peso. Edições de plano/agenda rodam dentro da transação,
+#   sobre a versão travada no banco (o perfil em mãos pode ter 1-2 minutos e
+#   seções do plano podem ter sido gravadas em segundo plano depois dele).
+# Novos comandos: registre uma função com @command("NOME").
+
+TOKEN_RE = re.compile(r'\[\[([A-Z_]+):\s*(.*?)\]\]', re.DOTALL)
+
+_COMMANDS = {}
+_EDITS_PLAN = set()  # comandos que leem/alteram plano ou agenda
+
+def command(name, edits_plan=False):
+    """Registra o handler de um token. Assinatura: handler(ctx, payload) -> confirmação."""
+    def register(func):
+        _COMMANDS[name] = func
+        if edits_plan:
+            _EDITS_PLAN.add(name)
+        return func
+    return register
+
+def _load_json(value, default):
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return default
+    return value if value is not None else default
+
+def _fuzzy_match(a, b):
+    a, b = (a or '').lower(), (b or '').lower()
+    return bool(a and b) and (a in b or b in a)
+
+
+class CommandContext:
+    """Estado mutável de uma resposta: plano/agenda carregados uma vez e as mudanças pendentes."""
+
+    def __init__(self, user_id, profile):
+        self.user_id = user_id
+        self._profile = profile or {}
+        self._plan = None
+        self._reminders = None
+        self.plan_changed = False
+        self.reminders_changed = False
+        self.water = []
+        self.weight = None
+
+    @property
+    def plan(self):
+        if self._plan is None:
+            self._plan = _load_json(self._profile.get('generated_plan'), {}) or {}
+        return self._plan
+
+    @property
+    def reminders(self):
+        if self._reminders is None:
+            self._reminders = _load_json(self._profile.get('reminders'), []) or []
+        return self._reminders
+
+    @property
+    def has_changes(self):
+        return self.plan_changed or self.reminders_changed or bool(self.water) or self.weight is not None
+
+    def changes(self):
+        return {
+            "plan": self.plan if self.plan_changed else None,
+            "reminders": self.reminders if self.reminders_changed else None,
+            "weight": self.weight,
+            "water": list(self.water),
+        }
+
+
+@command("UPDATE_SCHEDULE", edits_plan=True)
+def _update_schedule(ctx, payload):
+    cmd_data = json.loads(payload)
+    label = cmd_data.get('label')
+    new_time = cmd_data.get('time')
+    for r in ctx.reminders:
+        # Fuzzy match simples: se o label contiver a palavra
+        if _fuzzy_match(label, r.get('label')):
+            r['time'] = new_time
+            ctx.reminders_changed = True
+            return f"\n✅ **Agenda Atualizada:** {r.get('label')} ➡️ {new_time}"
+    return ""
+
+@command("UPDATE_DIET", edits_plan=True)
+def _update_diet(ctx, payload):
+    cmd_data = json.loads(payload)
+    target_meal = cmd_data.get('meal') # Ex: "Café da Manhã"
+    new_foods = cmd_data.get('foods')  # List of strings
+    for meal in ctx.plan.get('diet', []):
+        if _fuzzy_match(target_meal, meal.get('meal')):
+            meal['foods'] = new_foods
+            ctx.plan_changed = True
+            return f"\n🥗 **Dieta Atualizada:** {meal.get('meal')} ➡️ {', '.join(new_foods)}"
+    return ""
+
+@command("UPDATE_WORKOUT", edits_plan=True)
+def _update_workout(ctx, payload):
+    cmd_data = json.loads(payload)
+    target_day = cmd_data.get('day') # Ex: "Segunda"
+    new_exercises = cmd_data.get('exercises')  # List of strings
+    for day in ctx.plan.get('workout', {}).get('days', []):
+        if _fuzzy_match(target_day, day.get('day')):
+            day['exercises'] = new_exercises
+            ctx.plan_changed = True
+            return f"\n🏋️ *Treino Atualizado:* {day.get('day')} ➡️ {', '.join(new_exercises)}"
+    return ""
+
+@command("LOG_WATER")
+def _log_water(ctx, payload):
+    amount = int(float(payload.strip()))
+    if amount <= 0:
+        return ""
+    ctx.water.append(amount)
+    index = len(ctx.water) - 1
+    # O total só é conhecido depois de gravar (lido na mesma transação); cada
+    # confirmação mostra o acumulado até ela, não o total final do dia
+    def confirm(result):
+        running = (result.get('water_total') or 0) - sum(ctx.water[index + 1:])
+        return f"\n💧 *Hidratação:* +{amount}ml (Total: {int(running)}ml)"
+    return confirm
+
+@command("UPDATE_WEIGHT")
+def _update_weight(ctx, payload):
+    new_weight = float(payload.strip())
+    ctx.weight = new_weight
+    return f"\n⚖️ *Peso Atualizado:* {new_weight}kg"
+
+
+def parse_commands(text):
+    """Tokeniza a resposta uma vez: lista de (início, fim, nome, payload) só de comandos registrados."""
+    return [
+        (m.start(), m.end(), m.group(1), m.group(2))
+        for m in TOKEN_RE.finditer(text)
+        if m.group(1) in _COMMANDS
+    ]
+
+def _apply_tokens(ctx, tokens):
+    confirmations = []
+    for _, _, name, payload in tokens:
+        try:
+            confirmations.append(_COMMANDS[name](ctx, payload))
+        except Exception as e:
+            print(f"Error parsing {name}: {e}")
+            confirmations.append("")
+    return confirmations
+
+def plan_commands(text, user_id, profile):
+    """Aplica os comandos em memória. Retorna (contexto, tokens, confirmações)."""
+    ctx = CommandContext(user_id, profile)
+    tokens = parse_commands(text)
+    return ctx, tokens, _apply_tokens(ctx, tokens)
+
+def render(text, tokens, confirmations, result):
+    """Substitui cada token pela confirmação (ou remove, se a gravação falhou)."""
+    out = []
+    last = 0
+    for (start, end, _, _), confirmation in zip(tokens, confirmations):
+        out.append(text[last:start])
+        if result is not None and confirmation:
+            out.append(confirmation(result) if callable(confirmation) else confirmation)
+        last = end
+    out.append(text[last:])
+    return "".join(out)
+
+async def run_commands(text, user_id, profile, apply):
+    """
+    Processa todos os tokens da resposta e grava as mudanças de uma vez.
+    apply: coroutine(user_id, **changes) -> dict de resultado (ou None em falha),
+    normalmente repository.apply_user_changes. Com comandos de plano/agenda,
+    recebe edit=função(plano, agenda) -> mudanças, chamada dentro da transação.
+    Retorna o texto com os tokens trocados pelas confirmações.
+    """
+    tokens = parse_commands(text)
+    if not tokens:
+        return text
+    if not any(name in _EDITS_PLAN for _, _, name, _ in tokens):
+        # Só água/peso: não depende do plano, dispensa a trava
+        ctx = CommandContext(user_id, profile)
+        confirmations = _apply_tokens(ctx, tokens)
+        result = await apply(user_id, **ctx.changes()) if ctx.has_changes else {}
+        return render(text, tokens, confirmations, result)
+
+    edited = {"confirmations": [""] * len(tokens)}
+
+    def edit(plan, reminders):
+        ctx = CommandContext(user_id, {"generated_plan": plan, "reminders": reminders})
+        edited["confirmations"] = _apply_tokens(ctx, tokens)
+        return ctx.changes()
+
+    result = await apply(user_id, edit=edit)
+    return render(text, tokens, edited["confirmations"], result)
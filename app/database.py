@@ -1,60 +1,217 @@
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
 import os
+import threading
 from contextlib import contextmanager
 import json
+import copy
+import datetime
+import hashlib
+import uuid
+
+from .pool import ConnectionPool
+from .cache import TTLCache
+from . import migrations, reminder_index
+from .downsample import lttb
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Cache de perfis decodificados (telegram_id -> dict), invalidado por toda escrita em users
+_profile_cache = TTLCache(
+    maxsize=int(os.getenv("PROFILE_CACHE_SIZE", 5000)),
+    ttl=float(os.getenv("PROFILE_CACHE_TTL", 300))
+)
+
+# Respostas de get_user_history (telegram_id -> {variante: resposta}), invalidadas
+# pelas escritas que mudam o gráfico (peso, água, perfil). O TTL limita a
+# defasagem quando a escrita acontece em outro processo.
+_history_cache = TTLCache(
+    maxsize=int(os.getenv("HISTORY_CACHE_SIZE", 2000)),
+    ttl=float(os.getenv("HISTORY_CACHE_TTL", 60))
+)
+HISTORY_LOG_TYPES = ('WATER', 'WEIGHT')
+HISTORY_MAX_POINTS = int(os.getenv("HISTORY_MAX_POINTS", 120))       # pontos por série, no máximo
+HISTORY_CACHE_VARIANTS = int(os.getenv("HISTORY_CACHE_VARIANTS", 8))  # janelas guardadas por usuário
+HISTORY_WATER_BUCKETS = 7  # sem 'from', o gráfico de água mostra os 7 períodos mais recentes
+HISTORY_RESOLUTIONS = {"day": "%d/%m", "week": "%d/%m", "month": "%m/%Y"}
+
+def _get_pool():
+    """Cria o pool sob demanda (configurável via env DB_POOL_*)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    os.getenv("DATABASE_URL"),
+                    min_size=int(os.getenv("DB_POOL_MIN", 1)),
+                    max_size=int(os.getenv("DB_POOL_MAX", 10)),
+                    idle_timeout=float(os.getenv("DB_POOL_IDLE_TIMEOUT", 300)),
+                    health_check_after=float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", 30)),
+                    checkout_timeout=float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT", 10)),
+                )
+    return _pool
 
 @contextmanager
 def get_connection():
-    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+    pool = _get_pool()
+    conn = pool.getconn()
+    broken = False
     try:
         yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
     finally:
-        conn.close()
+        pool.putconn(conn, broken=broken)
 
-def init_db():
-    """Inicializa as tabelas do sistema SaaS."""
+def get_pool_stats():
+    """Estatísticas do pool em tempo real (conexões ociosas, em uso, checkouts...)."""
+    if _pool is None:
+        return {}
+    return _pool.stats()
+
+def get_profile_cache_stats():
+    return _profile_cache.stats()
+
+def invalidate_profile(telegram_id):
+    _profile_cache.invalidate(telegram_id)
+    _history_cache.invalidate(telegram_id)
+
+def get_history_cache_stats():
+    return _history_cache.stats()
+
+# Escritas em users/consolidado avisam os outros processos (pg_notify na mesma
+# transação; só é entregue no commit). O payload "origem:id,id,..." permite
+# ignorar os avisos do próprio processo, que já invalidou tudo localmente.
+CHANGE_CHANNEL = "shapebot_user_changes"
+CHANGE_ORIGIN = uuid.uuid4().hex[:12]
+_NOTIFY_CHUNK = 500  # ids por aviso (payload do NOTIFY é limitado a 8000 bytes)
+
+def _notify_change(cur, user_ids):
+    user_ids = sorted(user_ids)
+    for i in range(0, len(user_ids), _NOTIFY_CHUNK):
+        ids = ",".join(str(u) for u in user_ids[i:i + _NOTIFY_CHUNK])
+        cur.execute("SELECT pg_notify(%s, %s)", (CHANGE_CHANNEL, f"{CHANGE_ORIGIN}:{ids}"))
+
+def apply_remote_changes(user_ids):
+    """
+    Aplica escritas feitas por outro processo: invalida perfil/histórico e relê
+    os lembretes desses usuários para o índice do scheduler.
+    """
+    for user_id in user_ids:
+        _profile_cache.invalidate(user_id)
+        _history_cache.invalidate(user_id)
     try:
         with get_connection() as conn:
             with conn.cursor() as cur:
-                # Tabela de Usuários (Multi-tenant)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        telegram_id BIGINT PRIMARY KEY,
-                        name VARCHAR(255),
-                        height FLOAT,
-                        weight_start FLOAT,
-                        weight_current FLOAT,
-                        weight_target FLOAT,
-                        activity_level VARCHAR(50),
-                        niche VARCHAR(50),
-                        preferences JSONB DEFAULT '{}',
-                        generated_plan JSONB DEFAULT '{}',
-                        reminders JSONB DEFAULT '[]',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
-                
-                # Migração: Garantir colunas novas em tabelas existentes
-                try:
-                    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS generated_plan JSONB DEFAULT '{}';")
-                    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS reminders JSONB DEFAULT '[]';")
-                except Exception as e:
-                    print(f"Aviso migração: {e}")
-                
-                # Logs de Consumo vinculados ao Usuário
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS user_logs (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT REFERENCES users(telegram_id),
-                        log_type VARCHAR(20),
-                        value FLOAT,
-                        meta_data JSONB,
-                        description TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
-                conn.commit()
-                print("DB: Tabelas 'users' e 'user_logs' verificadas/criadas.")
+                cur.execute(
+                    "SELECT telegram_id, reminders FROM users WHERE telegram_id = ANY(%s)",
+                    (list(user_ids),)
+                )
+                rows = dict(cur.fetchall())
+    except Exception as e:
+        # Sem como reler: o próximo rebuild do índice corrige
+        print(f"Erro ao recarregar lembretes alterados por outro processo: {e}")
+        reminder_index.invalidate()
+        return
+    for user_id in user_ids:
+        if user_id in rows:
+            reminder_index.set_user_reminders(user_id, rows[user_id])
+        else:
+            reminder_index.remove_user(user_id)
+
+def invalidate_all():
+    """Descarta os caches por usuário (avisos de outros processos podem ter se perdido)."""
+    _profile_cache.clear()
+    _history_cache.clear()
+    reminder_index.invalidate()
+
+def _profile_version(profile):
+    """Versão do perfil = digest do conteúdo (estável entre processos e reinícios)."""
+    raw = json.dumps(profile, sort_keys=True, default=str).encode()
+    return hashlib.sha1(raw).hexdigest()[:12]
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+# Statements preparados no servidor para as queries quentes.
+# São preparados uma vez por conexão (o pool mantém as conexões vivas).
+PREPARED_STATEMENTS = {
+    "get_user_profile": "SELECT * FROM users WHERE telegram_id = $1",
+    "insert_user_log": """
+        INSERT INTO user_logs (user_id, log_type, value, description, meta_data)
+        VALUES ($1, $2, $3, $4, $5)
+    """,
+    "daily_water_total": """
+        SELECT water_total
+        FROM user_daily_stats
+        WHERE user_id = $1 AND day = CURRENT_DATE
+    """,
+    # $1 user_id, $2 log_type, $3 água (ml) somada, $4 peso (ou NULL),
+    # $5 nº de eventos, $6 dia (NULL = hoje)
+    "bump_daily_stats": """
+        INSERT INTO user_daily_stats (user_id, day, water_total, last_weight, event_counts)
+        VALUES ($1, COALESCE($6::date, CURRENT_DATE), $3, $4, jsonb_build_object($2::text, $5::int))
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            water_total = user_daily_stats.water_total + EXCLUDED.water_total,
+            last_weight = COALESCE(EXCLUDED.last_weight, user_daily_stats.last_weight),
+            event_counts = user_daily_stats.event_counts || jsonb_build_object(
+                $2::text, COALESCE((user_daily_stats.event_counts->>$2::text)::int, 0) + $5::int
+            ),
+            updated_at = CURRENT_TIMESTAMP
+    """,
+}
+
+def _ensure_prepared(cur, name):
+    prepared = cur.connection.prepared
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+        prepared.add(name)
+    return prepared
+
+def execute_prepared(cur, name, params):
+    """
+    Executa um statement preparado, fazendo PREPARE na primeira vez em cada conexão.
+    Se o schema mudou desde o PREPARE (migração feita por outro processo), prepara
+    de novo e repete uma vez, desde que nada desta transação se perca no rollback.
+    """
+    conn = cur.connection
+    fresh = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    placeholders = ", ".join(["%s"] * len(params))
+    for attempt in range(2):
+        prepared = _ensure_prepared(cur, name)
+        try:
+            cur.execute(f"EXECUTE {name} ({placeholders})", params)
+            return
+        except psycopg2.errors.FeatureNotSupported:
+            # "cached plan must not change result type": descarta os planos
+            # desta conexão (todos ficaram velhos com a migração)
+            conn.rollback()
+            cur.execute("DEALLOCATE ALL")
+            prepared.clear()
+            if attempt or not fresh:
+                # Já havia escritas na transação (perdidas no rollback): o chamador decide
+                raise
+
+def _bump_daily_stats(cur, user_id, log_type, value):
+    """Atualiza o consolidado diário (user_daily_stats) na mesma transação do log."""
+    water = value if log_type == 'WATER' and value else 0
+    weight = value if log_type == 'WEIGHT' else None
+    execute_prepared(cur, "bump_daily_stats", (user_id, log_type, water, weight, 1, None))
+
+def init_db():
+    """Aplica as migrações pendentes do schema (nenhum DDL se já estiver atualizado)."""
+    try:
+        with get_connection() as conn:
+            version = migrations.migrate(conn)
+            print(f"DB: schema na versão {version}.")
     except Exception as e:
         print(f"Erro ao inicializar DB: {e}")
 
@@ -73,7 +230,8 @@ def create_or_update_user(telegram_id, data):
                         weight_target = EXCLUDED.weight_target,
                         activity_level = EXCLUDED.activity_level,
                         niche = EXCLUDED.niche,
-                        preferences = COALESCE(users.preferences, '{}') || EXCLUDED.preferences;
+                        preferences = COALESCE(users.preferences, '{}') || EXCLUDED.preferences,
+                        updated_at = CURRENT_TIMESTAMP;
                 """, (
                     telegram_id,
                     data.get('name'),
@@ -85,22 +243,36 @@ def create_or_update_user(telegram_id, data):
                     data.get('niche'),
                     json.dumps(data.get('preferences', {}))
                 ))
+                _notify_change(cur, [telegram_id])
                 conn.commit()
+                _profile_cache.invalidate(telegram_id)
+                _history_cache.invalidate(telegram_id)
                 return True
     except Exception as e:
         print(f"Erro ao salvar usuário {telegram_id}: {e}")
         return False
 
 def get_user_profile(telegram_id):
-    """Busca o perfil completo do usuário."""
+    """
+    Busca o perfil completo do usuário (read-through no cache de perfis).
+    O dict retornado é uma cópia e traz '_version' (muda sempre que o perfil muda).
+    """
+    cached = _profile_cache.get(telegram_id)
+    if cached is not None:
+        return copy.deepcopy(cached)
+
+    generation = _profile_cache.generation()
     try:
         with get_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
+                execute_prepared(cur, "get_user_profile", (telegram_id,))
                 columns = [desc[0] for desc in cur.description]
                 row = cur.fetchone()
                 if row:
-                    return dict(zip(columns, row))
+                    profile = dict(zip(columns, row))
+                    profile['_version'] = _profile_version(profile)
+                    _profile_cache.set(telegram_id, profile, generation=generation)
+                    return copy.deepcopy(profile)
                 return None
     except Exception as e:
         print(f"Erro ao buscar usuário {telegram_id}: {e}")
@@ -110,17 +282,98 @@ def save_log(telegram_id, log_type, value, description="", meta_data=None):
     try:
         with get_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO user_logs (user_id, log_type, value, description, meta_data) 
-                    VALUES (%s, %s, %s, %s, %s)
-                    """,
+                execute_prepared(
+                    cur, "insert_user_log",
                     (telegram_id, log_type, value, description, json.dumps(meta_data) if meta_data else None)
                 )
+                _bump_daily_stats(cur, telegram_id, log_type, value)
+                if log_type in HISTORY_LOG_TYPES:
+                    _notify_change(cur, [telegram_id])
                 conn.commit()
+        if log_type in HISTORY_LOG_TYPES:
+            _history_cache.invalidate(telegram_id)
     except Exception as e:
         print(f"Erro ao salvar log: {e}")
 
+def _rollup(rows, days):
+    """Agrega o consolidado por (usuário, dia, tipo) antes de ir ao banco (days: dia de cada linha)."""
+    rollup = {}
+    for (telegram_id, log_type, value, _, _, _), day in zip(rows, days):
+        key = (telegram_id, day, log_type)
+        water, weight, count = rollup.get(key, (0, None, 0))
+        if log_type == 'WATER' and value:
+            water += value
+        if log_type == 'WEIGHT':
+            weight = value
+        rollup[key] = (water, weight, count + 1)
+    return rollup
+
+def save_logs_batch(rows):
+    """
+    Grava vários eventos numa única transação (INSERT multi-linha + consolidado diário).
+    rows: [(telegram_id, log_type, value, description, meta_data, created_at)]
+    created_at com fuso; o dia do consolidado é calculado pelo banco, no fuso da
+    sessão, como nas gravações diretas (CURRENT_DATE).
+    Eventos de usuários que não existem mais (ex: /reset logo após a mensagem)
+    são descartados, para não derrubar o lote inteiro na FK de user_logs.
+    Retorna True se gravou.
+    """
+    if not rows:
+        return True
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                # FOR KEY SHARE: um DELETE concorrente do usuário espera este lote
+                cur.execute(
+                    "SELECT telegram_id FROM users WHERE telegram_id = ANY(%s) FOR KEY SHARE",
+                    (list({row[0] for row in rows}),)
+                )
+                known = {r[0] for r in cur.fetchall()}
+                kept = [row for row in rows if row[0] in known]
+                if len(kept) < len(rows):
+                    print(f"Lote de logs: {len(rows) - len(kept)} eventos de usuários removidos descartados")
+                days = []
+                if kept:
+                    cur.execute("""
+                        SELECT t::date FROM unnest(%s::timestamptz[]) WITH ORDINALITY AS x(t, i)
+                        ORDER BY i
+                    """, ([row[5] for row in kept],))
+                    days = [r[0] for r in cur.fetchall()]
+                rollup = _rollup(kept, days)
+                if kept:
+                    psycopg2.extras.execute_values(
+                        cur,
+                        """
+                        INSERT INTO user_logs (user_id, log_type, value, description, meta_data, created_at)
+                        VALUES %s
+                        """,
+                        [
+                            (t_id, l_type, val, desc, json.dumps(meta) if meta else None, created_at)
+                            for t_id, l_type, val, desc, meta, created_at in kept
+                        ],
+                        page_size=500
+                    )
+                    _ensure_prepared(cur, "bump_daily_stats")
+                    psycopg2.extras.execute_batch(
+                        cur,
+                        "EXECUTE bump_daily_stats (%s, %s, %s, %s, %s, %s)",
+                        [
+                            (t_id, l_type, water, weight, count, day)
+                            for (t_id, day, l_type), (water, weight, count) in rollup.items()
+                        ],
+                        page_size=500
+                    )
+                changed = {key[0] for key in rollup if key[2] in HISTORY_LOG_TYPES}
+                _notify_change(cur, changed)
+                conn.commit()
+        for t_id in changed:
+            _history_cache.invalidate(t_id)
+        return True
+    except Exception as e:
+        print(f"Erro ao salvar lote de logs ({len(rows)} eventos): {e}")
+        return False
+
 def update_user_plan(user_id, plan_data):
     try:
         with get_connection() as conn:
@@ -129,12 +382,102 @@ def update_user_plan(user_id, plan_data):
                     "UPDATE users SET generated_plan = %s WHERE telegram_id = %s",
                     (json.dumps(plan_data), user_id)
                 )
+                _notify_change(cur, [user_id])
                 conn.commit()
+        _profile_cache.invalidate(user_id)
         return True
     except Exception as e:
         print(f"Erro ao atualizar plano: {e}")
         return False
 
+def update_plan_section(user_id, section, value):
+    """
+    Grava uma única seção do plano ('diet', 'workout', 'schedule') sem tocar nas
+    outras (jsonb_set), para a geração em paralelo não sobrescrever seções já prontas.
+    A seção 'schedule' também vira a agenda de lembretes.
+    """
+    try:
+        payload = json.dumps(value)
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE users SET
+                        generated_plan = jsonb_set(COALESCE(generated_plan, '{}'::jsonb), %s, %s::jsonb, true),
+                        reminders = CASE WHEN %s THEN %s::jsonb ELSE reminders END
+                    WHERE telegram_id = %s
+                """, ([section], payload, section == 'schedule', payload, user_id))
+                _notify_change(cur, [user_id])
+                conn.commit()
+        _profile_cache.invalidate(user_id)
+        if section == 'schedule':
+            reminder_index.set_user_reminders(user_id, value)
+        return True
+    except Exception as e:
+        print(f"Erro ao salvar seção '{section}' do plano: {e}")
+        return False
+
+def apply_user_changes(user_id, plan=None, reminders=None, weight=None, water=(), edit=None):
+    """
+    Grava numa única transação as mudanças vindas dos comandos do coach:
+    plano e agenda (um UPDATE), peso (users + log) e registros de água.
+    edit(plano, agenda) -> {"plan", "reminders", "weight", "water"}: edição feita
+    sobre o plano/agenda lidos com a linha do usuário travada (FOR UPDATE), para
+    não sobrescrever seções gravadas depois do perfil que o chamador tem em mãos.
+    Retorna {"water_total": ml_hoje} (lido na mesma transação) ou None em falha.
+    """
+    try:
+        result = {}
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                if edit is not None:
+                    cur.execute(
+                        "SELECT generated_plan, reminders FROM users WHERE telegram_id = %s FOR UPDATE",
+                        (user_id,)
+                    )
+                    row = cur.fetchone()
+                    if row is None:
+                        return None
+                    changes = edit(row[0], row[1])
+                    plan, reminders = changes["plan"], changes["reminders"]
+                    weight, water = changes["weight"], changes["water"]
+                if plan is not None or reminders is not None:
+                    cur.execute("""
+                        UPDATE users SET
+                            generated_plan = COALESCE(%s::jsonb, generated_plan),
+                            reminders = COALESCE(%s::jsonb, reminders)
+                        WHERE telegram_id = %s
+                    """, (
+                        json.dumps(plan) if plan is not None else None,
+                        json.dumps(reminders) if reminders is not None else None,
+                        user_id
+                    ))
+                if weight is not None:
+                    cur.execute(
+                        "UPDATE users SET weight_current = %s, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = %s",
+                        (weight, user_id)
+                    )
+                    execute_prepared(cur, "insert_user_log", (user_id, 'WEIGHT', weight, 'Atualização Manual', None))
+                    _bump_daily_stats(cur, user_id, 'WEIGHT', weight)
+                for amount in water:
+                    execute_prepared(cur, "insert_user_log", (user_id, 'WATER', amount, 'NLP', None))
+                    _bump_daily_stats(cur, user_id, 'WATER', amount)
+                if water:
+                    execute_prepared(cur, "daily_water_total", (user_id,))
+                    row = cur.fetchone()
+                    result["water_total"] = row[0] if row and row[0] else 0.0
+                _notify_change(cur, [user_id])
+                conn.commit()
+        if plan is not None or reminders is not None or weight is not None:
+            _profile_cache.invalidate(user_id)
+        if weight is not None or water:
+            _history_cache.invalidate(user_id)
+        if reminders is not None:
+            reminder_index.set_user_reminders(user_id, reminders)
+        return result
+    except Exception as e:
+        print(f"Erro ao aplicar mudanças do usuário {user_id}: {e}")
+        return None
+
 def get_user_plan(user_id):
     profile = get_user_profile(user_id)
     return profile.get('generated_plan') if profile else {}
@@ -147,7 +490,10 @@ def update_reminders(user_id, reminders_list):
                     "UPDATE users SET reminders = %s WHERE telegram_id = %s",
                     (json.dumps(reminders_list), user_id)
                 )
+                _notify_change(cur, [user_id])
                 conn.commit()
+        _profile_cache.invalidate(user_id)
+        reminder_index.set_user_reminders(user_id, reminders_list)
         return True
     except Exception as e:
         print(f"Erro ao atualizar lembretes: {e}")
@@ -162,8 +508,13 @@ def delete_user_data(user_id):
         with get_connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("DELETE FROM user_logs WHERE user_id = %s", (user_id,))
+                cur.execute("DELETE FROM user_daily_stats WHERE user_id = %s", (user_id,))
                 cur.execute("DELETE FROM users WHERE telegram_id = %s", (user_id,))
+                _notify_change(cur, [user_id])
                 conn.commit()
+        _profile_cache.invalidate(user_id)
+        _history_cache.invalidate(user_id)
+        reminder_index.remove_user(user_id)
         return True
     except Exception as e:
         print(f"Erro ao deletar usuário: {e}")
@@ -182,112 +533,471 @@ def get_all_users():
         print(f"Erro ao buscar todos usuários: {e}")
         return []
 
+def get_all_user_reminders():
+    """Retorna [{telegram_id, reminders}] de quem tem lembretes (para o índice do scheduler).
+    Retorna None em caso de erro, para não confundir falha com 'nenhum lembrete'."""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT telegram_id, reminders FROM users
+                    WHERE reminders IS NOT NULL AND reminders <> '[]'::jsonb
+                """)
+                return [{"telegram_id": r[0], "reminders": r[1]} for r in cur.fetchall()]
+    except Exception as e:
+        print(f"Erro ao buscar lembretes: {e}")
+        return None
+
 def get_daily_water_total(user_id):
     """Retorna o total de água (ml) consumido hoje pelo usuário."""
     try:
         with get_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT SUM(value) 
-                    FROM user_logs 
-                    WHERE user_id = %s 
-                      AND log_type = 'WATER' 
-                      AND created_at::date = CURRENT_DATE
-                """, (user_id,))
-                result = cur.fetchone()[0]
-                return result if result else 0.0
+                execute_prepared(cur, "daily_water_total", (user_id,))
+                result = cur.fetchone()
+                return result[0] if result and result[0] else 0.0
     except Exception as e:
         print(f"Erro ao calcular hidratação: {e}")
         return 0.0
 
+# Cada usuário tem uma chave fixa de 0 a HYDRATION_SLOTS-1, ((telegram_id * 7919) % 1440),
+# indexada (migração 7), que o scheduler converte no minuto dele dentro da janela
+HYDRATION_SLOTS = 1440
+
+def get_user_timezones():
+    """Fusos salvos pelos usuários (distintos). None em falha."""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT DISTINCT timezone FROM users WHERE timezone IS NOT NULL")
+                return [r[0] for r in cur.fetchall()]
+    except Exception as e:
+        print(f"Erro ao buscar fusos dos usuários: {e}")
+        return None
+
+def get_hydration_laggards(slots, ratio=0.5, ml_per_kg=35, partitions=None, partition_count=None,
+                           default_tz="America/Sao_Paulo"):
+    """
+    Usuários cuja checagem de hidratação vence agora e que beberam menos que
+    `ratio` da meta diária de água (peso * ml_per_kg).
+    slots: [(fuso, data_local, meia_noite_local, chave_min, chave_max)], um por fuso
+    com checagens vencendo agora (calculado pelo scheduler); usuários sem fuso
+    usam default_tz. Só os usuários com chave no intervalo são lidos (índice).
+    A água conta os registros desde a meia-noite local (o consolidado diário
+    segue a data do servidor, que pode ser outra).
+    partitions/partition_count: só usuários dessas partições (telegram_id % partition_count).
+    Retorna [{telegram_id, name, target, current, day}] (day = data local do usuário).
+    """
+    if not slots:
+        return []
+    tzs, days, since, key_lo, key_hi = (list(column) for column in zip(*slots))
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT u.telegram_id, u.name, u.weight_current * %(ml)s AS target,
+                           COALESCE(w.total, 0), due.day
+                    FROM unnest(%(tzs)s::text[], %(days)s::date[], %(since)s::timestamptz[],
+                                %(key_lo)s::int[], %(key_hi)s::int[])
+                         AS due(tz, day, since, key_lo, key_hi)
+                    JOIN users u
+                      ON ((u.telegram_id * 7919) %% 1440) BETWEEN due.key_lo AND due.key_hi
+                     AND COALESCE(u.timezone, %(tz)s) = due.tz
+                    LEFT JOIN LATERAL (
+                        SELECT SUM(l.value) AS total
+                        FROM user_logs l
+                        WHERE l.user_id = u.telegram_id AND l.log_type = 'WATER'
+                          AND l.created_at >= due.since::timestamp
+                    ) w ON true
+                    WHERE u.weight_current > 0
+                      AND (%(parts)s::int[] IS NULL OR (u.telegram_id %% %(count)s)::int = ANY(%(parts)s::int[]))
+                      AND COALESCE(w.total, 0) < u.weight_current * %(ml)s * %(ratio)s
+                """, {
+                    "ml": ml_per_kg, "ratio": ratio, "tz": default_tz,
+                    "tzs": tzs, "days": days, "since": since, "key_lo": key_lo, "key_hi": key_hi,
+                    "parts": list(partitions) if partitions is not None else None,
+                    "count": partition_count or 1,
+                })
+                return [
+                    {"telegram_id": r[0], "name": r[1], "target": r[2], "current": r[3], "day": r[4]}
+                    for r in cur.fetchall()
+                ]
+    except Exception as e:
+        print(f"Erro ao buscar usuários abaixo da meta de água: {e}")
+        return []
+
+def update_user_timezone(user_id, timezone):
+    """Grava o fuso horário (nome IANA, ex: 'America/Manaus') do usuário."""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE users SET timezone = %s WHERE telegram_id = %s", (timezone, user_id))
+                updated = cur.rowcount
+                _notify_change(cur, [user_id])
+                conn.commit()
+        _profile_cache.invalidate(user_id)
+        return updated > 0
+    except Exception as e:
+        print(f"Erro ao atualizar fuso do usuário {user_id}: {e}")
+        return False
+
+def heartbeat_leases(worker_id, partitions, ttl):
+    """
+    Heartbeat do worker + renovação/rebalanceamento das partições do scheduler,
+    numa transação. Cada worker vivo fica com ~partitions/N partições: devolve o
+    excedente e pega partições livres ou com lease vencido (worker morto).
+    Retorna a lista de partições deste worker, ou None em falha.
+    """
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO scheduler_leases (partition)
+                    SELECT generate_series(0, %s - 1)
+                    ON CONFLICT DO NOTHING
+                """, (partitions,))
+                cur.execute("""
+                    INSERT INTO scheduler_workers (worker_id, heartbeat_at) VALUES (%s, NOW())
+                    ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = NOW()
+                """, (worker_id,))
+                cur.execute(
+                    "SELECT COUNT(*) FROM scheduler_workers WHERE heartbeat_at > NOW() - %s * INTERVAL '1 second'",
+                    (ttl,)
+                )
+                live = max(1, cur.fetchone()[0])
+                target = -(-partitions // live)  # teto
+
+                cur.execute("""
+                    UPDATE scheduler_leases SET expires_at = NOW() + %s * INTERVAL '1 second'
+                    WHERE worker_id = %s AND partition < %s
+                    RETURNING partition
+                """, (ttl, worker_id, partitions))
+                owned = sorted(r[0] for r in cur.fetchall())
+
+                if len(owned) > target:
+                    surplus = owned[target:]
+                    cur.execute("""
+                        UPDATE scheduler_leases SET worker_id = NULL, expires_at = 'epoch'
+                        WHERE worker_id = %s AND partition = ANY(%s)
+                    """, (worker_id, surplus))
+                    owned = owned[:target]
+                elif len(owned) < target:
+                    cur.execute("""
+                        UPDATE scheduler_leases SET worker_id = %s, expires_at = NOW() + %s * INTERVAL '1 second'
+                        WHERE partition IN (
+                            SELECT partition FROM scheduler_leases
+                            WHERE partition < %s AND (worker_id IS NULL OR expires_at < NOW())
+                            ORDER BY partition
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING partition
+                    """, (worker_id, ttl, partitions, target - len(owned)))
+                    owned = sorted(owned + [r[0] for r in cur.fetchall()])
+
+                # Workers sem heartbeat há muito tempo saem da contagem de vez
+                cur.execute(
+                    "DELETE FROM scheduler_workers WHERE heartbeat_at < NOW() - %s * INTERVAL '1 second'",
+                    (ttl * 10,)
+                )
+                conn.commit()
+                return owned
+    except Exception as e:
+        print(f"Erro no heartbeat do scheduler ({worker_id}): {e}")
+        return None
+
+def release_leases(worker_id):
+    """Devolve as partições do worker (shutdown limpo: outro worker assume na hora)."""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE scheduler_leases SET worker_id = NULL, expires_at = 'epoch' WHERE worker_id = %s",
+                    (worker_id,)
+                )
+                cur.execute("DELETE FROM scheduler_workers WHERE worker_id = %s", (worker_id,))
+                conn.commit()
+                return True
+    except Exception as e:
+        print(f"Erro ao liberar leases de {worker_id}: {e}")
+        return False
+
+def get_scan_marks(partitions):
+    """
+    Último minuto de lembretes já varrido em cada partição ({partição: timestamp};
+    partições nunca varridas ficam de fora). None em falha.
+    """
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT partition, scanned_until FROM scheduler_leases "
+                    "WHERE partition = ANY(%s) AND scanned_until IS NOT NULL",
+                    (list(partitions),)
+                )
+                marks = dict(cur.fetchall())
+                conn.commit()
+                return marks
+    except Exception as e:
+        print(f"Erro ao ler progresso do scheduler: {e}")
+        return None
+
+def set_scan_marks(worker_id, partitions, minute):
+    """Registra até que minuto as partições foram varridas (só as que ainda são deste worker)."""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE scheduler_leases SET scanned_until = %s
+                    WHERE worker_id = %s AND partition = ANY(%s)
+                """, (minute, worker_id, list(partitions)))
+                conn.commit()
+                return True
+    except Exception as e:
+        print(f"Erro ao gravar progresso do scheduler ({worker_id}): {e}")
+        return False
+
+def claim_deliveries(rows):
+    """
+    Registra no ledger as entregas (user_id, slot, kind) antes do envio.
+    Retorna o set das que foram registradas agora; as que já existiam (outro
+    worker ou reinício no mesmo minuto) não devem ser enviadas de novo.
+    None em falha.
+    """
+    if not rows:
+        return set()
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                inserted = psycopg2.extras.execute_values(cur, """
+                    INSERT INTO delivery_ledger (user_id, slot, kind) VALUES %s
+                    ON CONFLICT DO NOTHING
+                    RETURNING user_id, slot, kind
+                """, rows, page_size=1000, fetch=True)
+                conn.commit()
+                return {tuple(r) for r in inserted}
+    except Exception as e:
+        print(f"Erro ao registrar entregas: {e}")
+        return None
+
+def prune_deliveries(keep_days=2):
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM delivery_ledger WHERE slot < NOW() - %s * INTERVAL '1 day'",
+                    (keep_days,)
+                )
+                deleted = cur.rowcount
+                conn.commit()
+                return deleted
+    except Exception as e:
+        print(f"Erro ao limpar ledger de entregas: {e}")
+        return 0
+
 def update_user_weight(user_id, new_weight):
     """Atualiza o peso atual e salva log."""
     try:
         with get_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("UPDATE users SET weight_current = %s WHERE telegram_id = %s", (new_weight, user_id))
+                cur.execute(
+                    "UPDATE users SET weight_current = %s, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = %s",
+                    (new_weight, user_id)
+                )
                 # Log do peso para gráfico
                 cur.execute("""
                     INSERT INTO user_logs (user_id, log_type, value, description)
                     VALUES (%s, 'WEIGHT', %s, 'Atualização Manual')
                 """, (user_id, new_weight))
+                _bump_daily_stats(cur, user_id, 'WEIGHT', new_weight)
+                _notify_change(cur, [user_id])
                 conn.commit()
+        _profile_cache.invalidate(user_id)
+        _history_cache.invalidate(user_id)
         return True
     except Exception as e:
         print(f"Erro ao atualizar peso: {e}")
         return False
 
-def get_user_history(user_id):
+def get_user_history(user_id, date_from=None, date_to=None, resolution="day", max_points=None):
     """
-    Retorna histórico para gráficos (Peso e Água).
+    Retorna histórico para gráficos (Peso e Água), com read-through no cache de respostas.
+    Janela [date_from, date_to] (padrão: todo o histórico até hoje), agregada no banco
+    por dia/semana/mês e reduzida por LTTB a max_points (teto HISTORY_MAX_POINTS).
+    Peso = último peso do período; Água = média diária dos dias com registro.
+    Sem date_from, a água mostra os HISTORY_WATER_BUCKETS períodos mais recentes.
     Formato: {
-        "dates": [...],
-        "weight": [...],
-        "water": [...]
+        "weight_labels": [...], "weight_values": [...],
+        "water_labels": [...], "water_values": [...],
+        "stats": {...},
+        "_version": digest do conteúdo (ETag),
+        "_last_modified": última mudança do conteúdo (datetime com fuso) ou None
     }
     """
+    label_format = HISTORY_RESOLUTIONS[resolution]
+    budget = min(max_points or HISTORY_MAX_POINTS, HISTORY_MAX_POINTS)
+    # A "água de hoje" muda à meia-noite sem nenhuma escrita: a data entra na chave
+    today = datetime.date.today()
+    variant = (today, date_from, date_to, resolution, budget)
+    variants = _history_cache.get(user_id) or {}
+    cached = variants.get(variant)
+    if cached is not None:
+        return copy.deepcopy(cached)
+
+    generation = _history_cache.generation()
+    params = {
+        "user_id": user_id,
+        "resolution": resolution,
+        "date_from": date_from,
+        "date_to": date_to or today,
+        "water_limit": None if date_from else HISTORY_WATER_BUCKETS,
+    }
     try:
-        data = {"dates": [], "weight": [], "water": []}
-        
         with get_connection() as conn:
             with conn.cursor() as cur:
-                # 1. Histórico de Peso (Últimos 30 registros)
+                # 1. Histórico de Peso (último peso de cada período, do consolidado)
                 cur.execute("""
-                    SELECT created_at::date, value 
-                    FROM user_logs 
-                    WHERE user_id = %s AND log_type = 'WEIGHT'
-                    ORDER BY created_at ASC
-                """, (user_id,))
+                    SELECT date_trunc(%(resolution)s, day)::date AS bucket,
+                           (ARRAY_AGG(last_weight ORDER BY day DESC))[1]
+                    FROM user_daily_stats
+                    WHERE user_id = %(user_id)s AND last_weight IS NOT NULL
+                      AND (%(date_from)s::date IS NULL OR day >= %(date_from)s::date)
+                      AND day <= %(date_to)s::date
+                    GROUP BY 1
+                    ORDER BY 1 ASC
+                """, params)
                 weight_rows = cur.fetchall()
                 
-                # 2. Histórico de Água (Soma diária, últimos 7 dias)
+                # 2. Histórico de Água (média diária por período; os mais recentes sem 'from')
                 cur.execute("""
-                    SELECT created_at::date, SUM(value)
-                    FROM user_logs
-                    WHERE user_id = %s AND log_type = 'WATER'
-                    GROUP BY created_at::date
-                    ORDER BY created_at::date ASC
-                    LIMIT 7
-                """, (user_id,))
+                    SELECT bucket, water FROM (
+                        SELECT date_trunc(%(resolution)s, day)::date AS bucket, AVG(water_total) AS water
+                        FROM user_daily_stats
+                        WHERE user_id = %(user_id)s AND water_total > 0
+                          AND (%(date_from)s::date IS NULL OR day >= %(date_from)s::date)
+                          AND day <= %(date_to)s::date
+                        GROUP BY 1
+                        ORDER BY 1 DESC
+                        LIMIT %(water_limit)s
+                    ) recent
+                    ORDER BY bucket ASC
+                """, params)
                 water_rows = cur.fetchall()
 
-                # Processar Peso (simples)
-                for date, val in weight_rows:
-                    d_str = date.strftime("%d/%m")
-                    if d_str not in data["dates"]:
-                        data["dates"].append(d_str)
-                    data["weight"].append(val)
-                
-                # Processar Água (mapa de datas)
-                water_map = {row[0].strftime("%d/%m"): row[1] for row in water_rows}
-                
-                # 3. Stats do Cabeçalho (Peso Atual, Meta, Água Hoje)
-                # Reutiliza queries ou chama funções helpers se performance não for crítica
-                # Como já estamos com conexão aberta, melhor query direta
-                cur.execute("SELECT weight_current, weight_target FROM users WHERE telegram_id = %s", (user_id,))
+                # 3. Stats do Cabeçalho (Peso Atual, Meta) + Last-Modified: a última
+                # mudança de qualquer parte da resposta (registros, peso/meta e a
+                # virada do dia, que zera a água de hoje e move a janela padrão)
+                cur.execute("""
+                    SELECT weight_current, weight_target,
+                           GREATEST(
+                               updated_at,
+                               (SELECT MAX(updated_at) FROM user_daily_stats WHERE user_id = %s),
+                               CURRENT_DATE::timestamp
+                           )::timestamptz
+                    FROM users WHERE telegram_id = %s
+                """, (user_id, user_id))
                 user_row = cur.fetchone()
                 current_weight = user_row[0] if user_row else 0
                 target_weight = user_row[1] if user_row else 0
+                last_modified = user_row[2] if user_row else None
                 
-                cur.execute("""
-                    SELECT SUM(value) FROM user_logs 
-                    WHERE user_id = %s AND log_type = 'WATER' AND created_at::date = CURRENT_DATE
-                """, (user_id,))
-                water_res = cur.fetchone()[0]
+                execute_prepared(cur, "daily_water_total", (user_id,))
+                water_res = cur.fetchone()
+                water_res = water_res[0] if water_res else 0
                 water_today = water_res if water_res else 0
 
-                return {
-                    "weight_labels": [r[0].strftime("%d/%m") for r in weight_rows],
-                    "weight_values": [r[1] for r in weight_rows],
-                    "water_labels": [r[0].strftime("%d/%m") for r in water_rows],
-                    "water_values": [r[1] for r in water_rows],
-                    "stats": {
-                        "current_weight": current_weight,
-                        "target_weight": target_weight,
-                        "water_today": water_today
-                    }
-                }
+        # Séries longas: LTTB sobre (dia ordinal, valor), mantendo a data de cada ponto
+        weight_points = lttb([(d.toordinal(), v, d) for d, v in weight_rows], budget)
+        water_points = lttb([(d.toordinal(), v, d) for d, v in water_rows], budget)
+        history = {
+            "weight_labels": [p[2].strftime(label_format) for p in weight_points],
+            "weight_values": [p[1] for p in weight_points],
+            "water_labels": [p[2].strftime(label_format) for p in water_points],
+            "water_values": [p[1] for p in water_points],
+            "stats": {
+                "current_weight": current_weight,
+                "target_weight": target_weight,
+                "water_today": water_today
+            }
+        }
+        history["_version"] = _profile_version(history)
+        history["_last_modified"] = last_modified
+
+        # Guarda poucas janelas por usuário; as de outros dias já não servem
+        variants = {k: v for k, v in variants.items() if k[0] == today}
+        variants[variant] = history
+        while len(variants) > HISTORY_CACHE_VARIANTS:
+            variants.pop(next(iter(variants)))
+        _history_cache.set(user_id, variants, generation=generation)
+        return copy.deepcopy(history)
 
     except Exception as e:
         print(f"Erro ao gerar histórico: {e}")
         return {}
+
+def get_plan_template(bucket):
+    """Plano-modelo da biblioteca para a faixa de perfil: {"plan", "base_weight"} ou None."""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT plan, base_weight FROM plan_templates WHERE bucket = %s", (bucket,))
+                row = cur.fetchone()
+                return {"plan": row[0], "base_weight": row[1]} if row else None
+    except Exception as e:
+        print(f"Erro ao buscar plano-modelo {bucket}: {e}")
+        return None
+
+def save_plan_template(bucket, plan, base_weight, source="lazy"):
+    """Grava o plano-modelo da faixa (o primeiro a gravar vence; modelos não mudam)."""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO plan_templates (bucket, plan, base_weight, source)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (bucket) DO NOTHING
+                """, (bucket, json.dumps(plan), base_weight, source))
+                conn.commit()
+                return True
+    except Exception as e:
+        print(f"Erro ao salvar plano-modelo {bucket}: {e}")
+        return False
+
+def get_plan_profiles():
+    """Dados de perfil usados no agrupamento da biblioteca de planos (pré-cálculo offline)."""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT height, weight_current, weight_target, activity_level, niche, preferences
+                    FROM users
+                """)
+                columns = [desc[0] for desc in cur.description]
+                return [dict(zip(columns, row)) for row in cur.fetchall()]
+    except Exception as e:
+        print(f"Erro ao buscar perfis: {e}")
+        return []
+
+def backfill_daily_stats(user_id=None):
+    """
+    (Re)constrói user_daily_stats a partir de user_logs.
+    Idempotente: sobrescreve os dias recalculados. Retorna o número de linhas gravadas.
+    """
+    user_filter = "AND user_id = %(user_id)s" if user_id is not None else ""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    migrations.BACKFILL_DAILY_STATS_SQL.format(user_filter=user_filter),
+                    {"user_id": user_id}
+                )
+                rows = cur.rowcount
+                conn.commit()
+        if user_id is not None:
+            _history_cache.invalidate(user_id)
+        else:
+            _history_cache.clear()
+        return rows
+    except Exception as e:
+        print(f"Erro no backfill do consolidado diário: {e}")
+        return 0
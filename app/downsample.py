@@ -0,0 +1,36 @@
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets: reduz uma série a no máximo `threshold` pontos
+    preservando a forma do gráfico (picos e vales). Mantém o primeiro e o último.
+    threshold <= 0 desliga a redução.
+    points: [(x, y, ...)] ordenados por x; campos extras (ex: rótulo) são preservados.
+    """
+    n = len(points)
+    if threshold <= 0 or threshold >= n or n <= 2:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    # Os pontos internos são divididos em (threshold - 2) faixas; de cada faixa fica
+    # o ponto que forma o maior triângulo com o último escolhido e a média da próxima.
+    every = (n - 2) / (threshold - 2)
+    sampled = [points[0]]
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        span = avg_end - avg_start
+        avg_x = sum(p[0] for p in points[avg_start:avg_end]) / span
+        avg_y = sum(p[1] for p in points[avg_start:avg_end]) / span
+
+        ax, ay = points[a][0], points[a][1]
+        chosen, max_area = None, -1.0
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            x, y = points[j][0], points[j][1]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > max_area:
+                chosen, max_area = j, area
+        sampled.append(points[chosen])
+        a = chosen
+    sampled.append(points[-1])
+    return sampled
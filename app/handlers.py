@@ -1,21 +1,25 @@
 import logging
 import os
-import io
-import json
-import re
+from zoneinfo import ZoneInfo
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler, CallbackQueryHandler
 
-from PIL import Image
-
 # Relative imports
-from .coach import think_as_coach, generate_full_plan
-from .database import (
+from .coach import cancel_user_requests, CoachError
+from .replies import coach_reply, finalize_reply, ERROR_MSG
+from .repository import (
     save_log, create_or_update_user, get_user_profile, 
-    update_user_plan, update_reminders, get_user_plan, 
-    get_reminders, delete_user_data, get_daily_water_total
+    get_user_plan, 
+    get_reminders, delete_user_data, get_daily_water_total,
+    apply_user_changes, update_user_timezone
 )
 from .graphics import generate_progress_card
+from .log_sink import log_event
+from .commands import run_commands
+from . import chat_sessions, vision_cache
+from .media import prepare_photo, prepare_voice, release_voice, MediaRejected, VOICE_MAX_SECONDS
+from .plan_jobs import start_plan_generation, cancel as cancel_plan_generation
+from .scheduler import HYDRATION_DEFAULT_TZ
 
 # States for Onboarding
 NOME, ALTURA, PESO, META, ATIVIDADE, NICHE, CUSTOM_NICHE = range(7)
@@ -31,7 +35,7 @@ def get_main_menu_keyboard():
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    profile = get_user_profile(user_id)
+    profile = await get_user_profile(user_id)
     
     if profile:
         await update.message.reply_text(
@@ -135,7 +139,7 @@ async def finish_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # 1. Salvar Perfil Básico
-    success = create_or_update_user(user_id, context.user_data)
+    success = await create_or_update_user(user_id, context.user_data)
     
     if success:
         await update.message.reply_text(
@@ -147,32 +151,13 @@ async def finish_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=ReplyKeyboardRemove(),
             parse_mode='Markdown'
         )
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-        
-        # 2. Gerar Plano Completo (AI)
-        profile = context.user_data
-        full_plan = generate_full_plan(profile)
-        
-        if full_plan:
-            # 3. Salvar Plano e Lembretes no DB
-            update_user_plan(user_id, full_plan)
-            
-            reminders = full_plan.get('schedule', [])
-            update_reminders(user_id, reminders)
-            
-            await update.message.reply_text(
-                "🔥 *PLANO PRONTO!* 🔥\n\n"
-                "Seu protocolo exclusivo foi carregado.\n"
-                "Use o Menu abaixo para ver os detalhes.",
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode='Markdown'
-            )
-        else:
-            await update.message.reply_text(
-                "Tive um erro ao gerar o plano detalhado, mas seu perfil está salvo!\n"
-                "Tente novamente mais tarde.",
-                reply_markup=get_main_menu_keyboard()
-            )
+        # 2. Gerar Plano Completo em segundo plano: biblioteca de planos para perfis
+        # comuns; senão dieta, treino e agenda em paralelo pelo LLM. O aviso chega no fim.
+        profile = await get_user_profile(user_id) or context.user_data
+        start_plan_generation(
+            context.application, update.effective_chat.id, user_id, profile,
+            reply_markup=get_main_menu_keyboard()
+        )
             
     else:
         await update.message.reply_text("Erro crítico ao salvar perfil. Tente /start.", reply_markup=ReplyKeyboardRemove())
@@ -180,6 +165,7 @@ async def finish_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cancel_user_requests(update.effective_user.id)
     await update.message.reply_text("Cancelado.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
@@ -189,7 +175,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_text = update.message.text
     
-    profile = get_user_profile(user_id)
+    profile = await get_user_profile(user_id)
     if not profile:
         await update.message.reply_text("Eita, não te achei no sistema. Dá um /start pra gente configurar seu perfil!")
         return
@@ -212,141 +198,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         # Chat Normal com Coach
         if user_text:
-            response = think_as_coach(user_text, profile)
-            save_log(user_id, "TALK", 0, "Conversa com Coach")
-
-            # Check for schedule updates (NL Smart Interaction)
-            match = re.search(r'\[\[UPDATE_SCHEDULE: (.*?)\]\]', response)
-            if match:
-                try:
-                    cmd_data = json.loads(match.group(1))
-                    label = cmd_data.get('label')
-                    new_time = cmd_data.get('time')
-                    
-                    reminders = get_reminders(user_id)
-                    # Convert raw string to list if needed
-                    if isinstance(reminders, str): reminders = json.loads(reminders)
-                    
-                    updated = False
-                    for r in reminders:
-                        # Fuzzy match simples: se o label contiver a palavra
-                        if label.lower() in r.get('label', '').lower() or r.get('label', '').lower() in label.lower():
-                            r['time'] = new_time
-                            updated = True
-                            label = r.get('label') # Use original label for msg
-                            break
-                    
-                    if updated:
-                        update_reminders(user_id, reminders)
-                        confirmation = f"\n✅ **Agenda Atualizada:** {label} ➡️ {new_time}"
-                        response = response.replace(match.group(0), confirmation)
-                    else:
-                        response = response.replace(match.group(0), "")
-                        
-                except Exception as e:
-                    print(f"Error parsing update schedule: {e}")
-                    response = response.replace(match.group(0), "")
-
-            # Check for DIET updates
-            match_diet = re.search(r'\[\[UPDATE_DIET: (.*?)\]\]', response)
-            if match_diet:
-                try:
-                    cmd_data = json.loads(match_diet.group(1))
-                    target_meal = cmd_data.get('meal') # Ex: "Café da Manhã"
-                    new_foods = cmd_data.get('foods')  # List of strings
-                    
-                    plan = get_user_plan(user_id)
-                    diet = plan.get('diet', [])
-                    
-                    updated = False
-                    for meal in diet:
-                        # Fuzzy match no nome da refeição
-                        if target_meal.lower() in meal.get('meal', '').lower() or meal.get('meal', '').lower() in target_meal.lower():
-                            meal['foods'] = new_foods
-                            updated = True
-                            target_meal = meal.get('meal')
-                            break
-                    
-                    if updated:
-                        update_user_plan(user_id, plan)
-                        foods_str = ", ".join(new_foods)
-                        confirmation = f"\n🥗 **Dieta Atualizada:** {target_meal} ➡️ {foods_str}"
-                        response = response.replace(match_diet.group(0), confirmation)
-                    else:
-                        response = response.replace(match_diet.group(0), "")
-
-                except Exception as e:
-                    print(f"Error parsing update diet: {e}")
-                    response = response.replace(match_diet.group(0), "")
-
-            # Check for WORKOUT updates
-            match_workout = re.search(r'\[\[UPDATE_WORKOUT: (.*?)\]\]', response)
-            if match_workout:
-                try:
-                    cmd_data = json.loads(match_workout.group(1))
-                    target_day = cmd_data.get('day') # Ex: "Segunda"
-                    new_exercises = cmd_data.get('exercises')  # List of strings
-                    
-                    plan = get_user_plan(user_id)
-                    workout = plan.get('workout', {})
-                    days = workout.get('days', [])
-                    
-                    updated = False
-                    for day in days:
-                        # Fuzzy match no nome do dia
-                        if target_day.lower() in day.get('day', '').lower() or day.get('day', '').lower() in target_day.lower():
-                            day['exercises'] = new_exercises
-                            updated = True
-                            target_day = day.get('day')
-                            break
-                    
-                    if updated:
-                        update_user_plan(user_id, plan)
-                        ex_str = ", ".join(new_exercises)
-                        confirmation = f"\n🏋️ *Treino Atualizado:* {target_day} ➡️ {ex_str}"
-                        response = response.replace(match_workout.group(0), confirmation)
-                    else:
-                        response = response.replace(match_workout.group(0), "")
-
-                except Exception as e:
-                    print(f"Error parsing update workout: {e}")
-                    response = response.replace(match_workout.group(0), "")
-
-            # Check for WATER logging (NLP)
-            # [[LOG_WATER: 300]]
-            match_water = re.search(r'\[\[LOG_WATER: (\d+)\]\]', response)
-            if match_water:
-                try:
-                    amount = int(match_water.group(1))
-                    save_log(user_id, "WATER", amount, "NLP")
-                    total = get_daily_water_total(user_id)
-                    confirmation = f"\n💧 *Hidratação:* +{amount}ml (Total: {int(total)}ml)"
-                    response = response.replace(match_water.group(0), confirmation)
-                except Exception as e:
-                    print(f"Error parsing log water: {e}")
-                    response = response.replace(match_water.group(0), "")
-
-            # Check for WEIGHT updates (NLP)
-            # [[UPDATE_WEIGHT: 75.5]]
-            match_weight = re.search(r'\[\[UPDATE_WEIGHT: ([\d\.]+)\]\]', response)
-            if match_weight:
-                try:
-                    new_weight = float(match_weight.group(1))
-                    from .database import update_user_weight # Lazy import to avoid cycle if needed or just standard
-                    update_user_weight(user_id, new_weight)
-                    confirmation = f"\n⚖️ *Peso Atualizado:* {new_weight}kg"
-                    response = response.replace(match_weight.group(0), confirmation)
-                except Exception as e:
-                    print(f"Error parsing weight update: {e}")
-                    response = response.replace(match_weight.group(0), "")
+            response, sent = await coach_reply(update, user_text, profile, reply_markup=get_main_menu_keyboard())
+            if response is None:
+                return
+            await log_event(user_id, "TALK", 0, "Conversa com Coach")
+
+            # Comandos do coach ([[UPDATE_DIET: ...]], [[LOG_WATER: ...]], ...) numa passada e numa transação
+            response = await run_commands(response, user_id, profile, apply=apply_user_changes)
             
             # Markdown Fix for Response
             response = response.replace("**", "*")
             
-            await update.message.reply_text(response, reply_markup=get_main_menu_keyboard(), parse_mode='Markdown')
+            await finalize_reply(update, sent, response, reply_markup=get_main_menu_keyboard())
 
 async def show_diet(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
-    plan = get_user_plan(user_id)
+    plan = await get_user_plan(user_id)
     diet = plan.get('diet', []) if plan else []
     
     if not diet:
@@ -362,7 +228,7 @@ async def show_diet(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id)
     await update.message.reply_text(msg, parse_mode='Markdown')
 
 async def show_workout(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
-    plan = get_user_plan(user_id)
+    plan = await get_user_plan(user_id)
     workout = plan.get('workout', {}) if plan else {}
     
     if not workout:
@@ -379,7 +245,7 @@ async def show_workout(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
     await update.message.reply_text(msg, parse_mode='Markdown')
 
 async def show_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
-    reminders = get_reminders(user_id)
+    reminders = await get_reminders(user_id)
     if not reminders:
         await update.message.reply_text("Sem lembretes configurados.")
         return
@@ -402,7 +268,7 @@ async def log_water_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, use
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     # Busca total do dia
-    total = get_daily_water_total(user_id)
+    total = await get_daily_water_total(user_id)
     
     await update.message.reply_text(
         f"💧 *Painel de Hidratação*\n"
@@ -425,8 +291,8 @@ async def handle_water_callback(update: Update, context: ContextTypes.DEFAULT_TY
         return # Future: Handle next message as number
         
     if amount > 0:
-        save_log(user_id, "WATER", amount, "Menu")
-        total = get_daily_water_total(user_id)
+        await save_log(user_id, "WATER", amount, "Menu")
+        total = await get_daily_water_total(user_id)
         await query.edit_message_text(f"✅ *+{amount}ml* registrado!\n🌊 Total hoje: *{int(total)}ml*", parse_mode='Markdown')
 
 async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, profile):
@@ -434,8 +300,9 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, profi
         f"👤 *Perfil de Atleta*\n"
         f"Nome: {profile['name']}\n"
         f"Nicho: {profile['niche']}\n"
-        f"Peso: {profile['weight_current']}kg (Meta: {profile['weight_target']}kg)\n\n"
-        "Para resetar tudo, digite /reset."
+        f"Peso: {profile['weight_current']}kg (Meta: {profile['weight_target']}kg)\n"
+        f"Fuso: {profile.get('timezone') or HYDRATION_DEFAULT_TZ}\n\n"
+        "Para mudar o fuso, use /fuso. Para resetar tudo, digite /reset."
     )
     await update.message.reply_text(msg, parse_mode='Markdown')
 
@@ -459,6 +326,7 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "⚖️ *Progresso*\n"
         "• _\"Estou pesando 75.5kg\"_\n"
         "• _\"Atualizar peso para 80kg\"_\n\n"
+        "🔄 /plano gera seu plano de novo.\n\n"
         "Experimente falar do seu jeito, eu entendo!"
     )
     await update.message.reply_text(msg, parse_mode='Markdown')
@@ -466,39 +334,64 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- MEDIA HANDLERS ---
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    profile = get_user_profile(user_id)
+    profile = await get_user_profile(user_id)
     if not profile: return 
 
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-    photo_file = await update.message.photo[-1].get_file()
-    photo_bytes = await photo_file.download_as_bytearray()
-    image = Image.open(io.BytesIO(photo_bytes))
+    # Menor tamanho que atende a resolução configurada, reduzido e sem EXIF
+    image_bytes, image_mime, image = await prepare_photo(update.message.photo)
     user_text = update.message.caption or "Analise esta imagem."
     
-    response = think_as_coach(user_text, profile, media_data=image)
-    save_log(user_id, "VISION", 0, "Photo Analysis")
+    # Foto repetida/encaminhada: reaproveita a análise sem chamar o LLM
+    phash = vision_cache.image_hash(image)
+    bucket = vision_cache.make_bucket(profile, user_text)
+    cached = await vision_cache.get(bucket, phash)
+    if cached is not None:
+        await log_event(user_id, "VISION", 0, "Photo Analysis (cache)")
+        await finalize_reply(update, None, cached)
+        return
+    
+    response, sent = await coach_reply(update, user_text, profile, media_data=image_bytes, media_type=image_mime)
+    if response is None:
+        return
+    await log_event(user_id, "VISION", 0, "Photo Analysis")
     # Fix markdown
     response = response.replace("**", "*")
-    await update.message.reply_text(response, parse_mode='Markdown')
+    await finalize_reply(update, sent, response)
+    await vision_cache.put(bucket, phash, response)
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    profile = get_user_profile(user_id)
+    profile = await get_user_profile(user_id)
     if not profile: return 
 
+    try:
+        voice_data, voice_mime, uploaded = await prepare_voice(update.message.voice)
+    except MediaRejected:
+        await update.message.reply_text(
+            f"🎙️ Esse áudio é longo demais pra mim (máx. {VOICE_MAX_SECONDS // 60} min). Manda um mais curto?"
+        )
+        return
+    except CoachError as e:
+        print(f"Erro no áudio de {user_id}: {e}")
+        await update.message.reply_text(ERROR_MSG)
+        return
+
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-    voice_file = await update.message.voice.get_file()
-    voice_bytes = await voice_file.download_as_bytearray()
-    
-    response = think_as_coach("Audio enviado.", profile, media_data=voice_bytes, media_type="audio/mp3")
-    save_log(user_id, "VOICE", 0, "Voice Interaction")
+    try:
+        response, sent = await coach_reply(update, "Audio enviado.", profile, media_data=voice_data, media_type=voice_mime)
+    finally:
+        await release_voice(uploaded)
+    if response is None:
+        return
+    await log_event(user_id, "VOICE", 0, "Voice Interaction")
     # Fix markdown
     response = response.replace("**", "*")
-    await update.message.reply_text(response, parse_mode='Markdown')
+    await finalize_reply(update, sent, response)
 
 async def handle_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    profile = get_user_profile(user_id)
+    profile = await get_user_profile(user_id)
     if not profile: return 
 
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="upload_photo")
@@ -512,6 +405,51 @@ async def handle_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_photo(photo=image_bio, caption="📊 *Seu Progresso*", reply_markup=reply_markup, parse_mode='Markdown')
 
 # --- RESET FLOW ---
+async def cmd_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/plano: gera o plano de novo (em segundo plano, como no onboarding)."""
+    user_id = update.effective_user.id
+    profile = await get_user_profile(user_id)
+    if not profile:
+        await update.message.reply_text("Eita, não te achei no sistema. Dá um /start pra gente configurar seu perfil!")
+        return
+
+    # Pedido explícito: plano sob medida pelo LLM, sem passar pela biblioteca
+    started = start_plan_generation(
+        context.application, update.effective_chat.id, user_id, profile,
+        reply_markup=get_main_menu_keyboard(), use_library=False
+    )
+    if started:
+        await update.message.reply_text(
+            "🧠 *Gerando um novo plano...*\n"
+            "(Dieta, treino e horários. Te aviso quando terminar!)",
+            parse_mode='Markdown'
+        )
+    else:
+        await update.message.reply_text("⏳ Seu plano já está sendo gerado. Te aviso quando terminar!")
+
+async def cmd_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/fuso America/Manaus: fuso usado nos avisos por horário local (hidratação)."""
+    user_id = update.effective_user.id
+    if not context.args:
+        profile = await get_user_profile(user_id)
+        current = (profile or {}).get('timezone') or HYDRATION_DEFAULT_TZ
+        await update.message.reply_text(
+            f"🌎 Seu fuso: *{current}*\nPara mudar: `/fuso America/Manaus`",
+            parse_mode='Markdown'
+        )
+        return
+
+    timezone = context.args[0]
+    try:
+        ZoneInfo(timezone)
+    except Exception:
+        await update.message.reply_text("Fuso inválido. Use o nome completo, ex: America/Sao_Paulo, America/Manaus, Europe/Lisbon.")
+        return
+    if await update_user_timezone(user_id, timezone):
+        await update.message.reply_text(f"✅ Fuso atualizado para *{timezone}*.", parse_mode='Markdown')
+    else:
+        await update.message.reply_text("Não te achei no sistema. Dá um /start primeiro!")
+
 async def cmd_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("✅ SIM, Apagar Tudo", callback_data='confirm_reset')],
@@ -532,7 +470,10 @@ async def reset_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TY
     
     if query.data == 'confirm_reset':
         user_id = query.from_user.id
-        delete_user_data(user_id)
+        cancel_user_requests(user_id)
+        cancel_plan_generation(user_id)
+        chat_sessions.reset(user_id)
+        await delete_user_data(user_id)
         await query.edit_message_text("🗑️ *Perfil Deletado.*\nDigite /start para começar do zero.", parse_mode='Markdown')
     else:
         await query.edit_message_text("Ufa! Operação cancelada. Seus dados estão salvos.")
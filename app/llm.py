@@ -0,0 +1,78 @@
+import os
+import warnings
+
+# Backend de LLM plugável.
+# O coach (app/coach.py) só conversa com esta interface; a escolha vem de
+# LLM_BACKEND: "gemini" (padrão, Google Generative AI) ou "fake" (app/llm_fake.py,
+# local e determinístico, para testes de carga e benchmark sem o serviço real).
+#
+# Um backend expõe:
+#   create_model(system_instruction=None) -> modelo com
+#       generate_content(contents, request_options=None) -> resposta com .text
+#       generate_content_async(contents, stream=False)  -> resposta com .text
+#           (ou, com stream=True, um iterável assíncrono de pedaços com .text)
+#   upload_file(stream, mime_type) / get_file(name) / delete_file(name)
+#       arquivos com .name, .uri e .state.name ("PROCESSING", "ACTIVE", ...)
+
+
+class GeminiBackend:
+    """Google Generative AI. A chave (GEMINI_API_KEY) só é lida no primeiro uso."""
+
+    name = "gemini"
+
+    def __init__(self, model_name=None, api_key=None):
+        self.model_name = model_name or os.getenv("GEMINI_MODEL", "models/gemini-2.5-flash-preview-09-2025")
+        self._api_key = api_key
+        self._genai = None
+
+    @property
+    def genai(self):
+        if self._genai is None:
+            # Suppress deprecation warning for now
+            warnings.filterwarnings("ignore", category=FutureWarning, module="google.generativeai")
+            import google.generativeai as genai
+            genai.configure(api_key=self._api_key or os.getenv("GEMINI_API_KEY"))
+            self._genai = genai
+        return self._genai
+
+    def create_model(self, system_instruction=None):
+        if system_instruction is None:
+            return self.genai.GenerativeModel(self.model_name)
+        return self.genai.GenerativeModel(model_name=self.model_name, system_instruction=system_instruction)
+
+    def upload_file(self, stream, mime_type):
+        return self.genai.upload_file(stream, mime_type=mime_type)
+
+    def get_file(self, name):
+        return self.genai.get_file(name)
+
+    def delete_file(self, name):
+        self.genai.delete_file(name)
+
+
+def _create_fake():
+    from .llm_fake import FakeBackend
+    return FakeBackend.from_env()
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "fake": _create_fake,
+}
+
+_backend = None
+
+def get_backend():
+    """Backend ativo (criado na primeira chamada a partir de LLM_BACKEND)."""
+    global _backend
+    if _backend is None:
+        name = os.getenv("LLM_BACKEND", "gemini").lower()
+        if name not in BACKENDS:
+            raise ValueError(f"LLM_BACKEND desconhecido: {name} (opções: {', '.join(BACKENDS)})")
+        _backend = BACKENDS[name]()
+    return _backend
+
+def set_backend(backend):
+    """Troca o backend (benchmarks/testes). Use coach.use_backend para limpar os caches do coach junto."""
+    global _backend
+    _backend = backend
+    return backend
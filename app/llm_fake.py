@@ -0,0 +1,314 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import uuid
+from types import SimpleNamespace
+
+# Backend de LLM local e determinístico (LLM_BACKEND=fake).
+# Responde no mesmo formato do modelo real: respostas do coach com os tokens de
+# comando ([[LOG_WATER: 300]], [[UPDATE_DIET: {...}]], ...) quando a mensagem pede,
+# e o JSON do plano (completo ou por seção). Latência e falhas seguem
+# distribuições configuráveis, para medir o resto do pipeline sem o serviço real.
+# Mesma semente + mesma sequência de chamadas = mesmas respostas e latências.
+#
+# LLM_FAKE_SEED             semente (padrão 0)
+# LLM_FAKE_LATENCY_MS       latência mediana de uma resposta completa (padrão 800)
+# LLM_FAKE_LATENCY_SIGMA    dispersão log-normal da latência (padrão 0.35; 0 = fixa)
+# LLM_FAKE_FIRST_CHUNK      fração da latência até o 1º pedaço no streaming (padrão 0.3)
+# LLM_FAKE_ERROR_RATE       fração de chamadas que levantam erro da API (padrão 0)
+# LLM_FAKE_EMPTY_RATE       fração de respostas bloqueadas/sem texto (padrão 0)
+# LLM_FAKE_HANG_RATE        fração de chamadas que nunca respondem (testa prazos; padrão 0)
+
+
+class FakeLLMError(Exception):
+    """Erro simulado da API (equivalente a um 500/503 do serviço real)."""
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self._text = text
+
+    @property
+    def text(self):
+        if not self._text:
+            # Mesmo comportamento do SDK com resposta bloqueada
+            raise ValueError("Resposta sem candidatos (bloqueada pelos filtros)")
+        return self._text
+
+
+class FakeStream:
+    def __init__(self, chunks, delays):
+        self._chunks = chunks
+        self._delays = delays
+
+    async def __aiter__(self):
+        for chunk, delay in zip(self._chunks, self._delays):
+            if delay:
+                await asyncio.sleep(delay)
+            yield FakeResponse(chunk)
+
+
+_MEALS = (
+    ("Café da Manhã", "07:30", ("{ovos} ovos mexidos", "{pao}g de pão integral", "1 banana", "200ml de café sem açúcar")),
+    ("Lanche da Manhã", "10:00", ("{iogurte}g de iogurte natural", "30g de aveia")),
+    ("Almoço", "12:30", ("{arroz}g de arroz", "100g de feijão", "{frango}g de frango grelhado", "Salada à vontade")),
+    ("Lanche da Tarde", "16:00", ("{whey}g de whey protein", "1 maçã")),
+    ("Jantar", "20:00", ("{batata}g de batata doce", "{peixe}g de tilápia", "Legumes no vapor")),
+)
+_SPLITS = {
+    "ABC": (
+        ("Segunda", "Peito e Tríceps", ("Supino reto 4x10", "Supino inclinado 3x12", "Crucifixo 3x12", "Tríceps corda 3x15")),
+        ("Quarta", "Costas e Bíceps", ("Puxada frente 4x10", "Remada curvada 3x10", "Rosca direta 3x12", "Rosca martelo 3x12")),
+        ("Sexta", "Pernas e Ombros", ("Agachamento 4x10", "Leg press 3x12", "Desenvolvimento 3x10", "Elevação lateral 3x15")),
+    ),
+    "Fullbody": (
+        ("Segunda", "Corpo inteiro", ("Agachamento 3x10", "Supino reto 3x10", "Remada baixa 3x12", "Prancha 3x40s")),
+        ("Quarta", "Corpo inteiro", ("Levantamento terra 3x8", "Desenvolvimento 3x10", "Puxada frente 3x10", "Abdominal 3x20")),
+        ("Sexta", "Corpo inteiro", ("Leg press 3x12", "Flexão 3x15", "Remada curvada 3x10", "Afundo 3x12")),
+    ),
+}
+_OPENERS = (
+    "Boa, {name}!", "Fala, {name}!", "Show, {name}.", "Anotado, {name}!", "Bora, {name}!",
+)
+_SENTENCES = (
+    "Consistência vale mais que intensidade: o resultado vem da soma dos dias.",
+    "Lembra de bater a proteína do dia, ela segura a massa magra.",
+    "Dormir bem é metade do shape, tenta fechar 7 horas hoje.",
+    "Hidratação em dia ajuda até no rendimento do treino.",
+    "Se a fome apertar, aumenta os vegetais antes de mexer no resto.",
+    "No treino, foca na execução antes de subir a carga.",
+    "Pequenos ajustes semanais funcionam melhor que mudanças radicais.",
+    "Registra o que comer hoje que eu te ajudo a ajustar amanhã.",
+)
+_FOOD_WORDS = ("ovo", "pão", "pao", "frango", "arroz", "tapioca", "carne", "peixe", "batata", "aveia", "whey")
+_WORKOUT_WORDS = ("supino", "agachamento", "remada", "flexão", "flexao", "puxada", "rosca", "leg", "treino")
+_MEAL_WORDS = (("café", "Café da Manhã"), ("cafe", "Café da Manhã"), ("almoço", "Almoço"), ("almoco", "Almoço"),
+               ("jantar", "Jantar"), ("lanche", "Lanche da Tarde"))
+
+_WATER_RE = re.compile(r'(\d{2,4})\s*ml', re.IGNORECASE)
+_GLASS_RE = re.compile(r'\bcopo', re.IGNORECASE)
+_WEIGHT_RE = re.compile(r'(\d{2,3}(?:[.,]\d+)?)\s*kg', re.IGNORECASE)
+_TIME_RE = re.compile(r'\b(\d{1,2})(?::(\d{2})|h(\d{2})?)')
+_SWAP_RE = re.compile(r'tro[cq]\w*\s+(?:o |a )?(.+?)\s+por\s+(.+?)(?:\s+n[oa]\s+|[.!?]|$)', re.IGNORECASE)
+_LABEL_RE = re.compile(r'\b(?:meu|minha|o|a)\s+(\w+)', re.IGNORECASE)
+_NAME_RE = re.compile(r'Nome:\s*(.+)')
+_WEIGHT_LINE_RE = re.compile(r'Peso(?: Atual)?:\s*([\d.]+)')
+_SECTION_RE = re.compile(r'Crie a parte "(\w+)"')
+
+
+class FakeModel:
+    def __init__(self, backend, system_instruction=None):
+        self.backend = backend
+        self.system_instruction = system_instruction or ""
+
+    def generate_content(self, contents, request_options=None):
+        text, latency = self.backend.respond(self.system_instruction, contents)
+        timeout = (request_options or {}).get("timeout")
+        if latency is None:
+            time.sleep(timeout or 3600)
+            raise FakeLLMError("504 Deadline exceeded (simulado)")
+        time.sleep(latency)
+        return FakeResponse(text)
+
+    async def generate_content_async(self, contents, stream=False):
+        text, latency = self.backend.respond(self.system_instruction, contents)
+        if latency is None:
+            await asyncio.Event().wait()  # nunca responde; o prazo do chamador encerra
+        if not stream:
+            await asyncio.sleep(latency)
+            return FakeResponse(text)
+        first = latency * self.backend.first_chunk
+        chunks = [text[i:i + 24] for i in range(0, len(text), 24)] or [""]
+        rest = (latency - first) / max(1, len(chunks) - 1)
+        return FakeStream(chunks, [first] + [rest] * (len(chunks) - 1))
+
+
+class FakeBackend:
+    name = "fake"
+
+    def __init__(self, seed=0, latency_ms=800, latency_sigma=0.35, first_chunk=0.3,
+                 error_rate=0.0, empty_rate=0.0, hang_rate=0.0):
+        self.seed = seed
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.first_chunk = first_chunk
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.hang_rate = hang_rate
+        self._calls = 0
+        self._files = {}
+        self.stats = {"calls": 0, "errors": 0, "empty": 0, "hangs": 0, "plans": 0, "commands": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            seed=int(os.getenv("LLM_FAKE_SEED", 0)),
+            latency_ms=float(os.getenv("LLM_FAKE_LATENCY_MS", 800)),
+            latency_sigma=float(os.getenv("LLM_FAKE_LATENCY_SIGMA", 0.35)),
+            first_chunk=float(os.getenv("LLM_FAKE_FIRST_CHUNK", 0.3)),
+            error_rate=float(os.getenv("LLM_FAKE_ERROR_RATE", 0)),
+            empty_rate=float(os.getenv("LLM_FAKE_EMPTY_RATE", 0)),
+            hang_rate=float(os.getenv("LLM_FAKE_HANG_RATE", 0)),
+        )
+
+    # --- Interface do backend ---
+
+    def create_model(self, system_instruction=None):
+        return FakeModel(self, system_instruction)
+
+    def upload_file(self, stream, mime_type):
+        name = f"files/{uuid.uuid4().hex[:12]}"
+        uploaded = SimpleNamespace(
+            name=name, uri=f"fake://{name}", mime_type=mime_type,
+            size=len(stream.read()), state=SimpleNamespace(name="ACTIVE")
+        )
+        self._files[name] = uploaded
+        return uploaded
+
+    def get_file(self, name):
+        return self._files[name]
+
+    def delete_file(self, name):
+        self._files.pop(name, None)
+
+    # --- Simulação ---
+
+    def _rng(self, system_instruction, prompt):
+        self._calls += 1
+        digest = hashlib.sha1(f"{system_instruction}\x00{prompt}".encode()).hexdigest()
+        return random.Random(f"{self.seed}:{self._calls}:{digest}")
+
+    def respond(self, system_instruction, contents):
+        """(texto, latência em s); latência None = chamada que nunca responde. Pode levantar FakeLLMError."""
+        if not isinstance(contents, (list, tuple)):
+            contents = [contents]
+        if contents and isinstance(contents[-1], dict) and "role" in contents[-1]:
+            # Formato multi-turno: responde ao último turno do usuário
+            contents = contents[-1]["parts"]
+        prompt = "\n".join(part for part in contents if isinstance(part, str))
+        has_media = any(not isinstance(part, str) for part in contents)
+        rng = self._rng(system_instruction, prompt)
+        self.stats["calls"] += 1
+
+        roll = rng.random()
+        if roll < self.hang_rate:
+            self.stats["hangs"] += 1
+            return "", None
+        latency = self.latency_ms / 1000 * (rng.lognormvariate(0, self.latency_sigma) if self.latency_sigma else 1)
+        if roll < self.hang_rate + self.error_rate:
+            self.stats["errors"] += 1
+            raise FakeLLMError("503 Service Unavailable (simulado)")
+        if roll < self.hang_rate + self.error_rate + self.empty_rate:
+            self.stats["empty"] += 1
+            return "", latency
+
+        if "plano de transformação" in prompt:
+            self.stats["plans"] += 1
+            return self._plan(rng, prompt), latency
+        text = self._reply(rng, system_instruction, prompt, has_media)
+        if "[[" in text:
+            self.stats["commands"] += 1
+        return text, latency
+
+    def _plan(self, rng, prompt):
+        weight = _match_float(_WEIGHT_LINE_RE, prompt) or 75.0
+        scale = weight / 75.0
+        portions = {
+            "ovos": max(2, round(3 * scale)), "pao": _portion(50 * scale), "iogurte": _portion(170 * scale),
+            "arroz": _portion(120 * scale), "frango": _portion(150 * scale), "whey": _portion(30 * scale),
+            "batata": _portion(150 * scale), "peixe": _portion(150 * scale),
+        }
+        diet = []
+        for meal, meal_time, foods in _MEALS:
+            diet.append({
+                "meal": meal,
+                "time": meal_time,
+                "foods": [food.format(**portions) for food in foods],
+                "calories": int(round(rng.uniform(250, 650) * scale / 10)) * 10,
+            })
+        split = rng.choice(sorted(_SPLITS))
+        workout = {
+            "split": split,
+            "days": [{"day": day, "focus": focus, "exercises": list(ex)} for day, focus, ex in _SPLITS[split]],
+        }
+        workout_time = rng.choice(("06:30", "12:00", "18:00", "19:00"))
+        schedule = [
+            {"label": meal["meal"], "time": meal["time"], "message": f"Hora do {meal['meal'].lower()}! Foco na proteína."}
+            for meal in diet
+        ]
+        schedule += [
+            {"label": f"Água {i}", "time": t, "message": "Hidratação! 500ml pra dentro."}
+            for i, t in enumerate(("09:00", "11:00", "15:00", "17:00"), 1)
+        ]
+        schedule.append({"label": "Treino", "time": workout_time, "message": "Bora esmagar! Dia de treino."})
+        schedule.sort(key=lambda r: r["time"])
+        plan = {"diet": diet, "workout": workout, "schedule": schedule}
+
+        section = _SECTION_RE.search(prompt)
+        if section and section.group(1) in plan:
+            plan = {section.group(1): plan[section.group(1)]}
+        return json.dumps(plan, ensure_ascii=False)
+
+    def _reply(self, rng, system_instruction, prompt, has_media):
+        name_match = _NAME_RE.search(system_instruction)
+        name = name_match.group(1).strip() if name_match else "atleta"
+        lines = [rng.choice(_OPENERS).format(name=name)]
+        if has_media and not prompt:
+            lines.append("Recebi aqui e já analisei.")
+        if has_media:
+            kcal = int(rng.uniform(300, 900) // 10 * 10)
+            lines.append(f"Esse prato tem em torno de {kcal} kcal, com ~{int(kcal * 0.3 / 4)}g de proteína.")
+        lines += rng.sample(_SENTENCES, k=rng.randint(2, 4))
+        tokens = _command_tokens(prompt)
+        return " ".join(lines) + ("\n" + "\n".join(tokens) if tokens else "")
+
+
+def _portion(grams):
+    return max(10, int(round(grams / 10)) * 10)
+
+def _match_float(pattern, text):
+    match = pattern.search(text)
+    if not match:
+        return None
+    try:
+        return float(match.group(1).replace(",", "."))
+    except ValueError:
+        return None
+
+def _command_tokens(text):
+    """Tokens de comando que o modelo real emitiria para a mensagem (formato de app/commands.py)."""
+    lower = text.lower()
+    tokens = []
+    water = _WATER_RE.search(text)
+    if water and ("água" in lower or "agua" in lower or "tomei" in lower or "bebi" in lower):
+        tokens.append(f"[[LOG_WATER: {int(water.group(1))}]]")
+    elif _GLASS_RE.search(text) and ("água" in lower or "agua" in lower):
+        tokens.append("[[LOG_WATER: 250]]")
+
+    weight = _match_float(_WEIGHT_RE, text)
+    if weight and any(w in lower for w in ("peso", "pesando", "estou com", "to com", "tô com")):
+        tokens.append(f"[[UPDATE_WEIGHT: {weight:.1f}]]")
+
+    when = _TIME_RE.search(text)
+    if when and any(w in lower for w in ("mude", "muda", "mudar", "passa", "coloca")):
+        hour = int(when.group(1))
+        minute = when.group(2) or when.group(3) or "00"
+        label = _LABEL_RE.search(text)
+        payload = {"label": label.group(1).capitalize() if label else "Treino", "time": f"{hour:02d}:{minute}"}
+        tokens.append(f"[[UPDATE_SCHEDULE: {json.dumps(payload, ensure_ascii=False)}]]")
+
+    swap = _SWAP_RE.search(text)
+    if swap:
+        old, new = swap.group(1).strip(), swap.group(2).strip()
+        if any(w in lower for w in _WORKOUT_WORDS) and not any(w in old.lower() for w in _FOOD_WORDS):
+            payload = {"day": "Segunda", "exercises": [f"{new.capitalize()} 3x12"]}
+            tokens.append(f"[[UPDATE_WORKOUT: {json.dumps(payload, ensure_ascii=False)}]]")
+        else:
+            meal = next((m for word, m in _MEAL_WORDS if word in lower), "Almoço")
+            payload = {"meal": meal, "foods": [f"{new.capitalize()} (100g)", "Salada à vontade"]}
+            tokens.append(f"[[UPDATE_DIET: {json.dumps(payload, ensure_ascii=False)}]]")
+    return tokens
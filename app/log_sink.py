@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+import os
+
+from . import repository
+
+# Logger write-behind para user_logs.
+# Eventos que o usuário não vê na hora (TALK, VISION, VOICE...) entram numa fila
+# limitada e são gravados em lotes a cada LOG_SINK_FLUSH_MS ou LOG_SINK_BATCH_SIZE
+# eventos. Fila cheia = backpressure (quem enfileira espera).
+# Eventos com leitura imediata (ex: WATER, cujo total é mostrado na resposta)
+# devem continuar usando repository.save_log diretamente.
+
+FLUSH_INTERVAL = int(os.getenv("LOG_SINK_FLUSH_MS", 500)) / 1000
+BATCH_SIZE = int(os.getenv("LOG_SINK_BATCH_SIZE", 200))
+MAX_QUEUE = int(os.getenv("LOG_SINK_MAX_QUEUE", 10000))
+
+_queue = None
+_task = None
+_stats = {"enqueued": 0, "flushed": 0, "batches": 0, "failed": 0, "backpressure_waits": 0}
+
+async def log_event(telegram_id, log_type, value, description="", meta_data=None):
+    """Enfileira um evento. Sem o sink rodando (scripts), grava direto."""
+    if _task is None or _task.done():
+        await repository.save_log(telegram_id, log_type, value, description, meta_data)
+        return
+    # Com fuso: o banco converte para o fuso da sessão (o mesmo de CURRENT_TIMESTAMP),
+    # independente do TZ do container
+    row = (telegram_id, log_type, value, description, meta_data, datetime.datetime.now(datetime.timezone.utc))
+    if _queue.full():
+        _stats["backpressure_waits"] += 1
+    await _queue.put(row)
+    _stats["enqueued"] += 1
+
+async def _write(batch):
+    # Uma nova tentativa antes de descartar o lote
+    for _ in range(2):
+        if await repository.save_logs_batch(batch):
+            _stats["flushed"] += len(batch)
+            _stats["batches"] += 1
+            return
+    _stats["failed"] += len(batch)
+
+_STOP = object()  # sentinela de shutdown: tudo antes dela é gravado
+
+async def _run():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await _queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                # Fila com itens: pega sem agendar timeout
+                item = _queue.get_nowait()
+            except asyncio.QueueEmpty:
+                try:
+                    item = await asyncio.wait_for(_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        await _write(batch)
+
+def start():
+    """Inicia o flusher no event loop atual."""
+    global _queue, _task
+    if _task is not None and not _task.done():
+        return
+    _queue = asyncio.Queue(maxsize=MAX_QUEUE)
+    _task = asyncio.get_running_loop().create_task(_run())
+
+async def stop():
+    """Grava tudo que ainda estiver na fila e para o flusher (shutdown)."""
+    global _task
+    if _task is None:
+        return
+    if not _task.done():
+        await _queue.put(_STOP)
+        await _task
+    _task = None
+
+def stats():
+    return {**_stats, "queue_depth": _queue.qsize() if _queue else 0}
@@ -0,0 +1,139 @@
+import asyncio
+import io
+import os
+import time
+
+from PIL import Image, ImageOps
+
+from .coach import upload_media, delete_media, CoachError
+
+# Pré-processamento das fotos antes do envio multimodal.
+# 1. Escolhe o menor tamanho do Telegram que atende VISION_MIN_SIDE (menos download).
+# 2. Decodifica em modo draft (JPEG já reduzido no decode), aplica a orientação
+#    do EXIF e descarta os metadados.
+# 3. Re-encoda em JPEG/WebP limitado a VISION_MAX_SIDE (menos upload e tokens de visão).
+
+MIN_SIDE = int(os.getenv("VISION_MIN_SIDE", 768))
+MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", 1024))
+QUALITY = int(os.getenv("VISION_QUALITY", 80))
+FORMAT = os.getenv("VISION_FORMAT", "JPEG").upper()  # JPEG ou WEBP
+
+_MIME = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+# Áudio: notas acima de VOICE_MAX_SECONDS/VOICE_MAX_BYTES são recusadas antes
+# de qualquer download; acima de VOICE_INLINE_MAX_BYTES vão por upload + referência.
+VOICE_MAX_SECONDS = int(os.getenv("VOICE_MAX_SECONDS", 300))
+VOICE_MAX_BYTES = int(os.getenv("VOICE_MAX_BYTES", 20 * 1024 * 1024))  # limite de download da Bot API
+VOICE_INLINE_MAX_BYTES = int(os.getenv("VOICE_INLINE_MAX_BYTES", 1024 * 1024))
+VOICE_DEFAULT_MIME = "audio/ogg"  # notas de voz do Telegram são OGG/Opus
+
+
+class MediaRejected(Exception):
+    """Mídia recusada antes do download (longa/grande demais)."""
+
+
+_stats = {
+    "photos": 0,
+    "largest_bytes": 0,     # o que seria baixado usando photo[-1]
+    "downloaded_bytes": 0,
+    "uploaded_bytes": 0,
+    "download_s": 0.0,
+    "process_s": 0.0,
+}
+
+def pick_photo_size(photo_sizes, min_side=MIN_SIDE):
+    """Menor PhotoSize cujo lado menor >= min_side; se nenhum atende, o maior."""
+    ordered = sorted(photo_sizes, key=lambda p: p.width * p.height)
+    for size in ordered:
+        if min(size.width, size.height) >= min_side:
+            return size
+    return ordered[-1]
+
+def preprocess_image(raw, max_side=MAX_SIDE):
+    """Bytes da foto -> (bytes re-encodados sem EXIF, mime, imagem PIL reduzida)."""
+    image = Image.open(io.BytesIO(raw))
+    if image.format == "JPEG":
+        # Decode já reduzido (escala 1/2, 1/4, 1/8) quando a foto é maior que o alvo
+        image.draft("RGB", (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    out = io.BytesIO()
+    fmt = FORMAT if FORMAT in _MIME else "JPEG"
+    # Sem o argumento exif=..., nenhum metadado é gravado
+    image.save(out, format=fmt, quality=QUALITY, optimize=True)
+    return out.getvalue(), _MIME[fmt], image
+
+async def prepare_photo(photo_sizes):
+    """Baixa o tamanho adequado e pré-processa fora do event loop. Retorna (bytes, mime, imagem)."""
+    chosen = pick_photo_size(photo_sizes)
+    largest = max(photo_sizes, key=lambda p: p.width * p.height)
+
+    started = time.monotonic()
+    photo_file = await chosen.get_file()
+    buffer = io.BytesIO()
+    await photo_file.download_to_memory(out=buffer)
+    downloaded = time.monotonic()
+
+    data, mime, image = await asyncio.to_thread(preprocess_image, buffer.getvalue())
+    processed = time.monotonic()
+
+    _stats["photos"] += 1
+    _stats["largest_bytes"] += largest.file_size or 0
+    _stats["downloaded_bytes"] += buffer.getbuffer().nbytes
+    _stats["uploaded_bytes"] += len(data)
+    _stats["download_s"] += downloaded - started
+    _stats["process_s"] += processed - downloaded
+    return data, mime, image
+
+_voice_stats = {"voices": 0, "inline": 0, "uploaded": 0, "rejected": 0, "bytes": 0}
+
+async def prepare_voice(voice):
+    """
+    Baixa a nota de voz direto para um buffer (sem cópias intermediárias) e
+    decide o caminho: inline (pequena) ou upload + referência (grande).
+    Retorna (media_data, mime, arquivo_enviado_ou_None).
+    Levanta MediaRejected (limites) ou CoachError (falha no upload).
+    """
+    if (voice.duration or 0) > VOICE_MAX_SECONDS or (voice.file_size or 0) > VOICE_MAX_BYTES:
+        _voice_stats["rejected"] += 1
+        raise MediaRejected(f"Áudio acima do limite ({VOICE_MAX_SECONDS}s)")
+
+    mime = voice.mime_type or VOICE_DEFAULT_MIME
+    voice_file = await voice.get_file()
+    buffer = io.BytesIO()
+    await voice_file.download_to_memory(out=buffer)
+    size = buffer.getbuffer().nbytes
+
+    _voice_stats["voices"] += 1
+    _voice_stats["bytes"] += size
+    if size <= VOICE_INLINE_MAX_BYTES:
+        _voice_stats["inline"] += 1
+        # Única cópia: o blob inline da API exige bytes
+        return buffer.getvalue(), mime, None
+
+    buffer.seek(0)
+    try:
+        uploaded = await asyncio.to_thread(upload_media, buffer, mime)
+    except CoachError:
+        raise
+    except Exception as e:
+        raise CoachError(f"Falha no upload do áudio: {e}") from e
+    _voice_stats["uploaded"] += 1
+    return uploaded, mime, uploaded
+
+async def release_voice(uploaded):
+    """Remove da File API o áudio enviado (após a resposta)."""
+    if uploaded is not None:
+        await asyncio.to_thread(delete_media, uploaded)
+
+def stats():
+    photos = _stats["photos"]
+    return {
+        **_stats,
+        "voice": dict(_voice_stats),
+        "avg_download_ms": round(_stats["download_s"] / photos * 1000, 1) if photos else None,
+        "avg_process_ms": round(_stats["process_s"] / photos * 1000, 1) if photos else None,
+    }
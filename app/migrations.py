@@ -0,0 +1,262 @@
+# Migrações versionadas do schema.
+# Cada migração: (versão, descrição, passos, transacional).
+# Passos são SQL ou callables(cur). Migrações não-transacionais rodam em
+# autocommit (necessário para CREATE INDEX CONCURRENTLY, que não bloqueia escritas).
+# Nunca edite uma migração já publicada: adicione uma nova versão no fim da lista.
+
+MIGRATION_LOCK_KEY = 7420001  # pg_advisory_lock: só um processo migra por vez
+
+# Recalcula user_daily_stats a partir de user_logs (migração 8 e backfill_stats.py).
+# {user_filter}: vazio (todos) ou "AND user_id = %(user_id)s".
+BACKFILL_DAILY_STATS_SQL = """
+    WITH per_type AS (
+        SELECT user_id, created_at::date AS day, log_type,
+               COUNT(*) AS n,
+               SUM(value) AS total,
+               (ARRAY_AGG(value ORDER BY created_at DESC))[1] AS last_value
+        FROM user_logs
+        WHERE user_id IS NOT NULL AND log_type IS NOT NULL {user_filter}
+        GROUP BY 1, 2, 3
+    )
+    INSERT INTO user_daily_stats (user_id, day, water_total, last_weight, event_counts)
+    SELECT user_id, day,
+           COALESCE(SUM(total) FILTER (WHERE log_type = 'WATER'), 0),
+           MAX(last_value) FILTER (WHERE log_type = 'WEIGHT'),
+           jsonb_object_agg(log_type, n)
+    FROM per_type
+    GROUP BY user_id, day
+    ON CONFLICT (user_id, day) DO UPDATE SET
+        water_total = EXCLUDED.water_total,
+        last_weight = EXCLUDED.last_weight,
+        event_counts = EXCLUDED.event_counts,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+def _create_index_concurrently(name, ddl):
+    """Cria índice sem bloquear escritas, descartando sobras inválidas de tentativas anteriores."""
+    def step(cur):
+        cur.execute("""
+            SELECT NOT i.indisvalid
+            FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s
+        """, (name,))
+        row = cur.fetchone()
+        if row and row[0]:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        cur.execute(ddl)
+    return step
+
+MIGRATIONS = [
+    (1, "Tabelas base (users, user_logs, user_daily_stats)", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id BIGINT PRIMARY KEY,
+            name VARCHAR(255),
+            height FLOAT,
+            weight_start FLOAT,
+            weight_current FLOAT,
+            weight_target FLOAT,
+            activity_level VARCHAR(50),
+            niche VARCHAR(50),
+            preferences JSONB DEFAULT '{}',
+            generated_plan JSONB DEFAULT '{}',
+            reminders JSONB DEFAULT '[]',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        # Bancos antigos, anteriores às colunas de plano/lembretes
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS generated_plan JSONB DEFAULT '{}';",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS reminders JSONB DEFAULT '[]';",
+        """
+        CREATE TABLE IF NOT EXISTS user_logs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(telegram_id),
+            log_type VARCHAR(20),
+            value FLOAT,
+            meta_data JSONB,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_daily_stats (
+            user_id BIGINT REFERENCES users(telegram_id),
+            day DATE,
+            water_total FLOAT DEFAULT 0,
+            last_weight FLOAT,
+            event_counts JSONB DEFAULT '{}',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, day)
+        );
+        """,
+    ], True),
+
+    # Consultas por usuário + tipo + período (histórico, backfill, DELETE por user_id)
+    (2, "Índice user_logs (user_id, log_type, created_at)", [
+        _create_index_concurrently(
+            "idx_user_logs_user_type_created",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_logs_user_type_created "
+            "ON user_logs (user_id, log_type, created_at)"
+        ),
+    ], False),
+
+    # Varredura de hidratação: todos os consolidados do dia
+    (3, "Índice user_daily_stats (day)", [
+        _create_index_concurrently(
+            "idx_user_daily_stats_day",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_daily_stats_day "
+            "ON user_daily_stats (day)"
+        ),
+    ], False),
+
+    # Biblioteca de planos pré-computados por faixa de perfil (plan_library)
+    (4, "Tabela plan_templates", [
+        """
+        CREATE TABLE IF NOT EXISTS plan_templates (
+            bucket TEXT PRIMARY KEY,
+            plan JSONB NOT NULL,
+            base_weight FLOAT,
+            source VARCHAR(20),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ], True),
+
+    # Scheduler particionado entre workers (app/sharding.py)
+    (5, "Tabelas de leases do scheduler e ledger de entregas", [
+        """
+        CREATE TABLE IF NOT EXISTS scheduler_workers (
+            worker_id TEXT PRIMARY KEY,
+            heartbeat_at TIMESTAMP NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS scheduler_leases (
+            partition INT PRIMARY KEY,
+            worker_id TEXT,
+            expires_at TIMESTAMP NOT NULL DEFAULT 'epoch'
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS delivery_ledger (
+            user_id BIGINT,
+            slot TIMESTAMP,
+            kind TEXT,
+            delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, slot, kind)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_delivery_ledger_slot ON delivery_ledger (slot);",
+    ], True),
+
+    # Fuso do usuário (checagem de hidratação no horário local); NULL = HYDRATION_DEFAULT_TZ
+    (6, "Coluna users.timezone", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS timezone VARCHAR(64);",
+    ], True),
+
+    # Checagem de hidratação: só lê os usuários cujo minuto da janela vence agora
+    # (a expressão precisa bater com a de database.get_hydration_laggards)
+    (7, "Índice users (minuto de hidratação)", [
+        _create_index_concurrently(
+            "idx_users_hydration_slot",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_hydration_slot "
+            "ON users (((telegram_id * 7919) % 1440))"
+        ),
+    ], False),
+
+    # O consolidado nasceu vazio (migração 1), mas água do dia e /api/history só
+    # leem dele: preenche com o histórico de user_logs no próprio upgrade
+    (8, "Backfill de user_daily_stats a partir de user_logs", [
+        BACKFILL_DAILY_STATS_SQL.format(user_filter=""),
+    ], True),
+
+    # Última mudança de peso/meta (Last-Modified do /api/history)
+    (9, "Coluna users.updated_at", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;",
+    ], True),
+
+    # Até que minuto cada partição já teve os lembretes varridos: quem assume a
+    # partição retoma dali (catch-up só após troca de dono ou tick perdido)
+    (10, "Coluna scheduler_leases.scanned_until", [
+        "ALTER TABLE scheduler_leases ADD COLUMN IF NOT EXISTS scanned_until TIMESTAMP;",
+    ], True),
+
+    # A checagem de hidratação passou a partir de users (migração 7) e nada mais
+    # filtra user_daily_stats só por dia: o índice da migração 3 só pesava no upsert
+    (11, "Remove índice user_daily_stats (day)", [
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_user_daily_stats_day",
+    ], False),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def _current_version(cur):
+    cur.execute("SELECT to_regclass('schema_migrations')")
+    if cur.fetchone()[0] is None:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cur.fetchone()[0]
+
+def _run_steps(cur, steps):
+    for step in steps:
+        if callable(step):
+            step(cur)
+        else:
+            cur.execute(step)
+
+def migrate(conn):
+    """
+    Aplica as migrações pendentes. Se o schema já está na última versão,
+    faz uma única leitura e não executa nenhum DDL.
+    Retorna a versão final do schema.
+    """
+    with conn.cursor() as cur:
+        version = _current_version(cur)
+    conn.rollback()
+    if version >= LATEST_VERSION:
+        return version
+
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+            try:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INT PRIMARY KEY,
+                        description TEXT,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+                # Outro processo pode ter migrado enquanto esperávamos o lock
+                version = _current_version(cur)
+                for number, description, steps, transactional in MIGRATIONS:
+                    if number <= version:
+                        continue
+                    print(f"DB: aplicando migração {number} - {description}")
+                    if transactional:
+                        conn.autocommit = False
+                        try:
+                            _run_steps(cur, steps)
+                            cur.execute(
+                                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                                (number, description)
+                            )
+                            conn.commit()
+                        except Exception:
+                            conn.rollback()
+                            raise
+                        finally:
+                            conn.autocommit = True
+                    else:
+                        _run_steps(cur, steps)
+                        cur.execute(
+                            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                            (number, description)
+                        )
+                    version = number
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+    finally:
+        conn.autocommit = False
+    return version
@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from .telegram_utils import retry_after_seconds
+
+# Despachante único das mensagens ativas (lembretes, hidratação, avisos de plano).
+# As mensagens entram numa fila limitada e saem por OUTBOX_CONCURRENCY envios em
+# paralelo, respeitando:
+# - um token bucket global (~30 msg/s, limite do Telegram por bot);
+# - um intervalo mínimo por chat (OUTBOX_CHAT_INTERVAL, ~1 msg/s por conversa);
+# - RetryAfter: pausa o bucket global pelo tempo pedido pelo Telegram e reenvia.
+# Respostas diretas a uma mensagem do usuário continuam saindo pelo handler.
+
+RATE = float(os.getenv("OUTBOX_RATE", 30))                   # msg/s globais
+BURST = int(os.getenv("OUTBOX_BURST", 30))
+CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL", 1.0))  # s entre mensagens do mesmo chat
+CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", 20))
+MAX_QUEUE = int(os.getenv("OUTBOX_MAX_QUEUE", 50000))
+MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", 3))
+DRAIN_TIMEOUT = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", 10))   # s esperando a fila esvaziar no shutdown
+LATENCY_SAMPLES = 1000
+
+
+class TokenBucket:
+    """Token bucket assíncrono; pause() suspende as saídas (RetryAfter global)."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_bot = None
+_queue = None
+_workers = []
+_bucket = None
+_chat_next = {}  # chat_id -> próximo instante livre para o chat
+_latencies = collections.deque(maxlen=LATENCY_SAMPLES)  # enfileirado -> entregue (s)
+_api_latencies = collections.deque(maxlen=LATENCY_SAMPLES)  # duração da chamada à API (s)
+_stats = {
+    "enqueued": 0, "sent": 0, "failed": 0, "retries": 0, "retry_after": 0,
+    "blocked": 0, "backpressure_waits": 0, "direct": 0,
+}
+
+async def _wait_chat_slot(chat_id):
+    # Reserva o próximo horário livre do chat antes de dormir: mensagens do
+    # mesmo chat em workers diferentes saem espaçadas e na ordem da fila.
+    now = time.monotonic()
+    slot = max(now, _chat_next.get(chat_id, 0.0))
+    _chat_next[chat_id] = slot + CHAT_INTERVAL
+    if slot > now:
+        await asyncio.sleep(slot - now)
+    if len(_chat_next) > 10000:
+        for key in [k for k, t in _chat_next.items() if t < now]:
+            del _chat_next[key]
+
+async def _deliver(chat_id, text, kwargs, enqueued_at):
+    """Envia com retries. Retorna True se entregou."""
+    for attempt in range(MAX_RETRIES + 1):
+        await _wait_chat_slot(chat_id)
+        await _bucket.acquire()
+        started = time.monotonic()
+        try:
+            await _bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            done = time.monotonic()
+            _api_latencies.append(done - started)
+            _latencies.append(done - enqueued_at)
+            _stats["sent"] += 1
+            return True
+        except RetryAfter as e:
+            # Flood control vale para o bot inteiro: segura todos os envios
+            _stats["retry_after"] += 1
+            _bucket.pause(retry_after_seconds(e))
+        except Forbidden:
+            # Usuário bloqueou o bot: não adianta tentar de novo
+            _stats["blocked"] += 1
+            return False
+        except BadRequest as e:
+            if kwargs.get("parse_mode") and "parse" in str(e).lower():
+                # Markdown inválido: reenvia como texto puro
+                kwargs = {k: v for k, v in kwargs.items() if k != "parse_mode"}
+            else:
+                print(f"Outbox: mensagem para {chat_id} recusada: {e}")
+                break
+        except (TimedOut, NetworkError) as e:
+            print(f"Outbox: falha de rede para {chat_id} (tentativa {attempt + 1}): {e}")
+            await asyncio.sleep(min(30, 2 ** attempt))
+        if attempt < MAX_RETRIES:
+            _stats["retries"] += 1
+    _stats["failed"] += 1
+    return False
+
+async def _worker():
+    while True:
+        item = await _queue.get()
+        try:
+            await _deliver(*item)
+        except Exception as e:
+            _stats["failed"] += 1
+            print(f"Outbox: erro inesperado ao enviar para {item[0]}: {e}")
+        finally:
+            _queue.task_done()
+
+async def send(chat_id, text, **kwargs):
+    """
+    Enfileira uma mensagem (kwargs vão para bot.send_message: parse_mode, reply_markup...).
+    Fila cheia = backpressure. Sem o despachante rodando (scripts), envia direto.
+    """
+    if not _workers:
+        _stats["direct"] += 1
+        if _bot is None:
+            raise RuntimeError("Outbox não iniciado")
+        await _bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        return
+    if _queue.full():
+        _stats["backpressure_waits"] += 1
+    await _queue.put((chat_id, text, kwargs, time.monotonic()))
+    _stats["enqueued"] += 1
+
+def start(bot):
+    """Inicia os workers no event loop atual."""
+    global _bot, _queue, _bucket
+    _bot = bot
+    if _workers:
+        return
+    _queue = asyncio.Queue(maxsize=MAX_QUEUE)
+    _bucket = TokenBucket(RATE, BURST)
+    loop = asyncio.get_running_loop()
+    _workers.extend(loop.create_task(_worker()) for _ in range(CONCURRENCY))
+
+async def stop():
+    """Espera a fila esvaziar (até OUTBOX_DRAIN_TIMEOUT) e para os workers."""
+    if not _workers:
+        return
+    try:
+        await asyncio.wait_for(_queue.join(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"Outbox: {_queue.qsize()} mensagens descartadas no shutdown")
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+def _percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 1)
+
+def stats():
+    return {
+        **_stats,
+        "queue_depth": _queue.qsize() if _queue else 0,
+        "workers": len(_workers),
+        "rate": RATE,
+        "paused_s": round(max(0.0, _bucket.paused_until - time.monotonic()), 1) if _bucket else 0.0,
+        "delivery_p50_ms": _percentile(_latencies, 0.5),
+        "delivery_p95_ms": _percentile(_latencies, 0.95),
+        "send_p50_ms": _percentile(_api_latencies, 0.5),
+        "send_p95_ms": _percentile(_api_latencies, 0.95),
+    }
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import time
+
+from .coach import generate_plan_section_async, CoachError, CoachCancelled
+from .repository import update_plan_section, apply_user_changes
+from . import outbox, plan_library
+
+# Geração do plano em segundo plano após o onboarding.
+# Dieta, treino e agenda são chamadas independentes ao LLM, feitas em paralelo,
+# cada uma com seus próprios retries. Cada seção é gravada assim que fica pronta
+# (o usuário já pode usar a dieta enquanto o treino ainda está sendo gerado) e
+# uma seção que falha não descarta as outras.
+# Perfis comuns são atendidos antes pela biblioteca de planos (plan_library),
+# sem chamada individual ao LLM.
+
+SECTION_RETRIES = int(os.getenv("PLAN_SECTION_RETRIES", 2))      # tentativas extras por seção
+RETRY_BACKOFF = float(os.getenv("PLAN_SECTION_RETRY_BACKOFF", 2))  # s, dobra a cada tentativa
+
+SECTION_NAMES = {"diet": "Dieta", "workout": "Treino", "schedule": "Horários"}
+
+_running = {}  # user_id -> asyncio.Task
+_stats = {"jobs": 0, "sections_ok": 0, "sections_failed": 0, "retries": 0, "total_s": 0.0}
+
+async def _generate_section(user_id, profile, section):
+    """Gera e grava uma seção, com retry. Retorna True se a seção foi salva."""
+    for attempt in range(SECTION_RETRIES + 1):
+        try:
+            # Sem user_id: a chamada não entra em coach._inflight, então um /cancel da
+            # conversa não derruba o plano (que só para por cancel(), ex: /reset)
+            value = await generate_plan_section_async(profile, section)
+            if await update_plan_section(user_id, section, value):
+                _stats["sections_ok"] += 1
+                return True
+            print(f"Falha ao gravar a seção '{section}' do usuário {user_id}")
+        except CoachCancelled:
+            raise
+        except CoachError as e:
+            print(f"Erro ao gerar a seção '{section}' do usuário {user_id} (tentativa {attempt + 1}): {e}")
+        if attempt < SECTION_RETRIES:
+            _stats["retries"] += 1
+            await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+    _stats["sections_failed"] += 1
+    return False
+
+async def generate_plan(user_id, profile, sections=("diet", "workout", "schedule")):
+    """Gera as seções em paralelo. Retorna a lista das seções que falharam."""
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *(_generate_section(user_id, profile, section) for section in sections),
+        return_exceptions=True
+    )
+    _stats["jobs"] += 1
+    _stats["total_s"] += time.monotonic() - started
+    if any(isinstance(r, CoachCancelled) for r in results):
+        raise CoachCancelled("Geração do plano cancelada")
+    return [section for section, ok in zip(sections, results) if ok is not True]
+
+async def _from_library(user_id, profile):
+    """Plano da biblioteca gravado de uma vez (plano + agenda). True se atendeu."""
+    plan = await plan_library.plan_for(profile)
+    if plan is None:
+        return False
+    return await apply_user_changes(user_id, plan=plan, reminders=plan.get('schedule', [])) is not None
+
+async def _run(chat_id, user_id, profile, reply_markup, use_library):
+    try:
+        if use_library and await _from_library(user_id, profile):
+            failed = []
+        else:
+            failed = await generate_plan(user_id, profile)
+    except (CoachCancelled, asyncio.CancelledError):
+        return
+    finally:
+        if _running.get(user_id) is asyncio.current_task():
+            _running.pop(user_id, None)
+
+    if not failed:
+        text = (
+            "🔥 *PLANO PRONTO!* 🔥\n\n"
+            "Seu protocolo exclusivo foi carregado.\n"
+            "Use o Menu abaixo para ver os detalhes."
+        )
+    elif len(failed) < len(SECTION_NAMES):
+        missing = ", ".join(SECTION_NAMES[s] for s in failed)
+        text = (
+            "⚠️ *Plano parcialmente pronto.*\n\n"
+            f"Não consegui gerar: {missing}.\n"
+            "O resto já está salvo. Use /plano para tentar de novo."
+        )
+    else:
+        text = (
+            "Tive um erro ao gerar o plano detalhado, mas seu perfil está salvo!\n"
+            "Use /plano para tentar novamente mais tarde."
+        )
+    await outbox.send(chat_id, text, reply_markup=reply_markup, parse_mode='Markdown')
+
+def start_plan_generation(application, chat_id, user_id, profile, reply_markup=None, use_library=True):
+    """
+    Agenda a geração do plano sem bloquear o handler.
+    use_library=False força a geração individual pelo LLM (pedido explícito de plano novo).
+    Retorna False se já existe uma geração em andamento para o usuário.
+    """
+    task = _running.get(user_id)
+    if task is not None and not task.done():
+        return False
+    _running[user_id] = application.create_task(
+        _run(chat_id, user_id, profile, reply_markup, use_library)
+    )
+    return True
+
+def cancel(user_id):
+    """Cancela a geração em andamento (ex: /reset). Retorna True se havia uma."""
+    task = _running.pop(user_id, None)
+    if task is None or task.done():
+        return False
+    task.cancel()
+    return True
+
+def is_generating(user_id):
+    task = _running.get(user_id)
+    return task is not None and not task.done()
+
+def stats():
+    jobs = _stats["jobs"]
+    return {
+        **_stats,
+        "running": sum(1 for t in _running.values() if not t.done()),
+        "avg_job_s": round(_stats["total_s"] / jobs, 2) if jobs else None,
+    }
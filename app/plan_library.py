@@ -0,0 +1,228 @@
+import asyncio
+import copy
+import os
+import re
+import unicodedata
+
+from .cache import TTLCache
+from .coach import generate_plan_section_async, CoachError
+from .repository import get_plan_template, save_plan_template
+
+# Biblioteca de planos pré-computados.
+# A maioria dos perfis cai em poucas faixas (altura × peso × objetivo ×
+# nível de atividade × nicho). Cada faixa tem um plano-modelo, gerado uma vez
+# (offline com precompute_plans.py ou na primeira vez que alguém cai nela) e
+# servido na hora com uma personalização determinística: nome do aluno e
+# porções (g/ml/kcal) escaladas pelo peso. O LLM só é chamado para perfis fora
+# das faixas (ver bucket_for) ou quando o usuário pede um plano novo (/plano).
+
+TEMPLATE_VERSION = "v1"  # mude ao alterar o prompt/formato: as faixas antigas deixam de ser usadas
+HEIGHT_STEP = 0.05       # m
+WEIGHT_STEP = 10         # kg
+HEIGHT_RANGE = (1.50, 2.00)
+WEIGHT_RANGE = (45, 140)
+MAX_GOAL_DELTA = 30      # kg entre peso atual e meta
+GOAL_STEPS = (2, 5, 10, 20, MAX_GOAL_DELTA)
+NICHES = ("Programador", "Executivo", "Geral")
+TEMPLATE_NAME = "{nome}"  # marcador do nome no plano-modelo
+
+_ACTIVITY_LEVELS = (
+    ("sedentario", "Sedentário (0x)"),
+    ("leve", "Leve (1-2x)"),
+    ("moderado", "Moderado (3-4x)"),
+    ("intenso", "Intenso (5-6x)"),
+    ("atleta", "Atleta (7x+)"),
+)
+_PORTION_RE = re.compile(r'(\d+(?:[.,]\d+)?)(\s*)(g|ml)\b', re.IGNORECASE)
+
+_templates = TTLCache(
+    maxsize=int(os.getenv("PLAN_LIBRARY_CACHE_SIZE", 500)),
+    ttl=float(os.getenv("PLAN_LIBRARY_CACHE_TTL", 86400))
+)
+_filling = {}  # faixa -> Task do preenchimento em andamento (um por faixa)
+_stats = {"hits": 0, "db_hits": 0, "lazy_fills": 0, "fill_failures": 0, "unusual": 0}
+
+def _normalize(text):
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode()
+    return text.lower()
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _band(value, step):
+    return int(value // step) * step
+
+def _activity_key(activity_level):
+    text = _normalize(activity_level)
+    for key, _ in _ACTIVITY_LEVELS:
+        if key in text:
+            return key
+    return None
+
+def _goal_band(delta):
+    direction = "manter" if abs(delta) < GOAL_STEPS[0] else ("perder" if delta < 0 else "ganhar")
+    if direction == "manter":
+        return direction, 0
+    for step in GOAL_STEPS[1:]:
+        if abs(delta) <= step:
+            return direction, step
+    return direction, MAX_GOAL_DELTA
+
+def bucket_for(profile):
+    """
+    Faixa do perfil na biblioteca (string estável) ou None para perfis fora do
+    comum, que seguem para a geração individual pelo LLM.
+    """
+    height = _to_float(profile.get('height'))
+    weight = _to_float(profile.get('weight_current', profile.get('weight')))
+    target = _to_float(profile.get('weight_target', profile.get('target_weight')))
+    if height is None or weight is None or target is None:
+        return None
+    if height > 3:
+        height /= 100  # altura digitada em cm
+    activity = _activity_key(profile.get('activity_level'))
+    niche = profile.get('niche')
+    preferences = profile.get('preferences') or {}
+
+    if not (HEIGHT_RANGE[0] <= height < HEIGHT_RANGE[1]):
+        return None
+    if not (WEIGHT_RANGE[0] <= weight < WEIGHT_RANGE[1]):
+        return None
+    if abs(target - weight) > MAX_GOAL_DELTA or activity is None or niche not in NICHES:
+        return None
+    if preferences and preferences != "{}":
+        # Preferências/personalidade própria pedem um plano sob medida
+        return None
+
+    direction, goal = _goal_band(target - weight)
+    height_cm = int(round(height * 100)) // int(HEIGHT_STEP * 100) * int(HEIGHT_STEP * 100)
+    return f"{TEMPLATE_VERSION}|h{height_cm}|w{_band(weight, WEIGHT_STEP)}|{direction}{goal}|{activity}|{niche}"
+
+def template_profile(bucket):
+    """Perfil representativo da faixa (valores do meio da faixa), usado para gerar o modelo."""
+    _, height, weight, goal, activity, niche = bucket.split("|")
+    height = (int(height[1:]) + HEIGHT_STEP * 100 / 2) / 100
+    weight = int(weight[1:]) + WEIGHT_STEP / 2
+    direction = goal.rstrip("0123456789")
+    delta = int(goal[len(direction):]) * 0.75
+    target = weight - delta if direction == "perder" else weight + delta if direction == "ganhar" else weight
+    return {
+        'name': TEMPLATE_NAME,
+        'height': round(height, 3),
+        'weight_current': weight,
+        'weight_target': round(target, 1),
+        'activity_level': dict(_ACTIVITY_LEVELS)[activity],
+        'niche': niche,
+        'preferences': {},
+    }
+
+# --- Personalização determinística ---
+
+def _scale_text(text, ratio):
+    def scale(match):
+        amount = float(match.group(1).replace(',', '.')) * ratio
+        # Porções arredondadas de 5 em 5 (g/ml)
+        return f"{max(5, int(round(amount / 5)) * 5)}{match.group(2)}{match.group(3)}"
+    return _PORTION_RE.sub(scale, text)
+
+def _fill_name(value, name):
+    if isinstance(value, str):
+        return value.replace(TEMPLATE_NAME, name)
+    if isinstance(value, list):
+        return [_fill_name(v, name) for v in value]
+    if isinstance(value, dict):
+        return {k: _fill_name(v, name) for k, v in value.items()}
+    return value
+
+def personalize(plan, profile, base_weight):
+    """Aplica nome e porções proporcionais ao peso do usuário sobre uma cópia do modelo."""
+    plan = copy.deepcopy(plan)
+    weight = _to_float(profile.get('weight_current', profile.get('weight')))
+    ratio = weight / base_weight if weight and base_weight else 1.0
+    if abs(ratio - 1) >= 0.02:
+        for meal in plan.get('diet', []):
+            meal['foods'] = [_scale_text(food, ratio) for food in meal.get('foods', [])]
+            calories = _to_float(meal.get('calories'))
+            if calories:
+                meal['calories'] = int(round(calories * ratio / 10)) * 10
+    return _fill_name(plan, profile.get('name') or "Atleta")
+
+# --- Modelos ---
+
+async def generate_template(bucket):
+    """Gera o plano-modelo da faixa (três seções em paralelo). None em falha."""
+    profile = template_profile(bucket)
+    sections = ("diet", "workout", "schedule")
+    results = await asyncio.gather(
+        *(generate_plan_section_async(profile, section) for section in sections),
+        return_exceptions=True
+    )
+    for section, result in zip(sections, results):
+        if isinstance(result, BaseException):
+            print(f"Erro ao gerar modelo {bucket} ({section}): {result}")
+            return None
+    return dict(zip(sections, results))
+
+async def _fill(bucket, source):
+    plan = await generate_template(bucket)
+    if plan is None:
+        _stats["fill_failures"] += 1
+        return None
+    template = {"plan": plan, "base_weight": template_profile(bucket)['weight_current']}
+    await save_plan_template(bucket, plan, template["base_weight"], source)
+    _stats["lazy_fills"] += 1
+    return template
+
+async def get_template(bucket, fill=True, source="lazy"):
+    """Modelo da faixa: memória -> banco -> geração (uma só por faixa, mesmo com pedidos simultâneos)."""
+    template = _templates.get(bucket)
+    if template is not None:
+        return template
+    template = await get_plan_template(bucket)
+    if template is not None:
+        _stats["db_hits"] += 1
+    elif fill:
+        task = _filling.get(bucket)
+        if task is None:
+            task = asyncio.ensure_future(_fill(bucket, source))
+            _filling[bucket] = task
+            task.add_done_callback(lambda _: _filling.pop(bucket, None))
+        template = await asyncio.shield(task)
+    if template is not None:
+        _templates.set(bucket, template)
+    return template
+
+async def plan_for(profile):
+    """
+    Plano personalizado vindo da biblioteca, ou None quando o perfil é incomum
+    ou o modelo não pôde ser gerado (o chamador cai na geração individual).
+    """
+    bucket = bucket_for(profile)
+    if bucket is None:
+        _stats["unusual"] += 1
+        return None
+    try:
+        template = await get_template(bucket)
+    except CoachError as e:
+        print(f"Erro na biblioteca de planos ({bucket}): {e}")
+        template = None
+    if template is None:
+        return None
+    _stats["hits"] += 1
+    return personalize(template["plan"], profile, template["base_weight"])
+
+def stats():
+    served = _stats["hits"]
+    requests = served + _stats["unusual"] + _stats["fill_failures"]
+    return {
+        **_stats,
+        "cached_templates": len(_templates),
+        "filling": len(_filling),
+        # Fração das gerações de plano atendidas pela biblioteca (sem LLM por usuário)
+        "hit_rate": round(served / requests, 3) if requests else None,
+        # Das atendidas, quantas já tinham modelo pronto (sem nenhuma chamada ao LLM)
+        "ready_rate": round((served - _stats["lazy_fills"]) / served, 3) if served else None,
+    }
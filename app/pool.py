@@ -0,0 +1,166 @@
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Conexão com metadados do pool (statements preparados, último uso)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+class PoolTimeout(Exception):
+    """Nenhuma conexão ficou livre dentro do prazo de checkout."""
+
+
+class ConnectionPool:
+    """
+    Pool thread-safe de conexões PostgreSQL.
+    - min_size conexões abertas no boot, até max_size sob carga.
+    - Conexões ociosas além de idle_timeout são fechadas (mantendo min_size).
+    - Health check (SELECT 1) no checkout se a conexão ficou parada mais que health_check_after.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, idle_timeout=300.0,
+                 health_check_after=30.0, checkout_timeout=10.0):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.checkout_timeout = checkout_timeout
+
+        self._idle = []  # LIFO: a mais recente é a mais "quente"
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "health_checks": 0,
+            "idle_closed": 0,
+        }
+
+        for _ in range(self.min_size):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection)
+        self._stats["created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        self._stats["discarded"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used < self.health_check_after:
+            return True
+        self._stats["health_checks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _reap_idle(self):
+        """Fecha conexões ociosas há mais de idle_timeout (chamado com o lock)."""
+        if not self.idle_timeout:
+            return
+        now = time.monotonic()
+        keep = []
+        # _idle[0] é a mais antiga
+        for conn in self._idle:
+            total = len(keep) + self._in_use
+            if now - conn.last_used > self.idle_timeout and total >= self.min_size:
+                self._stats["idle_closed"] += 1
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            else:
+                keep.append(conn)
+        self._idle = keep
+
+    def getconn(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._cond:
+            if self._closed:
+                raise PoolTimeout("Pool fechado")
+            self._reap_idle()
+            while not self._idle and self._in_use >= self.max_size:
+                self._stats["waits"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"Sem conexões livres após {self.checkout_timeout}s")
+            conn = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+
+        # I/O (health check / connect) fora do lock
+        try:
+            if conn is not None and not self._is_healthy(conn):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, broken=False):
+        if not broken and not conn.closed:
+            try:
+                # Nunca devolver conexão com transação aberta/abortada
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                broken = True
+
+        with self._cond:
+            self._in_use -= 1
+            if broken or conn.closed or self._closed:
+                self._discard(conn)
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for conn in self._idle:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                **self._stats,
+            }
@@ -0,0 +1,165 @@
+import json
+import os
+import re
+import unicodedata
+
+# Montagem com orçamento de tokens das seções do perfil no system prompt.
+# Só as seções relevantes para a mensagem (dieta / treino / agenda) entram
+# completas; as demais entram compactadas (só nomes) ou saem, até caber em
+# PROMPT_TOKEN_BUDGET.
+
+TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 1200))  # tokens para as seções do perfil
+PREFERENCE_MAX_CHARS = 200
+
+# Ordem de descarte quando o orçamento aperta (primeiro = menos importante)
+SECTION_ORDER = ("context", "schedule", "workout", "diet")
+
+_TOPIC_KEYWORDS = {
+    "diet": (
+        "dieta", "comida", "comer", "comi", "refeicao", "cafe", "almoco", "jantar", "lanche",
+        "ceia", "caloria", "kcal", "proteina", "carbo", "gordura", "macro", "troca", "troque",
+        "alimento", "fome", "receita", "foto", "imagem", "prato",
+    ),
+    "workout": (
+        "treino", "treinar", "exercicio", "academia", "musculacao", "serie", "repeticao",
+        "supino", "agachamento", "corrida", "cardio", "perna", "costas", "peito", "braco",
+        "ombro", "abdomen", "descanso",
+    ),
+    "schedule": (
+        "horario", "hora", "lembrete", "agenda", "avisa", "avise", "mude", "mudar", "muda",
+        "acordo", "durmo",
+    ),
+}
+# Casamento por início de palavra ("treino" pega "treinos", mas "hora" não pega "melhora")
+_TOPIC_PATTERNS = {
+    topic: re.compile(r'\b(?:' + "|".join(words) + r')')
+    for topic, words in _TOPIC_KEYWORDS.items()
+}
+_TIME_RE = re.compile(r'\b\d{1,2}(:\d{2}|h)\b')
+
+def estimate_tokens(text):
+    """Estimativa barata (~4 caracteres por token, média dos modelos Gemini em PT-BR)."""
+    return (len(text) + 3) // 4
+
+def _normalize(text):
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode()
+    return text.lower()
+
+def detect_topics(user_message):
+    """Seções do plano relevantes para a mensagem. None = sem mensagem (considera tudo relevante)."""
+    if user_message is None:
+        return set(SECTION_ORDER)
+    text = _normalize(user_message)
+    topics = {topic for topic, pattern in _TOPIC_PATTERNS.items() if pattern.search(text)}
+    if _TIME_RE.search(text):
+        topics.add("schedule")
+    return topics
+
+def _load(value, default):
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return default
+    return value if value else default
+
+# --- Renderização das seções (completa / compacta) ---
+
+def _render_context(profile, full):
+    preferences = _load(profile.get('preferences'), {})
+    if not isinstance(preferences, dict) or not preferences:
+        return ""
+    out = "\nCONTEXTO & MEMÓRIA:\n"
+    for k, v in preferences.items():
+        v = str(v)
+        if not full and len(v) > PREFERENCE_MAX_CHARS:
+            v = v[:PREFERENCE_MAX_CHARS] + "..."
+        out += f"- {k}: {v}\n"
+    return out
+
+def _render_schedule(profile, full):
+    reminders = _load(profile.get('reminders'), [])
+    if not isinstance(reminders, list) or not reminders:
+        return ""
+    if full:
+        out = "\nAGENDA ATUAL:\n"
+        for r in reminders:
+            out += f"- {r.get('label')}: {r.get('time')}\n"
+        return out
+    items = ", ".join(f"{r.get('label')} {r.get('time')}" for r in reminders)
+    return f"\nAGENDA ATUAL (resumo): {items}\n"
+
+def _render_diet(profile, full):
+    diet = _load(profile.get('generated_plan'), {}).get('diet', [])
+    if not diet:
+        return ""
+    if full:
+        out = "\nDIETA ATUAL:\n"
+        for meal in diet:
+            foods = ", ".join(meal.get('foods', []))
+            out += f"- {meal.get('meal')}: {foods}\n"
+        return out
+    meals = ", ".join(str(meal.get('meal')) for meal in diet)
+    return f"\nDIETA ATUAL (resumo, {len(diet)} refeições): {meals}\n"
+
+def _render_workout(profile, full):
+    workout = _load(profile.get('generated_plan'), {}).get('workout', {})
+    if not workout:
+        return ""
+    if full:
+        out = f"\nTREINO ATUAL ({workout.get('split', 'Geral')}):\n"
+        for day in workout.get('days', []):
+            exercises = ", ".join(day.get('exercises', []))
+            out += f"- {day.get('day')}: {exercises}\n"
+        return out
+    days = ", ".join(f"{d.get('day')} ({d.get('focus', '')})".replace(" ()", "") for d in workout.get('days', []))
+    return f"\nTREINO ATUAL (resumo, {workout.get('split', 'Geral')}): {days}\n"
+
+_RENDERERS = {
+    "context": _render_context,
+    "schedule": _render_schedule,
+    "diet": _render_diet,
+    "workout": _render_workout,
+}
+
+def build_sections(profile, user_message=None, budget=TOKEN_BUDGET):
+    """
+    Monta as seções do perfil dentro do orçamento.
+    Retorna (dict seção -> texto, modos: dict seção -> 'full'|'compact'|'dropped', tokens).
+    """
+    relevant = detect_topics(user_message)
+    # Preferências (memória/personalidade custom) valem para qualquer mensagem
+    relevant.add("context")
+    modes = {name: ("full" if name in relevant else "compact") for name in SECTION_ORDER}
+    rendered = {name: _RENDERERS[name](profile, modes[name] == "full") for name in SECTION_ORDER}
+
+    def total():
+        return sum(estimate_tokens(text) for text in rendered.values())
+
+    # 1. Remove as seções não relevantes (já compactas)
+    for name in SECTION_ORDER:
+        if total() <= budget:
+            break
+        if name not in relevant and rendered[name]:
+            modes[name] = "dropped"
+            rendered[name] = ""
+    # 2. Compacta as relevantes, da menos para a mais importante
+    for name in SECTION_ORDER:
+        if total() <= budget:
+            break
+        if modes[name] == "full":
+            modes[name] = "compact"
+            rendered[name] = _RENDERERS[name](profile, False)
+    # 3. Último recurso: corta o texto restante
+    for name in SECTION_ORDER:
+        excess = total() - budget
+        if excess <= 0:
+            break
+        text = rendered[name]
+        if text:
+            keep = max(0, len(text) - excess * 4 - 4)
+            rendered[name] = text[:keep] + "...\n" if keep else ""
+            if not rendered[name]:
+                modes[name] = "dropped"
+
+    return rendered, modes, total()
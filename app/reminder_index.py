@@ -0,0 +1,125 @@
+import itertools
+import json
+import threading
+
+# Índice residente dos lembretes: "HH:MM" -> {chat_id: [lembrete, ...]}
+# Montado no boot a partir do banco e atualizado in-place pelas escritas
+# (update_reminders / delete_user_data), inclusive as de outros processos
+# (app/change_feed.py). O ticker só faz um lookup por minuto.
+_lock = threading.Lock()
+_by_minute = {}
+_by_user = {}  # chat_id -> set("HH:MM") para remoção rápida
+_ready = False
+# Escritas ocorridas durante cada rebuild em andamento: token -> {chat_id: lembretes ou None}.
+# Um por rebuild: rebuilds sobrepostos não apagam as escritas uns dos outros.
+_pending = {}
+_tokens = itertools.count(1)
+
+def _normalize_time(value):
+    """'8:00' -> '08:00'. Valores inválidos retornam None."""
+    if not isinstance(value, str):
+        return None
+    try:
+        hour, minute = value.strip().split(":")[:2]
+        hour, minute = int(hour), int(minute)
+    except ValueError:
+        return None
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        return None
+    return f"{hour:02d}:{minute:02d}"
+
+def _parse(reminders):
+    if isinstance(reminders, str):
+        try:
+            reminders = json.loads(reminders)
+        except ValueError:
+            return []
+    return reminders if isinstance(reminders, list) else []
+
+def _remove_locked(chat_id):
+    for minute in _by_user.pop(chat_id, ()):
+        bucket = _by_minute.get(minute)
+        if bucket is not None:
+            bucket.pop(chat_id, None)
+            if not bucket:
+                del _by_minute[minute]
+
+def _add_locked(chat_id, reminders):
+    minutes = set()
+    for item in _parse(reminders):
+        if not isinstance(item, dict):
+            continue
+        minute = _normalize_time(item.get('time'))
+        if not minute:
+            continue
+        _by_minute.setdefault(minute, {}).setdefault(chat_id, []).append(item)
+        minutes.add(minute)
+    if minutes:
+        _by_user[chat_id] = minutes
+
+def set_user_reminders(chat_id, reminders):
+    """Substitui os lembretes indexados de um usuário."""
+    with _lock:
+        _remove_locked(chat_id)
+        _add_locked(chat_id, reminders)
+        for writes in _pending.values():
+            writes[chat_id] = reminders
+
+def remove_user(chat_id):
+    with _lock:
+        _remove_locked(chat_id)
+        for writes in _pending.values():
+            writes[chat_id] = None
+
+def begin_rebuild():
+    """
+    Marca o início da leitura do banco; escritas a partir daqui são reaplicadas no
+    rebuild. Retorna o token a passar para rebuild() ou abort_rebuild().
+    """
+    with _lock:
+        token = next(_tokens)
+        _pending[token] = {}
+        return token
+
+def abort_rebuild(token):
+    """Descarta um rebuild que não vai terminar (falha na leitura do banco)."""
+    with _lock:
+        _pending.pop(token, None)
+
+def rebuild(token, users):
+    """Reconstrói o índice inteiro (boot e rede de segurança periódica)."""
+    global _by_minute, _by_user, _ready
+    with _lock:
+        writes = _pending.pop(token, {})
+        _by_minute, _by_user = {}, {}
+        for user in users:
+            _add_locked(user['telegram_id'], user.get('reminders'))
+        # Escritas concorrentes à leitura são mais novas que o snapshot
+        for chat_id, reminders in writes.items():
+            _remove_locked(chat_id)
+            if reminders is not None:
+                _add_locked(chat_id, reminders)
+        _ready = True
+
+def is_ready():
+    return _ready
+
+def invalidate():
+    """Força reconstrução no próximo tick (mudanças de outro processo podem ter se perdido)."""
+    global _ready
+    with _lock:
+        _ready = False
+
+def due_at(current_time):
+    """Lista de (chat_id, lembrete) marcados para 'HH:MM'."""
+    with _lock:
+        bucket = _by_minute.get(current_time, {})
+        return [(chat_id, item) for chat_id, items in bucket.items() for item in items]
+
+def stats():
+    with _lock:
+        return {
+            "users": len(_by_user),
+            "minutes": len(_by_minute),
+            "reminders": sum(len(items) for bucket in _by_minute.values() for items in bucket.values()),
+        }
@@ -0,0 +1,151 @@
+import os
+import re
+import time
+
+from telegram import Update
+from telegram.error import BadRequest, RetryAfter
+
+from .telegram_utils import retry_after_seconds
+from .coach import (
+    think_as_coach_async, stream_coach_reply, run_for_user,
+    CoachError, CoachTimeout, CoachCancelled
+)
+
+# Envio das respostas do coach para o Telegram.
+# No modo streaming a primeira mensagem sai assim que chega a primeira frase
+# e é editada em incrementos espaçados (limite de edições do Telegram).
+
+STREAMING = os.getenv("COACH_STREAMING", "1") == "1"
+STREAM_TIMEOUT = float(os.getenv("COACH_STREAM_TIMEOUT", 120))
+EDIT_INTERVAL = float(os.getenv("COACH_STREAM_EDIT_INTERVAL", 1.5))  # s entre edições
+EDIT_MIN_CHARS = int(os.getenv("COACH_STREAM_EDIT_MIN_CHARS", 40))
+FIRST_MESSAGE_MIN_CHARS = 200  # sem fim de frase, publica ao atingir esse tamanho
+TELEGRAM_LIMIT = 4096
+
+ERROR_MSG = "⚠️ Meu cérebro neural deu uma travada. Tenta de novo daqui a pouco!"
+TIMEOUT_MSG = "⏳ Demorei demais pra pensar nessa... Tenta de novo em instantes?"
+
+_COMPLETE_TOKEN = re.compile(r'\[\[.*?\]\]', re.DOTALL)
+_SENTENCE_END = re.compile(r'[.!?…]\s|\n')
+
+_stats = {"streams": 0, "first_message_total_s": 0.0, "edits": 0, "edit_throttled": 0}
+
+def visible_text(text):
+    """Texto exibível durante o streaming: sem tokens [[...]] (completos ou ainda abertos)."""
+    text = _COMPLETE_TOKEN.sub("", text)
+    cut = text.find("[[")
+    if cut != -1:
+        text = text[:cut]
+    return text.strip()
+
+def _notice_for(error):
+    return TIMEOUT_MSG if isinstance(error, CoachTimeout) else ERROR_MSG
+
+async def ask_coach(update: Update, user_text, profile, media_data=None, media_type=None):
+    """Chama o coach. Em falha avisa o usuário e retorna None (nunca devolve erro como resposta)."""
+    try:
+        return await think_as_coach_async(user_text, profile, media_data=media_data, media_type=media_type)
+    except CoachCancelled:
+        return None
+    except CoachError as e:
+        print(f"Erro no coach para {profile.get('telegram_id')}: {e}")
+        await update.message.reply_text(_notice_for(e))
+    return None
+
+async def _consume_stream(update, chunks, reply_markup, state):
+    started = time.monotonic()
+    async for chunk in chunks:
+        state['text'] += chunk
+        visible = visible_text(state['text'])[:TELEGRAM_LIMIT]
+        now = time.monotonic()
+
+        if state['message'] is None:
+            if visible and (_SENTENCE_END.search(visible) or len(visible) >= FIRST_MESSAGE_MIN_CHARS):
+                state['message'] = await update.message.reply_text(visible, reply_markup=reply_markup)
+                state['shown'] = visible
+                state['next_edit'] = now + EDIT_INTERVAL
+                _stats["streams"] += 1
+                _stats["first_message_total_s"] += now - started
+            continue
+
+        if len(visible) - len(state['shown']) < EDIT_MIN_CHARS:
+            continue
+        if now < state['next_edit']:
+            _stats["edit_throttled"] += 1
+            continue
+        try:
+            await state['message'].edit_text(visible)
+            state['shown'] = visible
+            _stats["edits"] += 1
+            state['next_edit'] = now + EDIT_INTERVAL
+        except RetryAfter as e:
+            # Respeita o backoff pedido pelo Telegram; o texto final chega no fim
+            state['next_edit'] = now + retry_after_seconds(e)
+        except BadRequest:
+            state['next_edit'] = now + EDIT_INTERVAL
+
+async def stream_coach(update: Update, user_text, profile, reply_markup=None, media_data=None, media_type=None):
+    """
+    Resposta do coach em streaming, publicada e editada progressivamente.
+    Retorna (texto_completo, mensagem_publicada_ou_None); (None, None) em falha
+    (o usuário já foi avisado). O texto completo ainda contém os tokens [[...]].
+    """
+    state = {'text': "", 'message': None, 'shown': "", 'next_edit': 0.0}
+    chunks = stream_coach_reply(user_text, profile, media_data=media_data, media_type=media_type)
+    try:
+        await run_for_user(
+            profile.get('telegram_id'),
+            _consume_stream(update, chunks, reply_markup, state),
+            STREAM_TIMEOUT
+        )
+        return state['text'], state['message']
+    except CoachCancelled:
+        return None, None
+    except CoachError as e:
+        print(f"Erro no coach (stream) para {profile.get('telegram_id')}: {e}")
+        notice = _notice_for(e)
+        if state['message'] is not None:
+            try:
+                await state['message'].edit_text(f"{state['shown']}\n\n{notice}"[:TELEGRAM_LIMIT])
+            except BadRequest:
+                pass
+        else:
+            await update.message.reply_text(notice)
+        return None, None
+
+async def finalize_reply(update: Update, message, text, reply_markup=None):
+    """Publica o texto final (Markdown): edita a mensagem do streaming ou envia uma nova."""
+    text = text[:TELEGRAM_LIMIT]
+    if message is None:
+        try:
+            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        except BadRequest:
+            # Markdown inválido vindo do modelo: envia como texto puro
+            await update.message.reply_text(text, reply_markup=reply_markup)
+        return
+    try:
+        await message.edit_text(text, parse_mode='Markdown')
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return
+        try:
+            await message.edit_text(text)
+        except BadRequest:
+            pass
+
+async def coach_reply(update: Update, user_text, profile, reply_markup=None, media_data=None, media_type=None):
+    """
+    Ponto único para obter a resposta do coach (streaming ou não).
+    Retorna (texto, mensagem_ou_None) ou (None, None) em falha.
+    """
+    if STREAMING:
+        return await stream_coach(update, user_text, profile, reply_markup, media_data, media_type)
+    response = await ask_coach(update, user_text, profile, media_data, media_type)
+    return response, None
+
+def stats():
+    streams = _stats["streams"]
+    return {
+        **_stats,
+        "avg_time_to_first_message_s": round(_stats["first_message_total_s"] / streams, 3) if streams else None,
+    }
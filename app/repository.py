@@ -0,0 +1,58 @@
+# API assíncrona do banco de dados.
+# Espelha app/database.py rodando cada chamada num executor dedicado (do tamanho
+# do pool de conexões), para não travar o event loop compartilhado entre bot,
+# scheduler e API. As funções síncronas continuam disponíveis para scripts.
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import database
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DB_POOL_MAX", 10)),
+    thread_name_prefix="db"
+)
+
+async def run_db(func, *args, **kwargs):
+    """Executa uma função síncrona de banco no executor dedicado."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def _async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+init_db = _async(database.init_db)
+create_or_update_user = _async(database.create_or_update_user)
+get_user_profile = _async(database.get_user_profile)
+save_log = _async(database.save_log)
+save_logs_batch = _async(database.save_logs_batch)
+update_user_plan = _async(database.update_user_plan)
+update_plan_section = _async(database.update_plan_section)
+apply_user_changes = _async(database.apply_user_changes)
+get_user_plan = _async(database.get_user_plan)
+update_reminders = _async(database.update_reminders)
+get_reminders = _async(database.get_reminders)
+delete_user_data = _async(database.delete_user_data)
+get_all_users = _async(database.get_all_users)
+get_all_user_reminders = _async(database.get_all_user_reminders)
+get_daily_water_total = _async(database.get_daily_water_total)
+get_user_timezones = _async(database.get_user_timezones)
+get_hydration_laggards = _async(database.get_hydration_laggards)
+update_user_timezone = _async(database.update_user_timezone)
+update_user_weight = _async(database.update_user_weight)
+get_user_history = _async(database.get_user_history)
+get_plan_template = _async(database.get_plan_template)
+save_plan_template = _async(database.save_plan_template)
+heartbeat_leases = _async(database.heartbeat_leases)
+release_leases = _async(database.release_leases)
+claim_deliveries = _async(database.claim_deliveries)
+get_scan_marks = _async(database.get_scan_marks)
+set_scan_marks = _async(database.set_scan_marks)
+prune_deliveries = _async(database.prune_deliveries)
+
+def shutdown():
+    _executor.shutdown(wait=True)
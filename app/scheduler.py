@@ -1,80 +1,196 @@
 from telegram.ext import ContextTypes
 import datetime
-import json
-from .database import get_all_users, get_daily_water_total
+import os
+import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from .database import HYDRATION_SLOTS
+from .repository import get_all_user_reminders, get_hydration_laggards, get_user_timezones, prune_deliveries
+from . import outbox, reminder_index, sharding
+
+def _window_start():
+    hour, minute = os.getenv("HYDRATION_WINDOW_START", "13:00").split(":")
+    return int(hour) * 60 + int(minute)
+
+# Checagem de hidratação espalhada numa janela do horário local de cada usuário
+# (minuto fixo por usuário), em vez de um pico único às 14:00 do servidor.
+HYDRATION_WINDOW_START = _window_start()                                     # minuto do dia (local)
+HYDRATION_WINDOW_MINUTES = int(os.getenv("HYDRATION_WINDOW_MINUTES", 180))
+HYDRATION_DEFAULT_TZ = os.getenv("HYDRATION_DEFAULT_TZ", "America/Sao_Paulo")  # usuários sem fuso salvo
+HYDRATION_CATCHUP_MINUTES = 5  # ticks atrasados ainda pegam quem venceu há pouco
+HYDRATION_TZ_REFRESH = int(os.getenv("HYDRATION_TZ_REFRESH_SECONDS", 600))  # releitura dos fusos em uso
+# Limite do catch-up de lembretes: após tick atrasado ou troca de dono da partição
+# (devolução + próximo heartbeat, ou TTL de um worker morto), varre a partir da
+# marca scanned_until, mas no máximo estes minutos para trás. O ledger evita duplicatas.
+REMINDER_CATCHUP_MINUTES = int(os.getenv(
+    "REMINDER_CATCHUP_MINUTES", max(5, -(-(sharding.LEASE_TTL + sharding.LEASE_RENEW) // 60) + 1)
+))
+
+_timezones = {"names": [], "loaded_at": None}
+
+async def _timezones_in_use():
+    now = time.monotonic()
+    if _timezones["loaded_at"] is None or now - _timezones["loaded_at"] > HYDRATION_TZ_REFRESH:
+        names = await get_user_timezones()
+        if names is not None:
+            _timezones["names"], _timezones["loaded_at"] = names, now
+    return _timezones["names"]
+
+def _zone(name):
+    # Fuso salvo que não existe mais (ou inválido): vale o padrão, sem derrubar a checagem
+    for candidate in (name, HYDRATION_DEFAULT_TZ):
+        try:
+            return ZoneInfo(candidate)
+        except (ZoneInfoNotFoundError, ValueError):
+            continue
+    return datetime.timezone.utc
+
+def hydration_slots(timezones, now_utc):
+    """
+    Para cada fuso com checagens vencendo agora: (fuso, data local, meia-noite
+    local, chave_min, chave_max). A chave k (0..HYDRATION_SLOTS-1) de cada usuário
+    vira o minuto k * janela // HYDRATION_SLOTS da janela; vencem os minutos entre
+    agora - HYDRATION_CATCHUP_MINUTES e agora. Fora da janela não há nada a consultar.
+    """
+    window = max(1, min(HYDRATION_WINDOW_MINUTES, HYDRATION_SLOTS))
+    slots = []
+    for name in {HYDRATION_DEFAULT_TZ, *timezones}:
+        local = now_utc.astimezone(_zone(name))
+        elapsed = local.hour * 60 + local.minute - HYDRATION_WINDOW_START
+        first, last = max(0, elapsed - HYDRATION_CATCHUP_MINUTES), min(window - 1, elapsed)
+        if first > last:
+            continue
+        key_lo = -(-first * HYDRATION_SLOTS // window)
+        key_hi = -(-(last + 1) * HYDRATION_SLOTS // window) - 1
+        midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        slots.append((name, local.date(), midnight, key_lo, key_hi))
+    return slots
 
 async def check_hydration(context: ContextTypes.DEFAULT_TYPE):
     """
-    Roda as 14:00 diariamente.
-    Verifica se o usuário bebeu pelo menos 50% da meta de água.
+    Roda a cada minuto.
+    Avisa quem bebeu menos de 50% da meta de água, no minuto da janela
+    sorteado (de forma fixa) para cada usuário, no fuso dele.
     Meta = Peso * 35ml
     """
-    users = get_all_users()
-    for user in users:
-        try:
-            user_id = user['telegram_id']
-            weight = user.get('weight')
-            
-            if not weight: continue # Sem peso, sem meta
-            
-            target = weight * 35 # ML
-            half_target = target / 2
-            
-            current = get_daily_water_total(user_id)
-            
-            if current < half_target:
-                msg = (
-                    f"⚠️ *Alerta de Hidratação*\n\n"
-                    f"Já passamos da metade do dia e você bebeu apenas *{int(current)}ml*.\n"
-                    f"Sua meta diária é *{int(target)}ml*.\n\n"
-                    f"💡 Beba 500ml agora para compensar!"
-                )
-                await context.bot.send_message(chat_id=user_id, text=msg, parse_mode='Markdown')
-        except Exception as e:
-            print(f"Erro no check de hidratação para {user.get('name')}: {e}")
+    owned = sharding.owned_partitions()
+    if not owned:
+        return
+    slots = hydration_slots(await _timezones_in_use(), datetime.datetime.now(datetime.timezone.utc))
+    if not slots:
+        return # Nenhum fuso dentro da janela agora
+    users = await get_hydration_laggards(
+        slots, ratio=0.5, partitions=owned, partition_count=sharding.PARTITIONS,
+        default_tz=HYDRATION_DEFAULT_TZ
+    )
+    if not users:
+        return
+    keys = [
+        (user['telegram_id'], datetime.datetime.combine(user['day'], datetime.time()), "hydration")
+        for user in users
+    ]
+    claimed = await sharding.claim(keys)
+    if claimed is None:
+        return
+    for key, user in zip(keys, users):
+        if key not in claimed:
+            continue # Já avisado hoje (tick anterior ou outro worker)
+        msg = (
+            f"⚠️ *Alerta de Hidratação*\n\n"
+            f"Já passamos da metade do dia e você bebeu apenas *{int(user['current'])}ml*.\n"
+            f"Sua meta diária é *{int(user['target'])}ml*.\n\n"
+            f"💡 Beba 500ml agora para compensar!"
+        )
+        # Envio (limites, retries, RetryAfter) fica com o outbox
+        await outbox.send(user['telegram_id'], msg, parse_mode='Markdown')
+
+async def rebuild_reminder_index(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Reconstrói o índice de lembretes a partir do banco.
+    Roda no boot e periodicamente como rede de segurança.
+    """
+    token = reminder_index.begin_rebuild()
+    try:
+        users = await get_all_user_reminders()
+        if users is None:
+            return # Falha no banco: mantém o índice atual
+        reminder_index.rebuild(token, users)
+    finally:
+        # Sem efeito se o rebuild terminou; em falha/cancelamento solta as escritas retidas
+        reminder_index.abort_rebuild(token)
+    print(f"Scheduler: índice de lembretes reconstruído {reminder_index.stats()}")
 
 async def check_reminders(context: ContextTypes.DEFAULT_TYPE):
     """
     Job que roda a cada minuto (Ticker).
-    Verifica se algum usuário tem lembrete para o horário atual.
+    Consulta o índice em memória pelos lembretes dos usuários das partições deste
+    worker, do minuto seguinte ao último varrido até o atual (normalmente só o
+    atual; mais após tick atrasado ou troca de dono), e registra no ledger antes
+    de enviar (quem já saiu não repete).
     """
-    now = datetime.datetime.now()
-    current_time = now.strftime("%H:%M")
-    
-    # Busca usuários e seus lembretes
-    users = get_all_users()
-    
-    for user in users:
-        reminders = user.get('reminders', [])
-        # Reminders é uma string JSON se vier do banco puro, ou lista se o driver converter?
-        # O psycopg2 + JSONB costuma retornar lista/dict python direto.
-        # Mas por via das dúvidas, vamos garantir.
-        if isinstance(reminders, str):
-            try:
-                reminders = json.loads(reminders)
-            except:
-                reminders = []
-        
-        if not reminders:
-            continue
-            
-        chat_id = user['telegram_id']
-        name = user['name']
-        
-        for item in reminders:
+    if not reminder_index.is_ready():
+        await rebuild_reminder_index(context)
+
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    starts = await sharding.scan_starts(now, REMINDER_CATCHUP_MINUTES)
+    if not starts:
+        return
+
+    due, keys = [], []
+    slot = min(starts.values())
+    while slot <= now:
+        for chat_id, item in reminder_index.due_at(slot.strftime("%H:%M")):
+            start = starts.get(sharding.partition_of(chat_id))
+            if start is not None and slot >= start:
+                due.append((chat_id, item))
+                keys.append((chat_id, slot, f"reminder:{item.get('label', '')}"))
+        slot += datetime.timedelta(minutes=1)
+    if due:
+        claimed = await sharding.claim(keys)
+        if claimed is None:
+            return # Banco fora: a marca não avança e o próximo tick tenta de novo
+        for key, (chat_id, item) in zip(keys, due):
+            if key not in claimed:
+                continue # Já entregue (outro worker ou reinício neste minuto)
             # item espera-se: {"time": "08:00", "label": "Café", "message": "..."}
-            if item.get('time') == current_time:
-                msg = f"⏰ **{item.get('label', 'Lembrete')}:**\n\n{item.get('message', 'Hora de agir!')}"
-                try:
-                    await context.bot.send_message(chat_id=chat_id, text=msg)
-                    # Opcional: Logar que enviou
-                except Exception as e:
-                    print(f"Falha ao enviar msg para {name} ({chat_id}): {e}")
+            msg = f"⏰ **{item.get('label', 'Lembrete')}:**\n\n{item.get('message', 'Hora de agir!')}"
+            await outbox.send(chat_id, msg)
+    await sharding.mark_scanned(starts, now)
+
+async def renew_leases(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Heartbeat do worker: renova e rebalanceia as partições do scheduler.
+    Partições recém-assumidas trazem usuários cujos avisos de mudança podem ter
+    chegado antes do lease: reconstrói o índice para não agendar pelo estado velho.
+    """
+    before = sharding.owned_partitions()
+    owned = await sharding.heartbeat()
+    if owned - before and reminder_index.is_ready():
+        await rebuild_reminder_index(context)
+
+async def prune_ledger(context: ContextTypes.DEFAULT_TYPE):
+    deleted = await prune_deliveries()
+    print(f"Scheduler: {deleted} entregas antigas removidas do ledger")
 
 def setup_notifications(job_queue):
     # Remove jobs antigos se houver (opcional, mas bom pra reload)
     # job_queue.scheduler.remove_all_jobs()
+
+    # Leases das partições: cada worker só agenda os usuários das suas partições
+    job_queue.run_repeating(
+        renew_leases,
+        interval=sharding.LEASE_RENEW,
+        first=0,
+        name="scheduler_lease_heartbeat"
+    )
     
+    # Índice de lembretes: monta no boot e reconstrói periodicamente (rede de segurança)
+    job_queue.run_repeating(
+        rebuild_reminder_index,
+        interval=int(os.getenv("REMINDER_INDEX_REBUILD_SECONDS", 1800)),
+        first=0,
+        name="reminder_index_rebuild"
+    )
+
     # Adiciona o Ticker de Minuto
     job_queue.run_repeating(
         check_reminders,
@@ -83,10 +199,16 @@ def setup_notifications(job_queue):
         name="dynamic_reminders_ticker"
     )
     
-    # Adiciona Check de Hidratação (14:00)
-    job_queue.run_daily(
+    # Check de Hidratação: cada usuário num minuto da janela, no fuso dele
+    job_queue.run_repeating(
         check_hydration,
-        time=datetime.time(hour=14, minute=0),
-        days=(0, 1, 2, 3, 4, 5, 6), # Todos os dias
+        interval=60,
+        first=20,
         name="hydration_check"
     )
+
+    job_queue.run_daily(
+        prune_ledger,
+        time=datetime.time(hour=4, minute=0),
+        name="delivery_ledger_prune"
+    )
@@ -0,0 +1,123 @@
+import datetime
+import os
+import socket
+import time
+import uuid
+
+from .repository import heartbeat_leases, release_leases, claim_deliveries, get_scan_marks, set_scan_marks
+
+# Particionamento do scheduler entre vários processos do bot.
+# Os usuários são divididos em SCHEDULER_PARTITIONS partições (telegram_id % N).
+# Cada worker mantém leases (tabela scheduler_leases) sobre ~N/workers partições,
+# renovados a cada SCHEDULER_LEASE_RENEW segundos. Se um worker morre, os leases
+# dele vencem em SCHEDULER_LEASE_TTL e os outros assumem; se entra um worker
+# novo, os antigos devolvem o excedente no heartbeat seguinte.
+# O delivery_ledger garante entrega única mesmo durante a troca de dono.
+# Cada partição guarda no lease até que minuto os lembretes já foram varridos
+# (scanned_until): o novo dono retoma dali em vez de revarrer minutos à toa.
+
+PARTITIONS = int(os.getenv("SCHEDULER_PARTITIONS", 64))
+LEASE_TTL = int(os.getenv("SCHEDULER_LEASE_TTL", 30))        # s
+LEASE_RENEW = int(os.getenv("SCHEDULER_LEASE_RENEW", 10))    # s (bem menor que o TTL)
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+_owned = frozenset()
+_expires_at = 0.0  # relógio local: sem heartbeat válido até aqui, não age sobre nada
+_scan_marks = {}   # partição -> último minuto varrido (cópia local de scanned_until)
+_stats = {"heartbeats": 0, "heartbeat_failures": 0, "rebalances": 0, "duplicates_skipped": 0, "takeover_catchups": 0}
+
+def partition_of(telegram_id):
+    return int(telegram_id) % PARTITIONS
+
+def owned_partitions():
+    """Partições com lease válido deste worker (vazio se o lease pode ter vencido)."""
+    if time.monotonic() >= _expires_at:
+        return frozenset()
+    return _owned
+
+def owns(telegram_id):
+    return partition_of(telegram_id) in owned_partitions()
+
+async def heartbeat():
+    """Renova/rebalanceia os leases. Retorna as partições atuais."""
+    global _owned, _expires_at
+    started = time.monotonic()
+    owned = await heartbeat_leases(WORKER_ID, PARTITIONS, LEASE_TTL)
+    if owned is None:
+        _stats["heartbeat_failures"] += 1
+        return owned_partitions()
+    owned = frozenset(owned)
+    if owned != _owned:
+        _stats["rebalances"] += 1
+        print(f"Scheduler: worker {WORKER_ID} agora com {len(owned)}/{PARTITIONS} partições")
+    _owned = owned
+    # Margem: conta o TTL a partir do início do heartbeat
+    _expires_at = started + LEASE_TTL
+    _stats["heartbeats"] += 1
+    return _owned
+
+async def release():
+    """Devolve as partições no shutdown."""
+    global _owned, _expires_at
+    _owned, _expires_at = frozenset(), 0.0
+    _scan_marks.clear()
+    await release_leases(WORKER_ID)
+
+async def scan_starts(now, max_catchup):
+    """
+    Primeiro minuto a varrer em cada partição deste worker: o seguinte ao último
+    varrido, limitado a `max_catchup` minutos atrás. Partições recém-assumidas
+    leem a marca do banco (onde o dono anterior parou); sem marca, só `now`.
+    """
+    owned = owned_partitions()
+    for partition in list(_scan_marks):
+        if partition not in owned:
+            del _scan_marks[partition]
+    floor = now - datetime.timedelta(minutes=max_catchup)
+    taken = [p for p in owned if p not in _scan_marks]
+    marks = await get_scan_marks(taken) if taken else {}
+    starts = {}
+    for partition in owned:
+        if partition in _scan_marks:
+            mark = _scan_marks[partition]
+        elif marks is None:
+            starts[partition] = floor  # Banco fora: varre a janela toda (o ledger deduplica)
+            continue
+        else:
+            mark = marks.get(partition)
+            if mark is None:
+                starts[partition] = now
+                continue
+            _stats["takeover_catchups"] += 1
+        starts[partition] = max(floor, mark + datetime.timedelta(minutes=1))
+    return starts
+
+async def mark_scanned(partitions, now):
+    """Registra que as partições foram varridas até `now` (memória e lease)."""
+    if not partitions:
+        return
+    for partition in partitions:
+        _scan_marks[partition] = now
+    await set_scan_marks(WORKER_ID, list(partitions), now)
+
+async def claim(rows):
+    """
+    Filtra (user_id, slot, kind) pelo ledger: só o que ainda não foi entregue.
+    Em falha do banco retorna None e nada deve ser enviado (melhor atrasar um
+    aviso que duplicar para todos).
+    """
+    claimed = await claim_deliveries(rows)
+    if claimed is None:
+        return None
+    _stats["duplicates_skipped"] += len(rows) - len(claimed)
+    return claimed
+
+def stats():
+    owned = owned_partitions()
+    return {
+        **_stats,
+        "worker_id": WORKER_ID,
+        "partitions": PARTITIONS,
+        "owned": len(owned),
+        "lease_valid_s": round(max(0.0, _expires_at - time.monotonic()), 1),
+    }
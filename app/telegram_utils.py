@@ -0,0 +1,10 @@
+import datetime
+
+# Utilitários comuns às chamadas à API do Telegram (outbox, respostas em streaming).
+
+def retry_after_seconds(error):
+    """Segundos pedidos por um RetryAfter (o PTB entrega int ou timedelta, conforme a versão)."""
+    value = error.retry_after
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return float(value)
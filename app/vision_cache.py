@@ -0,0 +1,175 @@
+import asyncio
+import os
+import shelve
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+# Cache das análises de foto (visão) por hash perceptual.
+# Chave: (usuário, versão do perfil, legenda) + dHash 64 bits da imagem reduzida.
+# Fotos quase iguais (reenvio, encaminhamento, recompressão) ficam a poucos bits
+# de distância e reaproveitam a análise sem chamar o LLM multimodal.
+# VISION_CACHE_DIR habilita um espelho em disco (shelve) que sobrevive a reinícios.
+# O disco é acessado fora do event loop (asyncio.to_thread) e a idade de cada
+# bucket fica num índice à parte (carregado na abertura), para a poda não ler
+# todos os buckets. shelve/dbm não suporta vários processos no mesmo arquivo:
+# com vários workers, use um VISION_CACHE_DIR por processo (ou deixe desligado).
+
+MAX_ENTRIES = int(os.getenv("VISION_CACHE_SIZE", 2000))
+MAX_DISTANCE = int(os.getenv("VISION_CACHE_MAX_DISTANCE", 6))  # bits de diferença aceitos
+DISK_DIR = os.getenv("VISION_CACHE_DIR")
+DISK_BUCKET_SIZE = 16  # análises guardadas por (usuário, perfil, legenda) no disco
+DISK_MAX_BUCKETS = int(os.getenv("VISION_CACHE_DISK_BUCKETS", 20000))
+
+_lock = threading.Lock()       # memória (rápido, pode ser tomado no event loop)
+_disk_lock = threading.Lock()  # shelve (só nas threads do to_thread)
+_entries = OrderedDict()  # (bucket, hash) -> resposta, em ordem LRU
+_buckets = {}             # bucket -> set(hash)
+_disk = None
+_disk_index = None        # shelf de idades: chave do bucket -> updated
+_disk_ages = {}           # cópia em memória do índice de idades
+_stats = {"hits": 0, "near_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+def image_hash(image):
+    """dHash 64 bits: compara pixels vizinhos da imagem em tons de cinza 9x8."""
+    small = image.convert("L").resize((9, 8), Image.BILINEAR, reducing_gap=2.0)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+def make_bucket(profile, caption):
+    return (
+        profile.get('telegram_id'),
+        profile.get('_version'),
+        " ".join((caption or "").lower().split()),
+    )
+
+def _distance(a, b):
+    return bin(a ^ b).count("1")
+
+def _get_disk():
+    """Abre o shelve (chamar com _disk_lock, fora do event loop)."""
+    global _disk, _disk_index, _disk_ages
+    if _disk is None and DISK_DIR:
+        os.makedirs(DISK_DIR, exist_ok=True)
+        _disk = shelve.open(os.path.join(DISK_DIR, "vision_cache"))
+        _disk_index = shelve.open(os.path.join(DISK_DIR, "vision_cache_index"))
+        _disk_ages = dict(_disk_index)
+        if len(_disk_ages) != len(_disk):
+            # Arquivo de uma versão sem índice (ou índice perdido): reconstrói uma vez
+            _disk_ages = {key: _disk[key].get("updated", 0) for key in _disk.keys()}
+            _disk_index.clear()
+            _disk_index.update(_disk_ages)
+    return _disk
+
+def _disk_key(bucket):
+    return "|".join(str(part) for part in bucket)
+
+def _put_memory(bucket, phash, response):
+    key = (bucket, phash)
+    _entries[key] = response
+    _entries.move_to_end(key)
+    _buckets.setdefault(bucket, set()).add(phash)
+    while len(_entries) > MAX_ENTRIES:
+        (old_bucket, old_hash), _ = _entries.popitem(last=False)
+        hashes = _buckets.get(old_bucket)
+        if hashes is not None:
+            hashes.discard(old_hash)
+            if not hashes:
+                del _buckets[old_bucket]
+        _stats["evictions"] += 1
+
+def _nearest(candidates, phash):
+    best, best_distance = None, MAX_DISTANCE + 1
+    for candidate in candidates:
+        distance = _distance(candidate, phash)
+        if distance < best_distance:
+            best, best_distance = candidate, distance
+    return best, best_distance
+
+def _disk_get(bucket, phash):
+    with _disk_lock:
+        disk = _get_disk()
+        if disk is None:
+            return None, None
+        stored = disk.get(_disk_key(bucket), {}).get("items", {})
+    match, _ = _nearest((int(h, 16) for h in stored), phash)
+    return match, stored[format(match, "016x")] if match is not None else None
+
+def _disk_put(bucket, phash, response):
+    with _disk_lock:
+        disk = _get_disk()
+        if disk is None:
+            return
+        key = _disk_key(bucket)
+        is_new = key not in _disk_ages
+        stored = disk.get(key, {}).get("items", {})
+        stored[format(phash, "016x")] = response
+        while len(stored) > DISK_BUCKET_SIZE:
+            stored.pop(next(iter(stored)))
+        updated = time.time()
+        disk[key] = {"updated": updated, "items": stored}
+        _disk_index[key] = updated
+        _disk_ages[key] = updated
+        if is_new and len(_disk_ages) > DISK_MAX_BUCKETS:
+            _prune_disk(disk)
+
+def _prune_disk(disk):
+    """Remove os 10% de buckets mais antigos (versões de perfil antigas somem aqui)."""
+    by_age = sorted(_disk_ages, key=_disk_ages.get)
+    for key in by_age[:max(1, len(by_age) // 10)]:
+        disk.pop(key, None)
+        _disk_index.pop(key, None)
+        del _disk_ages[key]
+        _stats["evictions"] += 1
+
+async def get(bucket, phash):
+    """Análise em cache para a imagem (ou uma quase idêntica), ou None."""
+    if bucket[0] is None or bucket[1] is None:
+        return None
+    with _lock:
+        match, distance = _nearest(_buckets.get(bucket, ()), phash)
+        if match is not None:
+            key = (bucket, match)
+            _entries.move_to_end(key)
+            _stats["hits" if distance == 0 else "near_hits"] += 1
+            return _entries[key]
+
+    if DISK_DIR:
+        match, response = await asyncio.to_thread(_disk_get, bucket, phash)
+        if match is not None:
+            with _lock:
+                _put_memory(bucket, match, response)
+                _stats["disk_hits"] += 1
+            return response
+
+    with _lock:
+        _stats["misses"] += 1
+    return None
+
+async def put(bucket, phash, response):
+    if bucket[0] is None or bucket[1] is None or not response:
+        return
+    with _lock:
+        _put_memory(bucket, phash, response)
+    if DISK_DIR:
+        await asyncio.to_thread(_disk_put, bucket, phash, response)
+
+def close():
+    global _disk, _disk_index
+    with _disk_lock:
+        if _disk is not None:
+            _disk.close()
+            _disk_index.close()
+            _disk, _disk_index = None, None
+
+def stats():
+    with _lock:
+        return {**_stats, "size": len(_entries), "maxsize": MAX_ENTRIES, "disk": bool(DISK_DIR)}
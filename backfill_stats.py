@@ -0,0 +1,14 @@
+import sys
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app.database import init_db, backfill_daily_stats, close_pool
+
+# Uso: python backfill_stats.py [telegram_id]
+user_id = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+init_db()
+rows = backfill_daily_stats(user_id)
+print(f"Consolidado diário: {rows} linhas (re)calculadas.")
+close_pool()
@@ -0,0 +1,60 @@
+import json
+import re
+import timeit
+
+from app.commands import parse_commands, plan_commands, render
+
+# Micro-benchmark do motor de comandos em respostas longas.
+# Compara a tokenização em passada única com as 5 buscas re.search antigas.
+# Uso: python bench_commands.py
+
+LEGACY_PATTERNS = [
+    r'\[\[UPDATE_SCHEDULE: (.*?)\]\]',
+    r'\[\[UPDATE_DIET: (.*?)\]\]',
+    r'\[\[UPDATE_WORKOUT: (.*?)\]\]',
+    r'\[\[LOG_WATER: (\d+)\]\]',
+    r'\[\[UPDATE_WEIGHT: ([\d\.]+)\]\]',
+]
+
+PROFILE = {
+    "telegram_id": 1,
+    "generated_plan": {
+        "diet": [{"meal": f"Refeição {i}", "foods": ["Arroz 100g", "Frango 150g"]} for i in range(6)],
+        "workout": {"split": "ABC", "days": [{"day": d, "exercises": ["Supino", "Remada"]} for d in ("Segunda", "Terça", "Quarta")]},
+    },
+    "reminders": [{"label": f"Lembrete {i}", "time": "08:00"} for i in range(10)],
+}
+
+def build_response(paragraphs, commands_per_type):
+    filler = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 8
+    tokens = []
+    for i in range(commands_per_type):
+        tokens.append('[[UPDATE_DIET: ' + json.dumps({"meal": f"Refeição {i % 6}", "foods": ["Tapioca 80g"]}) + ']]')
+        tokens.append('[[UPDATE_WORKOUT: ' + json.dumps({"day": "Terça", "exercises": ["Flexão"]}) + ']]')
+        tokens.append('[[UPDATE_SCHEDULE: ' + json.dumps({"label": f"Lembrete {i % 10}", "time": "09:00"}) + ']]')
+        tokens.append(f'[[LOG_WATER: {250 + i}]]')
+        tokens.append('[[UPDATE_WEIGHT: 80.5]]')
+    # O modelo costuma emitir os tokens no fim da resposta
+    return "\n".join([filler] * paragraphs + tokens)
+
+def legacy(text):
+    # Cada tipo: uma busca completa, só o primeiro match
+    for pattern in LEGACY_PATTERNS:
+        re.search(pattern, text)
+
+def engine(text):
+    ctx, tokens, confirmations = plan_commands(text, 1, PROFILE)
+    render(text, tokens, confirmations, {"water_total": 1000})
+
+if __name__ == "__main__":
+    for paragraphs, per_type in ((10, 0), (10, 1), (100, 5), (500, 20)):
+        text = build_response(paragraphs, per_type)
+        n = 2000 if paragraphs <= 100 else 200
+        t_legacy = timeit.timeit(lambda: legacy(text), number=n) / n * 1e6
+        t_parse = timeit.timeit(lambda: parse_commands(text), number=n) / n * 1e6
+        t_engine = timeit.timeit(lambda: engine(text), number=n) / n * 1e6
+        print(
+            f"{len(text):>7} chars, {len(parse_commands(text)):>3} tokens | "
+            f"legado (5 buscas, 1º match): {t_legacy:8.1f}µs | "
+            f"tokenização: {t_parse:8.1f}µs | motor completo: {t_engine:8.1f}µs"
+        )
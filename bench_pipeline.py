@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from app import coach
+from app.commands import run_commands
+from app.llm_fake import FakeBackend
+
+# Benchmark offline do pipeline de respostas (persona + LLM + motor de comandos)
+# e da geração de plano por seção, com o backend de LLM local (app/llm_fake.py).
+# Não precisa de Gemini, Telegram nem Postgres: a gravação dos comandos é simulada.
+# Uso: python bench_pipeline.py --users 200 --messages 5 --latency-ms 800 --error-rate 0.02
+
+MESSAGES = (
+    "Tomei 300ml de água agora",
+    "Estou pesando 81.5kg hoje",
+    "Mude meu treino para 19:00",
+    "Troque pão por tapioca no café",
+    "Troque supino por flexão no treino",
+    "Bora, como foi minha semana?",
+    "Posso comer pizza no fim de semana?",
+    "Me dá uma dica pra dormir melhor",
+)
+
+def make_profile(user_id):
+    return {
+        "telegram_id": user_id,
+        "_version": f"bench-{user_id}",
+        "name": f"Aluno {user_id}",
+        "height": 1.75,
+        "weight_current": 80.0,
+        "weight_target": 74.0,
+        "activity_level": "Moderado (3-4x)",
+        "niche": ("Programador", "Executivo", "Geral")[user_id % 3],
+        "preferences": {},
+        "generated_plan": {
+            "diet": [{"meal": "Café da Manhã", "foods": ["Pão 50g", "Ovos"]}, {"meal": "Almoço", "foods": ["Arroz 120g"]}],
+            "workout": {"split": "ABC", "days": [{"day": "Segunda", "exercises": ["Supino 4x10"]}]},
+        },
+        "reminders": [{"label": "Treino", "time": "18:00"}, {"label": "Café da Manhã", "time": "07:30"}],
+    }
+
+async def fake_apply(user_id, plan=None, reminders=None, weight=None, water=(), edit=None):
+    # Simula a transação única de apply_user_changes (edit roda sobre a linha "travada")
+    await asyncio.sleep(0.002)
+    if edit is not None:
+        profile = make_profile(user_id)
+        water = edit(profile["generated_plan"], profile["reminders"])["water"]
+    return {"water_total": float(sum(water))}
+
+async def run_user(user_id, messages, stream, latencies, outcome):
+    profile = make_profile(user_id)
+    rng = random.Random(user_id)
+    for _ in range(messages):
+        text = rng.choice(MESSAGES)
+        started = time.monotonic()
+        try:
+            if stream:
+                chunks = []
+                async for chunk in coach.stream_coach_reply(text, profile):
+                    chunks.append(chunk)
+                response = "".join(chunks)
+            else:
+                response = await coach.think_as_coach_async(text, profile)
+            await run_commands(response, user_id, profile, fake_apply)
+            outcome["ok"] += 1
+        except coach.CoachError:
+            outcome["errors"] += 1
+        latencies.append(time.monotonic() - started)
+
+async def run_plans(users, latencies, outcome):
+    async def one(user_id):
+        profile = make_profile(user_id)
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *(coach.generate_plan_section_async(profile, s) for s in ("diet", "workout", "schedule")),
+            return_exceptions=True
+        )
+        latencies.append(time.monotonic() - started)
+        failed = sum(isinstance(r, Exception) for r in results)
+        outcome["ok" if not failed else "errors"] += 1
+    await asyncio.gather(*(one(u) for u in range(users)))
+
+def report(label, elapsed, latencies, outcome):
+    done = outcome["ok"] + outcome["errors"]
+    ordered = sorted(latencies)
+    p95 = ordered[int(len(ordered) * 0.95) - 1] if ordered else 0
+    print(
+        f"{label:<10} {done:>6} em {elapsed:6.2f}s | {done / elapsed:8.1f}/s | "
+        f"p50 {statistics.median(ordered) * 1000 if ordered else 0:7.1f}ms | p95 {p95 * 1000:7.1f}ms | "
+        f"erros {outcome['errors']}"
+    )
+
+async def main(args):
+    backend = coach.use_backend(FakeBackend(
+        seed=args.seed, latency_ms=args.latency_ms, latency_sigma=args.sigma,
+        error_rate=args.error_rate, empty_rate=args.empty_rate
+    ))
+    for stream in (False, True):
+        latencies, outcome = [], {"ok": 0, "errors": 0}
+        started = time.monotonic()
+        await asyncio.gather(*(run_user(u, args.messages, stream, latencies, outcome) for u in range(args.users)))
+        report("stream" if stream else "resposta", time.monotonic() - started, latencies, outcome)
+
+    latencies, outcome = [], {"ok": 0, "errors": 0}
+    started = time.monotonic()
+    await run_plans(args.users, latencies, outcome)
+    report("plano", time.monotonic() - started, latencies, outcome)
+    print(f"backend: {backend.stats} | persona cache: {coach.get_persona_cache_stats()}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark offline do pipeline do coach")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=800)
+    parser.add_argument("--sigma", type=float, default=0.35)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--empty-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,33 @@
+import asyncio
+import sys
+from collections import Counter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app.database import init_db, get_plan_profiles, get_plan_template, close_pool
+from app.plan_library import bucket_for, get_template
+from app.repository import shutdown as shutdown_repository
+
+# Uso: python precompute_plans.py [quantidade]
+# Gera offline os planos-modelo das faixas de perfil mais comuns entre os
+# usuários atuais que ainda não têm modelo (padrão: as 50 mais comuns).
+limit = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+async def main():
+    counts = Counter(filter(None, (bucket_for(p) for p in get_plan_profiles())))
+    pending = [b for b, _ in counts.most_common() if get_plan_template(b) is None][:limit]
+    print(f"Faixas: {len(counts)} | sem modelo: {len(pending)} (gerando até {limit})")
+    done = 0
+    for bucket in pending:
+        if await get_template(bucket, source="offline") is not None:
+            done += 1
+            print(f"OK  {bucket} ({counts[bucket]} usuários)")
+        else:
+            print(f"ERRO {bucket}")
+    print(f"Modelos gerados: {done}/{len(pending)}")
+
+init_db()
+asyncio.run(main())
+shutdown_repository()
+close_pool()
@@ -10,12 +10,13 @@ from telegram.ext import (
     CallbackQueryHandler
 )
 
-from app.database import init_db
+from app.database import close_pool
+from app.repository import init_db, shutdown as shutdown_repository
 from app.scheduler import setup_notifications
 from app.handlers import (
     start, cancel, handle_message, handle_photo, handle_voice, handle_status, show_help,
     get_name, get_height, get_weight, get_target, get_activity, get_niche, get_custom_niche,
-    cmd_reset, reset_confirm_handler, handle_water_callback,
+    cmd_reset, cmd_plan, cmd_timezone, reset_confirm_handler, handle_water_callback,
     NOME, ALTURA, PESO, META, ATIVIDADE, NICHE, CUSTOM_NICHE
 )
 
@@ -33,10 +34,13 @@ async def error_handler(update, context):
 import asyncio
 import uvicorn
 from app.api import app as api_app
+from app import change_feed, log_sink, outbox, sharding, vision_cache
 
 async def main():
     # Inicializa DB
-    init_db()
+    await init_db()
+    # Escritas feitas por outros workers (caches e índice de lembretes)
+    change_feed.start()
     
     token = os.getenv("TELEGRAM_TOKEN")
     if not token:
@@ -63,14 +67,20 @@ async def main():
     
     # Registra Handlers
     application.add_handler(conv_handler)
+    # /cancel fora do onboarding: interrompe a resposta do coach em andamento
+    application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CommandHandler("status", handle_status))
     application.add_handler(CommandHandler("help", show_help))
     application.add_handler(CommandHandler("reset", cmd_reset))
+    application.add_handler(CommandHandler("plano", cmd_plan))
+    application.add_handler(CommandHandler("fuso", cmd_timezone))
     application.add_handler(CallbackQueryHandler(reset_confirm_handler, pattern='^(confirm_reset|cancel_reset)$'))
     application.add_handler(CallbackQueryHandler(handle_water_callback, pattern='^water_'))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Handlers que esperam o LLM não bloqueiam a fila de updates: um /cancel ou
+    # /reset do mesmo usuário é processado enquanto a resposta ainda está em andamento
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo, block=False))
+    application.add_handler(MessageHandler(filters.VOICE, handle_voice, block=False))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
     
     application.add_error_handler(error_handler)
 
@@ -86,7 +96,10 @@ async def main():
     # Start Bot
     await application.initialize()
     await application.start()
+    # Um único polling por token: outra instância com o mesmo TELEGRAM_TOKEN recebe 409 Conflict
     await application.updater.start_polling()
+    log_sink.start()
+    outbox.start(application.bot)
 
     # Start API Server
     config = uvicorn.Config(api_app, host="0.0.0.0", port=port, log_level="info")
@@ -101,8 +114,18 @@ async def main():
         # Cleanup Bot
         print("Parando Bot...")
         await application.updater.stop()
+        # Entrega o que já foi enfileirado (lembretes, avisos) antes de parar o bot
+        await outbox.stop()
+        # Devolve as partições do scheduler: outro worker assume sem esperar o TTL
+        await sharding.release()
         await application.stop()
         await application.shutdown()
+        # Garante que eventos enfileirados cheguem ao banco antes de fechar o pool
+        await log_sink.stop()
+        change_feed.stop()
+        shutdown_repository()
+        close_pool()
+        vision_cache.close()
 
 if __name__ == '__main__':
     # Fix for Windows Asyncio Loop
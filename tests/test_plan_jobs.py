@@ -0,0 +1,50 @@
+import asyncio
+
+from app import coach, plan_jobs
+from app.llm_fake import FakeBackend
+
+USER_ID = 4242
+
+PROFILE = {
+    "telegram_id": USER_ID,
+    "_version": "test",
+    "name": "Aluno",
+    "height": 1.75,
+    "weight_current": 80.0,
+    "weight_target": 74.0,
+    "activity_level": "Moderado (3-4x)",
+    "niche": "Geral",
+    "preferences": {},
+}
+
+
+class _Application:
+    def create_task(self, coro):
+        return asyncio.get_running_loop().create_task(coro)
+
+
+def test_cancel_during_plan_generation_keeps_job_running(monkeypatch):
+    saved, sent = {}, []
+
+    async def fake_update_plan_section(user_id, section, value):
+        saved[section] = value
+        return True
+
+    async def fake_send(chat_id, text, **kwargs):
+        sent.append(text)
+
+    monkeypatch.setattr(plan_jobs, "update_plan_section", fake_update_plan_section)
+    monkeypatch.setattr(plan_jobs.outbox, "send", fake_send)
+    coach.use_backend(FakeBackend(seed=1, latency_ms=200, latency_sigma=0.0))
+
+    async def scenario():
+        assert plan_jobs.start_plan_generation(_Application(), USER_ID, USER_ID, PROFILE, use_library=False)
+        await asyncio.sleep(0.05)  # seções já em andamento no LLM
+        coach.cancel_user_requests(USER_ID)  # /cancel da conversa
+        assert plan_jobs.is_generating(USER_ID)
+        await asyncio.wait_for(plan_jobs._running[USER_ID], 5)
+
+    asyncio.run(scenario())
+
+    assert set(saved) == {"diet", "workout", "schedule"}
+    assert len(sent) == 1 and "PLANO PRONTO" in sent[0]
@@ -0,0 +1,32 @@
+import asyncio
+
+from app import reminder_index, scheduler
+
+
+def _reminders(time):
+    return [{"time": time, "label": "Água", "message": "Beba água"}]
+
+
+def test_failed_rebuild_releases_pending_writes(monkeypatch):
+    async def failing_read():
+        return None
+
+    monkeypatch.setattr(scheduler, "get_all_user_reminders", failing_read)
+    asyncio.run(scheduler.rebuild_reminder_index(None))
+
+    assert reminder_index._pending == {}
+
+
+def test_overlapping_rebuilds_keep_concurrent_writes():
+    first = reminder_index.begin_rebuild()
+    reminder_index.set_user_reminders(1, _reminders("08:00"))
+    second = reminder_index.begin_rebuild()
+    reminder_index.set_user_reminders(2, _reminders("09:00"))
+
+    # O rebuild mais novo termina primeiro; o antigo, com snapshot sem as escritas, depois
+    reminder_index.rebuild(second, [{"telegram_id": 1, "reminders": _reminders("08:00")}])
+    reminder_index.rebuild(first, [])
+
+    assert [chat_id for chat_id, _ in reminder_index.due_at("08:00")] == [1]
+    assert [chat_id for chat_id, _ in reminder_index.due_at("09:00")] == [2]
+    assert reminder_index._pending == {}